@@ -0,0 +1,26 @@
+"""job heartbeat
+
+Revision ID: 5e81b3c0a9d4
+Revises: 7d4c2e8b1f60
+Create Date: 2026-10-17 05:21:07.312884
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e81b3c0a9d4'
+down_revision = '7d4c2e8b1f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('time_heartbeat', sa.DateTime(), nullable=True))
+    op.create_index('job_running_heartbeat', 'job', ['time_heartbeat'], unique=False, postgresql_where=sa.text('retval IS NULL'))
+
+
+def downgrade():
+    op.drop_index('job_running_heartbeat', table_name='job', postgresql_where=sa.text('retval IS NULL'))
+    op.drop_column('job', 'time_heartbeat')
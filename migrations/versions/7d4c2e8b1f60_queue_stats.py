@@ -0,0 +1,40 @@
+"""add queue_stats
+
+Revision ID: 7d4c2e8b1f60
+Revises: c3e1a9f5d2b7
+Create Date: 2026-10-17 04:02:19.730461
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4c2e8b1f60'
+down_revision = 'c3e1a9f5d2b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('queue_stats',
+    sa.Column('queue_id', sa.Integer(), nullable=False),
+    sa.Column('nr_targets', sa.Integer(), nullable=False),
+    sa.Column('nr_readynets', sa.Integer(), nullable=False),
+    sa.Column('nr_running', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['queue_id'], ['queue.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('queue_id')
+    )
+    op.execute('''
+        INSERT INTO queue_stats (queue_id, nr_targets, nr_readynets, nr_running)
+        SELECT
+            queue.id,
+            (SELECT count(*) FROM target WHERE target.queue_id = queue.id),
+            (SELECT count(*) FROM readynet WHERE readynet.queue_id = queue.id),
+            (SELECT count(*) FROM job WHERE job.queue_id = queue.id AND job.retval IS NULL)
+        FROM queue
+    ''')
+
+
+def downgrade():
+    op.drop_table('queue_stats')
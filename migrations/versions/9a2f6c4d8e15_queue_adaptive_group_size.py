@@ -0,0 +1,30 @@
+"""queue adaptive group size
+
+Revision ID: 9a2f6c4d8e15
+Revises: 5e81b3c0a9d4
+Create Date: 2026-10-17 18:04:12.307415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a2f6c4d8e15'
+down_revision = '5e81b3c0a9d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('queue', sa.Column('group_runtime', sa.Integer(), nullable=True))
+    op.add_column('queue', sa.Column('group_size_min', sa.Integer(), nullable=True))
+    op.add_column('queue', sa.Column('group_size_max', sa.Integer(), nullable=True))
+    op.add_column('queue_stats', sa.Column('target_runtime', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('queue_stats', 'target_runtime')
+    op.drop_column('queue', 'group_size_max')
+    op.drop_column('queue', 'group_size_min')
+    op.drop_column('queue', 'group_runtime')
@@ -0,0 +1,33 @@
+"""scheduler token bucket rate-limit
+
+Revision ID: b7d3e5a1c9f2
+Revises: 9a2f6c4d8e15
+Create Date: 2026-10-17 19:42:55.104318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e5a1c9f2'
+down_revision = '9a2f6c4d8e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'token_bucket',
+        sa.Column('hashval', sa.String(), nullable=False),
+        sa.Column('tokens', sa.Float(), nullable=False),
+        sa.Column('time_update', sa.DateTime(), nullable=False),
+        sa.Column('time_ready', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('hashval', name='token_bucket_pkey')
+    )
+    op.create_index('token_bucket_time_ready', 'token_bucket', ['time_ready'], unique=False, postgresql_where=sa.text('time_ready IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('token_bucket_time_ready', table_name='token_bucket', postgresql_where=sa.text('time_ready IS NOT NULL'))
+    op.drop_table('token_bucket')
@@ -0,0 +1,32 @@
+"""scheduler random sort keys
+
+Revision ID: c3e1a9f5d2b7
+Revises: 45996c79b2c6
+Create Date: 2026-10-17 03:12:40.518220
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e1a9f5d2b7'
+down_revision = '45996c79b2c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('readynet', sa.Column('rand', sa.Float(), server_default=sa.text('random()'), nullable=False))
+    op.create_index('readynet_queueid_rand', 'readynet', ['queue_id', 'rand'], unique=False)
+    op.add_column('target', sa.Column('rand', sa.Float(), server_default=sa.text('random()'), nullable=False))
+    op.drop_index('target_queueid_hashval', table_name='target')
+    op.create_index('target_queueid_hashval_rand', 'target', ['queue_id', 'hashval', 'rand'], unique=False)
+
+
+def downgrade():
+    op.drop_index('target_queueid_hashval_rand', table_name='target')
+    op.create_index('target_queueid_hashval', 'target', ['queue_id', 'hashval'], unique=False)
+    op.drop_column('target', 'rand')
+    op.drop_index('readynet_queueid_rand', table_name='readynet')
+    op.drop_column('readynet', 'rand')
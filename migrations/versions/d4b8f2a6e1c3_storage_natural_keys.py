@@ -0,0 +1,109 @@
+"""storage natural-key constraints
+
+Revision ID: d4b8f2a6e1c3
+Revises: b7d3e5a1c9f2
+Create Date: 2026-10-17 21:12:31.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8f2a6e1c3'
+down_revision = 'b7d3e5a1c9f2'
+branch_labels = None
+depends_on = None
+
+
+def dedupe(table, key, fields, children):
+    """
+    merge duplicates of storage table, frozen copy of sner.server.storage.dedupe at this revision
+
+    * the oldest item (lowest id) of each natural-key group is kept
+    * empty fields of kept item are filled with values of the newest duplicate having the field set
+    * tags are merged, child items are moved to the kept item
+    * duplicates are deleted
+    """
+
+    dups = f'''
+        SELECT ranked.id, ranked.keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY {key}) AS keep_id FROM {table}) ranked
+        WHERE ranked.id != ranked.keep_id
+    '''
+
+    newest_values = [f'(array_agg(item.{field} ORDER BY item.id DESC) FILTER (WHERE item.{field} IS NOT NULL))[1] AS {field}' for field in fields]
+    op.execute(f'''
+        UPDATE {table}
+        SET {', '.join(f'{field} = coalesce({table}.{field}, newest.{field})' for field in fields)}
+        FROM (
+            SELECT dups.keep_id, {', '.join(newest_values)}
+            FROM ({dups}) dups
+            JOIN {table} item ON item.id = dups.id
+            GROUP BY dups.keep_id
+        ) newest
+        WHERE {table}.id = newest.keep_id
+    ''')
+
+    op.execute(f'''
+        UPDATE {table}
+        SET tags = merged.tags
+        FROM (
+            SELECT tags.keep_id, array_agg(tags.tag) AS tags
+            FROM (
+                SELECT dups.keep_id, unnest(item.tags) AS tag FROM ({dups}) dups JOIN {table} item ON item.id = dups.id
+                UNION
+                SELECT dups.keep_id, unnest(item.tags) AS tag FROM ({dups}) dups JOIN {table} item ON item.id = dups.keep_id
+            ) tags
+            GROUP BY tags.keep_id
+        ) merged
+        WHERE {table}.id = merged.keep_id
+    ''')
+
+    for child, column in children:
+        op.execute(f'UPDATE {child} SET {column} = dups.keep_id FROM ({dups}) dups WHERE {child}.{column} = dups.id')
+
+    op.execute(f'DELETE FROM {table} USING ({dups}) dups WHERE {table}.id = dups.id')
+
+
+def upgrade():
+    # existing duplicates must be merged before unique indexes can be created, children are processed after their parents
+    dedupe('host', 'address', ['hostname', 'os', 'comment'], [('service', 'host_id'), ('vuln', 'host_id'), ('note', 'host_id')])
+    dedupe('service', 'host_id, proto, port', ['state', 'name', 'info', 'comment', 'import_time'], [('vuln', 'service_id'), ('note', 'service_id')])
+    dedupe(
+        'vuln',
+        "host_id, coalesce(service_id, 0), name, coalesce(xtype, ''), coalesce(via_target, '')",
+        ['descr', 'data', 'comment', 'import_time'],
+        []
+    )
+    dedupe('note', "host_id, coalesce(service_id, 0), coalesce(xtype, ''), coalesce(via_target, '')", ['data', 'comment', 'import_time'], [])
+
+    op.create_index('host_address', 'host', ['address'], unique=True)
+    op.create_index('host_address_inet', 'host', ['address'], unique=False, postgresql_using='gist', postgresql_ops={'address': 'inet_ops'})
+    op.create_index('service_hostid_proto_port', 'service', ['host_id', 'proto', 'port'], unique=True)
+    op.create_index(
+        'vuln_hostid_serviceid_name_xtype_viatarget',
+        'vuln',
+        ['host_id', sa.text('coalesce(service_id, 0)'), 'name', sa.text("coalesce(xtype, '')"), sa.text("coalesce(via_target, '')")],
+        unique=True
+    )
+    op.create_index('vuln_serviceid', 'vuln', ['service_id'], unique=False)
+    op.create_index(
+        'note_hostid_serviceid_xtype_viatarget',
+        'note',
+        ['host_id', sa.text('coalesce(service_id, 0)'), sa.text("coalesce(xtype, '')"), sa.text("coalesce(via_target, '')")],
+        unique=True
+    )
+    op.create_index('note_serviceid', 'note', ['service_id'], unique=False)
+    op.create_index('note_xtype', 'note', ['xtype'], unique=False)
+
+
+def downgrade():
+    op.drop_index('note_xtype', table_name='note')
+    op.drop_index('note_serviceid', table_name='note')
+    op.drop_index('note_hostid_serviceid_xtype_viatarget', table_name='note')
+    op.drop_index('vuln_serviceid', table_name='vuln')
+    op.drop_index('vuln_hostid_serviceid_name_xtype_viatarget', table_name='vuln')
+    op.drop_index('service_hostid_proto_port', table_name='service')
+    op.drop_index('host_address_inet', table_name='host')
+    op.drop_index('host_address', table_name='host')
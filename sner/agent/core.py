@@ -12,10 +12,14 @@ import shutil
 import signal
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser
-from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
+from http import HTTPStatus
 from pathlib import Path
-from time import sleep
+from random import uniform
+from threading import Event, Thread
+from time import monotonic, sleep
 from uuid import uuid4
 from zipfile import ZipFile, ZIP_DEFLATED
 
@@ -23,8 +27,9 @@ import marshmallow
 import requests
 
 from sner.server.api.schema import JobAssignmentSchema
-from sner.lib import load_yaml, TerminateContextMixin
+from sner.lib import file_sha256, load_yaml, TerminateContextMixin
 from sner.agent.modules import load_agent_plugins, REGISTERED_MODULES
+from sner.agent.transport import Transport
 from sner.version import __version__
 
 
@@ -35,8 +40,22 @@ DEFAULT_CONFIG = {
     'QUEUE': None,
     'CAPS': None,
     'BACKOFF_TIME': 5.0,
+    'BACKOFF_MAX': 300.0,
+    'ASSIGN_WAIT': 30,
+    'HEARTBEAT_INTERVAL': 60,
     'NET_TIMEOUT': 300,
-    'ONESHOT': False
+    'GZIP': True,
+    'RETRY': {
+        # assignment is not retried after server might have processed it (read errors, gateway errors), assigned job would be lost
+        'assign': {'connect': 3, 'read': 0, 'status': 3, 'backoff_factor': 0.5},
+        'output': {'connect': 3, 'read': 3, 'status': 3, 'backoff_factor': 0.5}
+    },
+    'UPLOAD_CHUNKSIZE': 16*1024*1024,
+    'ONESHOT': False,
+    'SLOTS': 1,
+    'PREFETCH': False,
+    'PREFETCH_LEAD': 10.0,
+    'SPOOL': 'spool'
 }
 
 
@@ -78,7 +97,7 @@ def config_from_args(args):
     """pull config variables from parsed args/generic object"""
 
     config = {}
-    for item in ['server', 'apikey', 'queue', 'caps', 'oneshot']:
+    for item in ['server', 'apikey', 'queue', 'caps', 'oneshot', 'slots']:
         if getattr(args, item) is not None:
             config[item.upper()] = getattr(args, item)
     return config
@@ -101,9 +120,10 @@ class AgentBase(ABC, TerminateContextMixin):
 
     def __init__(self):
         self.log = logging.getLogger(LOGGER_NAME)
-        self.module_instance = None
+        self.module_instances = {}
         self.original_signal_handlers = {}
         self.loop = None
+        self.terminated = False
 
         load_agent_plugins()
 
@@ -116,27 +136,27 @@ class AgentBase(ABC, TerminateContextMixin):
 
         self.log.info('received terminate')
         self.loop = False
-        if self.module_instance:
-            self.module_instance.terminate()
+        self.terminated = True
+        for module_instance in list(self.module_instances.values()):
+            module_instance.terminate()
 
     def process_assignment(self, assignment):
-        """process assignment"""
+        """process assignment, module runs in own job directory so several assignments can be processed concurrently"""
 
         jobdir = assignment['id']
-        oldcwd = os.getcwd()
         os.makedirs(jobdir, mode=0o700)
-        os.chdir(jobdir)
 
         try:
-            self.module_instance = REGISTERED_MODULES[assignment['config']['module']]()
-            retval = self.module_instance.run(assignment)
+            if self.terminated:
+                raise RuntimeError('agent terminated, assignment not executed')
+            self.module_instances[jobdir] = REGISTERED_MODULES[assignment['config']['module']](workdir=jobdir)
+            retval = self.module_instances[jobdir].run(assignment)
         except Exception as exc:  # pylint: disable=broad-except ; modules can raise variety of exceptions, but agent must continue
             self.log.exception(exc)
             retval = 1
         finally:
-            self.module_instance = None
+            self.module_instances.pop(jobdir, None)
 
-        os.chdir(oldcwd)
         zipdir(jobdir, f'{jobdir}.zip')
         shutil.rmtree(jobdir)
 
@@ -155,18 +175,40 @@ class ServerableAgent(AgentBase):  # pylint: disable=too-many-instance-attribute
         self.queue = config['QUEUE']
         self.caps = config['CAPS']
         self.backoff_time = config['BACKOFF_TIME']
+        self.backoff_max = config['BACKOFF_MAX']
+        self.assign_wait_max = config['ASSIGN_WAIT']
+        self.heartbeat_interval = config['HEARTBEAT_INTERVAL']
         self.net_timeout = config['NET_TIMEOUT']
+        self.upload_chunksize = config['UPLOAD_CHUNKSIZE']
         self.oneshot = config['ONESHOT']
+        self.slots = config['SLOTS']
+        self.prefetch = config['PREFETCH'] and not self.oneshot
+        self.prefetch_lead = config['PREFETCH_LEAD']
 
         self.loop = True
-        self.get_assignment_url = f'{self.server}/api/v2/scheduler/job/assign'
-        self.upload_output_url = f'{self.server}/api/v2/scheduler/job/output'
+        self.slots_status = {}
+        self.spool = Path(config['SPOOL'])
+        self.spool_event = Event()
+        self.spool_closed = False
+        self.assigned = set()
+        self.heartbeat_stop = Event()
+        self.assign_wait = 0  # long-poll is used when advertised by server
+        self.transport = Transport(
+            self.server,
+            self.apikey,
+            self.net_timeout,
+            retry=config['RETRY'],
+            gzip_requests=config['GZIP'],
+            pool_size=2*self.slots + 1
+        )
 
         self.get_assignment_params = {}
         if self.queue:
             self.get_assignment_params['queue'] = self.queue
         if self.caps:
             self.get_assignment_params['caps'] = self.caps
+        if self.heartbeat_interval:
+            self.get_assignment_params['heartbeat'] = True
 
     def shutdown(self, signum=None, frame=None):  # pragma: no cover  pylint: disable=unused-argument  ; running over multiprocessing
         """wait for current assignment to finish"""
@@ -184,10 +226,29 @@ class ServerableAgent(AgentBase):  # pylint: disable=too-many-instance-attribute
         finally:
             signal.signal(signal.SIGUSR1, self.original_signal_handlers[signal.SIGUSR1])
 
-    def call_api(self, url, data):
-        """call api"""
+    def status(self, signum=None, frame=None):  # pragma: no cover  pylint: disable=unused-argument  ; running over multiprocessing
+        """report status of all slots"""
 
-        return requests.post(url, json=data, headers={'X-API-KEY': self.apikey}, timeout=self.net_timeout)
+        for slot, status in sorted(self.slots_status.items()):
+            self.log.info('slot %d status, %s', slot, status)
+        self.log.info('spool, %d outputs', len(self.spooled()))
+        self.transport.report()
+
+    @contextmanager
+    def status_context(self):
+        """status report context manager; should restore handlers despite of underlying code exceptions"""
+
+        self.original_signal_handlers[signal.SIGUSR2] = signal.signal(signal.SIGUSR2, self.status)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGUSR2, self.original_signal_handlers[signal.SIGUSR2])
+
+    def set_status(self, slot, status):
+        """set slot status"""
+
+        self.slots_status[slot] = status
+        self.log.debug('slot %d status, %s', slot, status)
 
     def get_assignment(self):
         """get assignment from server"""
@@ -195,18 +256,24 @@ class ServerableAgent(AgentBase):  # pylint: disable=too-many-instance-attribute
         assignment = None
         while self.loop and not assignment:
             try:
-                response = self.call_api(self.get_assignment_url, self.get_assignment_params)
+                params = {**self.get_assignment_params, 'wait': self.assign_wait} if self.assign_wait else self.get_assignment_params
+                time_start = monotonic()
+                response = self.transport.post_json('assign', params)
                 response.raise_for_status()
+                self.assign_wait = min(self.assign_wait_max, int(response.headers.get('X-Assign-Wait-Max', 0)))
                 assignment = response.json()
                 if not assignment:  # response-nowork
                     self.log.debug('get_assignment response-nowork')
                     if self.oneshot:  # pylint: disable=no-else-break  ; improves readability for following pragma
                         break
                     else:  # pragma: no cover ; running over multiprocessing
-                        sleep(self.backoff_time)
+                        # server already waited for work unless it returned early (maintenance, busy, no long-poll)
+                        if (not params.get('wait')) or ((monotonic() - time_start) < params['wait']):
+                            sleep(self.backoff_time)
                         continue
                 JobAssignmentSchema().load(assignment)
-            except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, marshmallow.ValidationError) as exc:
+                self.assigned.add(assignment['id'])
+            except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, marshmallow.ValidationError, ValueError) as exc:
                 assignment = None
                 self.log.error('get_assignment error, %s', exc)
                 if self.oneshot:
@@ -216,46 +283,210 @@ class ServerableAgent(AgentBase):  # pylint: disable=too-many-instance-attribute
         self.log.info('get_assignment success, %s', assignment)
         return assignment, 0
 
-    def upload_output(self, output):
-        """upload assignment output to the server"""
+    def upload_output(self, job_id, retval, output_file, runtime=None, offset=0, progress=None):  # pylint: disable=too-many-arguments
+        """
+        upload assignment output file to the server
+
+        output is streamed in chunks, interrupted upload is resumed from the offset reported by server
 
-        uploaded = False
-        while not uploaded:
+        :param runtime: assignment execution time reported to the server
+        :param offset: offset acknowledged by server in previous attempt, server reports actual offset if it does not match
+        :param progress: callable receiving each offset acknowledged by server
+        :return: upload success
+        :rtype: bool
+        """
+
+        total = os.path.getsize(output_file)
+        headers = {'Content-Type': 'application/zip', 'X-Output-Sha256': file_sha256(output_file)}
+        params = {'retval': retval} if runtime is None else {'retval': retval, 'runtime': runtime}
+
+        while True:
             try:
-                response = self.call_api(self.upload_output_url, output)
+                with open(output_file, 'rb') as ftmp:
+                    ftmp.seek(offset)
+                    chunk = ftmp.read(self.upload_chunksize)
+                chunk_headers = {**headers, 'Content-Range': f'bytes {offset}-{offset+len(chunk)-1}/{total}'} if total else headers
+
+                response = self.transport.post('output', f'/{job_id}', params=params, data=chunk, headers=chunk_headers)
+                if response.status_code in (HTTPStatus.ACCEPTED, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE):
+                    offset = response.json()['offset']
+                    if offset >= total:
+                        offset = 0
+                    if progress:
+                        progress(offset)
+                    continue
                 response.raise_for_status()
-                uploaded = True
-            except requests.exceptions.RequestException as exc:
+            except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError) as exc:
                 self.log.error('upload_output error, %s', exc)
-                sleep(self.backoff_time)
-        self.log.info('upload_output success, %s', output['id'])
+                return False
 
-    def run(self, **kwargs):
-        """fetch, process and upload output for assignment given by server"""
+            self.log.info('upload_output success, %s', job_id)
+            return True
+
+    def spool_output(self, job_id, retval, runtime=None):
+        """move assignment output into spool, metadata file is written last and marks complete spool entry"""
+
+        shutil.move(f'{job_id}.zip', self.spool / f'{job_id}.zip')
+        self.spool_write_meta({'id': job_id, 'retval': retval, 'runtime': runtime})
+        self.assigned.discard(job_id)
+        self.spool_event.set()
+
+    def spool_write_meta(self, meta):
+        """atomically write spool entry metadata"""
+
+        tmp_path = self.spool / f'{meta["id"]}.json.tmp'
+        tmp_path.write_text(json.dumps(meta), encoding='utf-8')
+        tmp_path.replace(self.spool / f'{meta["id"]}.json')
+
+    def spool_progress(self, meta, offset):
+        """record upload offset acknowledged by server into spool entry metadata"""
+
+        meta['offset'] = offset
+        self.spool_write_meta(meta)
+
+    def spooled(self):
+        """list spooled outputs metadata files, least recently attempted first"""
+
+        return sorted(self.spool.glob('*.json'), key=lambda path: path.stat().st_mtime)
+
+    def backoff(self, failures):
+        """sleep exponential backoff with jitter, wake up on terminate"""
+
+        deadline = monotonic() + min(self.backoff_max, self.backoff_time * 2**(failures - 1)) * uniform(0.5, 1)
+        while (not self.terminated) and ((remaining := deadline - monotonic()) > 0):
+            sleep(min(remaining, 1))
+
+    def uploader(self):
+        """
+        upload spooled outputs until spool is closed and drained
+
+        outputs left in spool by previous agent run are resumed. failed upload moves the output
+        to the end of the spool (by mtime) so it does not block others, next attempt continues from
+        the last offset acknowledged by server. terminated agent leaves pending outputs in the spool.
+        """
+
+        if spooled := self.spooled():
+            self.log.info('resuming upload of %d spooled outputs', len(spooled))
+
+        failures = 0
+        while not self.terminated:
+            self.spool_event.clear()
+            if not (spooled := self.spooled()):
+                if self.spool_closed:
+                    break
+                self.spool_event.wait()
+                continue
+
+            meta = json.loads(spooled[0].read_text(encoding='utf-8'))
+            output_file = self.spool / f'{meta["id"]}.zip'
+            progress = partial(self.spool_progress, meta)
+            if self.upload_output(meta['id'], meta['retval'], output_file, meta.get('runtime'), meta.get('offset', 0), progress):
+                output_file.unlink()
+                spooled[0].unlink()
+                failures = 0
+            else:
+                os.utime(spooled[0])
+                failures += 1
+                self.backoff(failures)
+
+    def heartbeat(self):
+        """send periodic heartbeat for assigned jobs, including spooled ones, until stopped"""
+
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            if not (job_ids := sorted(self.assigned | {path.stem for path in self.spooled()})):
+                continue
+
+            try:
+                response = self.transport.post_json('heartbeat', {'ids': job_ids})
+                response.raise_for_status()
+                if lost := set(job_ids) - set(response.json()['ids']):
+                    self.log.warning('heartbeat, jobs not running on server %s', sorted(lost))
+            except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError) as exc:
+                self.log.error('heartbeat error, %s', exc)
+
+    def prefetch_assignment(self, done, expected_runtime):
+        """
+        get next assignment `prefetch_lead` seconds before current one is expected to finish or when it finishes
+
+        :param done: event set when current assignment finishes
+        :param expected_runtime: expected runtime of current assignment, None if not known
+        """
+
+        done.wait(None if expected_runtime is None else max(expected_runtime - self.prefetch_lead, 0))
+        return self.get_assignment()
+
+    def run_slot(self, slot):
+        """
+        fetch and process assignments given by server until shutdown
+
+        if enabled, next assignment is prefetched near the expected end of current one, expected end is estimated
+        by runtime of previous assignment processed by the slot. outputs are handed over to the uploader through
+        the spool along with assignment runtime measured from the start of execution.
+        prefetched assignment is already assigned by the server and it's always processed,
+        even during shutdown.
+        """
 
         retval = 0
-        with self.terminate_context(), self.shutdown_context():
-            while self.loop:
-                assignment, retval = self.get_assignment()
-
-                if assignment:
-                    retval = self.process_assignment(assignment)
-
-                    assignment_output_file = f'{assignment["id"]}.zip'
-                    output = {
-                        'id': assignment['id'],
-                        'retval': retval,
-                        'output': b64encode(Path(assignment_output_file).read_bytes()).decode('utf-8')
-                    }
-                    self.upload_output(output)
-                    os.remove(assignment_output_file)
+        assignment = None
+        runtime = None
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'prefetch-{slot}') as prefetcher:
+            while self.loop or assignment:
+                if not assignment:
+                    self.set_status(slot, 'assign')
+                    assignment, retval = self.get_assignment()
+                    if not assignment:
+                        if self.oneshot:
+                            break
+                        continue
+
+                done = Event()
+                prefetch = prefetcher.submit(self.prefetch_assignment, done, runtime) if self.prefetch else None
+                self.set_status(slot, f'running {assignment["id"]}')
+                time_start = monotonic()
+                retval = self.process_assignment(assignment)
+                runtime = monotonic() - time_start
+                done.set()
+
+                self.set_status(slot, f'spool {assignment["id"]}')
+                self.spool_output(assignment['id'], retval, runtime)
+                assignment = prefetch.result()[0] if prefetch else None
 
                 if self.oneshot:
-                    self.loop = False
+                    break
 
-        self.log.info('exit')
+        self.set_status(slot, 'exit')
         return retval
 
+    def run(self, **kwargs):
+        """
+        run configured number of slots processing assignments concurrently
+
+        first slot runs in main thread which must handle the signals, others are run in threads.
+        outputs are uploaded from spool by background uploader thread, pending uploads are finished
+        before exit unless the agent is terminated.
+        """
+
+        self.spool.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with self.terminate_context(), self.shutdown_context(), self.status_context():
+            uploader = Thread(target=self.uploader, name='uploader')
+            uploader.start()
+            heartbeat = Thread(target=self.heartbeat, name='heartbeat', daemon=True)
+            if self.heartbeat_interval:
+                heartbeat.start()
+            try:
+                with ThreadPoolExecutor(max_workers=max(self.slots - 1, 1), thread_name_prefix='slot') as executor:
+                    futures = [executor.submit(self.run_slot, slot) for slot in range(1, self.slots)]
+                    retvals = [self.run_slot(0)] + [future.result() for future in futures]
+            finally:
+                self.spool_closed = True
+                self.spool_event.set()
+                uploader.join()
+                self.heartbeat_stop.set()
+
+        self.transport.report()
+        self.log.info('exit')
+        return max(retvals)
+
 
 class AssignableAgent(AgentBase):
     """agent to execute assignments supplied from command line"""
@@ -285,6 +516,7 @@ def main(argv=None):
 
     parser.add_argument('--shutdown', type=int, help='request gracefull shutdown of the agent specified by PID')
     parser.add_argument('--terminate', type=int, help='request immediate termination of the agent specified by PID')
+    parser.add_argument('--status', type=int, help='request slots status report of the agent specified by PID')
 
     parser.add_argument('--assignment', help='manually specified assignment; mostly for debug purposses')
 
@@ -294,6 +526,7 @@ def main(argv=None):
     parser.add_argument('--queue', help='specific queue selector')
     parser.add_argument('--caps', nargs='+', help='agent capabilities tags')
     parser.add_argument('--oneshot', action='store_true', help='process single assignment and exit')
+    parser.add_argument('--slots', type=int, help='number of assignments processed concurrently')
 
     args = parser.parse_args(argv)
     if args.debug:
@@ -308,6 +541,8 @@ def main(argv=None):
         return os.kill(args.shutdown, signal.SIGUSR1)
     if args.terminate:
         return os.kill(args.terminate, signal.SIGTERM)
+    if args.status:
+        return os.kill(args.status, signal.SIGUSR2)
 
     # agent with custom assignment
     if args.assignment:
@@ -54,15 +54,16 @@ class ModuleBase(ABC):
         'module': str
     })
 
-    def __init__(self):
+    def __init__(self, workdir='.'):
         self.log = logging.getLogger(f'sner.agent.module.{self.__class__.__name__}')
         self.process = None
+        self.workdir = Path(workdir)
 
     @abstractmethod
     def run(self, assignment):
-        """run module for assignment"""
+        """run module for assignment, all files must be created in module workdir"""
 
-        Path('assignment.json').write_text(json.dumps(assignment), encoding='utf-8')
+        (self.workdir / 'assignment.json').write_text(json.dumps(assignment), encoding='utf-8')
         self.CONFIG_SCHEMA.validate(assignment['config'])
 
     @abstractmethod
@@ -79,11 +80,11 @@ class ModuleBase(ABC):
                 self.log.error(exc)
 
     def _execute(self, cmd, output_file='output'):
-        """execute command and capture output"""
+        """execute command in module workdir and capture output"""
 
         cmdarg = shlex.split(cmd) if isinstance(cmd, str) else cmd
-        with open(output_file, 'w', encoding='utf-8') as output_fd:
-            self.process = subprocess.Popen(cmdarg, stdin=subprocess.DEVNULL, stdout=output_fd, stderr=subprocess.STDOUT)  # noqa: E501  pylint: disable=consider-using-with
+        with open(self.workdir / output_file, 'w', encoding='utf-8') as output_fd:
+            self.process = subprocess.Popen(cmdarg, stdin=subprocess.DEVNULL, stdout=output_fd, stderr=subprocess.STDOUT, cwd=self.workdir)  # noqa: E501  pylint: disable=consider-using-with
             retval = self.process.wait()
             self.process = None
         return retval
@@ -0,0 +1,109 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+sner agent server transport
+"""
+
+import gzip
+import json
+import logging
+from collections import defaultdict
+from http import HTTPStatus
+from threading import Lock
+from time import monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+ENDPOINTS = {
+    'assign': '/api/v2/scheduler/job/assign',
+    'output': '/api/v2/scheduler/job/output',
+    'heartbeat': '/api/v2/scheduler/job/heartbeat'
+}
+RETRY_STATUS_FORCELIST = (
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT
+)
+# responded before the request has been processed, only these are safe to retry for non-idempotent endpoints
+RETRY_STATUS_FORCELIST_UNPROCESSED = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+NON_IDEMPOTENT_ENDPOINTS = ('assign',)
+RETRY_TOTAL = 10
+GZIP_MIN_SIZE = 1024
+
+
+class Transport:
+    """
+    agent to server transport
+
+    * single keep-alive connection pool shared by all agent threads
+    * json request bodies are gzip compressed, compressed responses are handled by requests
+    * retry policy is configured per endpoint, eg. `{'assign': {'connect': 3, 'backoff_factor': 0.5}}`,
+      see `urllib3.util.retry.Retry` for policy options
+    * non-idempotent endpoints are retried by default only on statuses responded before the request has been processed
+    * latency counters are kept per endpoint
+    """
+
+    def __init__(self, server, apikey, timeout, retry=None, gzip_requests=True, pool_size=10):  # pylint: disable=too-many-arguments
+        self.log = logging.getLogger('sner.agent.transport')
+        self.server = server
+        self.timeout = timeout
+        self.gzip_requests = gzip_requests
+        self.stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'time': 0.0, 'max': 0.0})
+        self.stats_lock = Lock()
+
+        self.session = requests.Session()
+        self.session.headers['X-API-KEY'] = apikey
+        self.session.mount(server, HTTPAdapter(pool_maxsize=pool_size))
+        for endpoint, policy in (retry or {}).items():
+            status_forcelist = RETRY_STATUS_FORCELIST_UNPROCESSED if endpoint in NON_IDEMPOTENT_ENDPOINTS else RETRY_STATUS_FORCELIST
+            max_retries = Retry(
+                **{'total': RETRY_TOTAL, 'status_forcelist': status_forcelist, 'allowed_methods': None, 'raise_on_status': False, **policy}
+            )
+            self.session.mount(f'{server}{ENDPOINTS[endpoint]}', HTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries))
+
+    def post(self, endpoint, path='', **kwargs):
+        """post request to the endpoint, account latency"""
+
+        time_start = monotonic()
+        try:
+            response = self.session.post(f'{self.server}{ENDPOINTS[endpoint]}{path}', timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.account(endpoint, monotonic() - time_start, error=True)
+            raise
+
+        self.account(endpoint, monotonic() - time_start, error=not response.ok)
+        return response
+
+    def post_json(self, endpoint, data, path=''):
+        """post json data to the endpoint"""
+
+        body = json.dumps(data).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.gzip_requests and (len(body) >= GZIP_MIN_SIZE):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return self.post(endpoint, path, data=body, headers=headers)
+
+    def account(self, endpoint, elapsed, error=False):
+        """account endpoint call"""
+
+        with self.stats_lock:
+            stats = self.stats[endpoint]
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['time'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+        self.log.debug('transport %s call, elapsed %.3fs, error %s', endpoint, elapsed, error)
+
+    def report(self):
+        """log latency counters"""
+
+        with self.stats_lock:
+            for endpoint, stats in sorted(self.stats.items()):
+                self.log.info(
+                    'transport %s stats, calls %d, errors %d, avg %.3fs, max %.3fs',
+                    endpoint, stats['calls'], stats['errors'], stats['time'] / stats['calls'], stats['max']
+                )
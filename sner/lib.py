@@ -6,6 +6,7 @@ shared functions
 import os
 import signal
 from contextlib import contextmanager
+from hashlib import sha256
 from pathlib import Path
 from zipfile import ZipFile
 
@@ -35,6 +36,16 @@ def file_from_zip(zippath, filename):
             return ftmp.read()
 
 
+def file_sha256(path, bufsize=1024*1024):
+    """compute hex sha256 digest of file content"""
+
+    digest = sha256()
+    with open(path, 'rb') as ftmp:
+        while chunk := ftmp.read(bufsize):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def format_host_address(value):
     """format ipv4 vs ipv6 address to string"""
     return value if ':' not in value else f'[{value}]'
@@ -25,8 +25,8 @@ class AgentModule(ModuleBase):
         'delay': int,
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = True
 
     def run(self, assignment):
@@ -5,7 +5,6 @@ sner agent nmap module
 
 import shlex
 from ipaddress import AddressValueError, IPv6Address
-from pathlib import Path
 
 from schema import Schema, Optional
 
@@ -26,8 +25,8 @@ class AgentModule(ModuleBase):
         Optional('timing_perhost'): int
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = True
 
     @staticmethod
@@ -58,7 +57,7 @@ class AgentModule(ModuleBase):
     def run_scan(self, assignment, targets, targets_file, output_file, extra_args=None):  # pylint: disable=too-many-arguments
         """run scan"""
 
-        Path(targets_file).write_text('\n'.join(targets), encoding='utf-8')
+        (self.workdir / targets_file).write_text('\n'.join(targets), encoding='utf-8')
 
         timing_args = []
         if 'timing_perhost' in assignment['config']:
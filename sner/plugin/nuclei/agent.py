@@ -4,7 +4,6 @@ sner agent nuclei module
 """
 
 import shlex
-from pathlib import Path
 from schema import Schema
 from sner.agent.modules import ModuleBase
 
@@ -25,7 +24,7 @@ class AgentModule(ModuleBase):
     def run(self, assignment):
         super().run(assignment)
 
-        Path('targets').write_text('\n'.join(assignment['targets']), encoding='utf-8')
+        (self.workdir / 'targets').write_text('\n'.join(assignment['targets']), encoding='utf-8')
 
         output_args = ['-nc', '-je', 'output.json', '-se', 'output.sarif.json', '-o', 'output']
         target_args = ['-l', 'targets']
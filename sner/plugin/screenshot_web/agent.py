@@ -29,8 +29,8 @@ class AgentModule(ModuleBase):
         'geometry': str
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = False
 
     # pylint: disable=duplicate-code
@@ -45,20 +45,20 @@ class AgentModule(ModuleBase):
             filebase = str(uuid4())
             screenshot_path = Path(f'{filebase}.png')
             profile_dir = Path(f'{filebase}.profile')
-            profile_dir.mkdir()
+            (self.workdir / profile_dir).mkdir()
 
             self._execute(
                 [
                     'timeout', '60',
                     'firefox', '--headless', '--profile', profile_dir,
-                    '--screenshot', screenshot_path.absolute(), '--window-size', assignment['config']['geometry'],
+                    '--screenshot', (self.workdir / screenshot_path).absolute(), '--window-size', assignment['config']['geometry'],
                     url
                 ],
                 f'{filebase}.output'
             )
-            rmtree(f'{profile_dir}')
+            rmtree(self.workdir / profile_dir)
             results[str(screenshot_path)] = {'target': item, 'timestamp': datetime.now().isoformat()}
-            Path('results.json').write_text(json.dumps(results), encoding='utf-8')
+            (self.workdir / 'results.json').write_text(json.dumps(results), encoding='utf-8')
 
             sleep(assignment['config']['delay'])
 
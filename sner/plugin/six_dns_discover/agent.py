@@ -4,7 +4,6 @@ sner agent ipv6 (via ipv4 enum ptr) dns discovery module
 """
 
 import json
-from pathlib import Path
 from socket import AF_INET6, getaddrinfo, gethostbyaddr
 from time import sleep
 
@@ -26,8 +25,8 @@ class AgentModule(ModuleBase):
         'delay': int
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = True
 
     # pylint: disable=duplicate-code
@@ -51,7 +50,7 @@ class AgentModule(ModuleBase):
             if not self.loop:  # pragma: no cover  ; not tested
                 break
 
-        Path('output.json').write_text(json.dumps(result), encoding='utf-8')
+        (self.workdir / 'output.json').write_text(json.dumps(result), encoding='utf-8')
         return 0
 
     def terminate(self):  # pragma: no cover  ; not tested / running over multiprocessing
@@ -34,8 +34,8 @@ class AgentModule(ModuleBase):
         'rate': int,
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = True
 
     @staticmethod
@@ -23,8 +23,8 @@ class AgentModule(ModuleBase):  # pragma: cover-ignore-if-not-pytestslow
         'delay': int,
     })
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.loop = True
 
     def run(self, assignment):
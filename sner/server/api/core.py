@@ -9,7 +9,7 @@ from sqlalchemy import func
 
 from sner.server.extensions import db
 
-from sner.server.scheduler.models import Heatmap, Job, Queue, Readynet, Target
+from sner.server.scheduler.models import Heatmap, Job, Queue, QueueStats, Readynet
 from sner.server.storage.models import Host, Note, Service, Versioninfo, Vuln, Vulnsearch
 
 
@@ -25,10 +25,17 @@ def get_metrics():
     metrics['sner_storage_versioninfo_total'] = Versioninfo.query.count()
     metrics['sner_storage_vulnsearch_total'] = Vulnsearch.query.count()
 
-    queue_targets = db.session.query(Queue.name, func.count(Target.id).label('cnt')).select_from(Queue).outerjoin(Target).group_by(Queue.name).all()
-    for queue, targets in queue_targets:
+    queue_stats = db.session.query(
+        Queue.name,
+        func.coalesce(QueueStats.nr_targets, 0),
+        func.coalesce(QueueStats.nr_readynets, 0),
+        func.coalesce(QueueStats.nr_running, 0)
+    ).select_from(Queue).outerjoin(QueueStats).all()
+    for queue, targets, readynets, running in queue_stats:
         metrics[f'sner_scheduler_queue_targets_total{{name="{queue}"}}'] = targets
-    metrics['sner_scheduler_targets_total'] = Target.query.count()
+        metrics[f'sner_scheduler_queue_readynets_total{{name="{queue}"}}'] = readynets
+        metrics[f'sner_scheduler_queue_jobs_running_total{{name="{queue}"}}'] = running
+    metrics['sner_scheduler_targets_total'] = sum(targets for _, targets, _, _ in queue_stats)
 
     stale_horizont = datetime.utcnow() - timedelta(days=5)
     metrics['sner_scheduler_jobs_total{state="running"}'] = Job.query.filter(Job.retval == None, Job.time_start > stale_horizont).count()  # noqa: E501,E711  pylint: disable=singleton-comparison
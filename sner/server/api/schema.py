@@ -21,6 +21,8 @@ class JobAssignArgsSchema(BaseSchema):
 
     queue = fields.String()
     caps = fields.List(fields.String)
+    wait = fields.Integer(validate=validate.Range(min=0))
+    heartbeat = fields.Boolean()
 
 
 class JobAssignmentConfigSchema(BaseSchema):
@@ -61,6 +63,19 @@ class JobOutputSchema(BaseSchema):
     output = fields.String()
 
 
+class JobHeartbeatSchema(Schema):  # not BaseSchema, empty ids list is a valid response and must not be removed
+    """/api/v2/scheduler/job/heartbeat request and response"""
+
+    ids = fields.List(fields.String(validate=validate.Regexp(r'^[a-f0-9\-]{36}$')), required=True)
+
+
+class JobOutputStreamArgsSchema(BaseSchema):
+    """/api/v2/scheduler/job/output/<id> request query args"""
+
+    retval = fields.Integer(required=True)
+    runtime = fields.Float(validate=validate.Range(min=0))
+
+
 class PublicHostArgsSchema(BaseSchema):
     """public host args schema"""
 
@@ -4,19 +4,24 @@ apiv2 controller
 """
 
 import binascii
+import gzip
+import re
+import shutil
 from base64 import b64decode
 from http import HTTPStatus
+from pathlib import Path
 
-from flask import current_app, jsonify, Response
+from flask import current_app, jsonify, request, Response
 from flask_login import current_user
 from flask_smorest import abort, Blueprint, Page
 from sqlalchemy import or_
 
 import sner.server.api.schema as api_schema
+from sner.lib import file_sha256
 from sner.server.api.core import get_metrics
 from sner.server.auth.core import apikey_required
 from sner.server.extensions import db
-from sner.server.scheduler.core import SchedulerService, SchedulerServiceBusyException
+from sner.server.scheduler.core import JobManager, SchedulerService, SchedulerServiceBusyException
 from sner.server.scheduler.models import Job
 from sner.server.storage.models import Host, Note, Service, Versioninfo, Vulnsearch
 from sner.server.storage.version_parser import is_in_version_range, parse as versionspec_parse
@@ -24,6 +29,26 @@ from sner.server.utils import filter_query
 
 
 blueprint = Blueprint('api', __name__)  # pylint: disable=invalid-name
+CONTENT_RANGE_REGEXP = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+OUTPUT_STREAM_BUFSIZE = 1024*1024
+GZIP_MIN_SIZE = 1024
+
+
+@blueprint.after_request
+def gzip_response(response):
+    """compress json responses for clients accepting gzip"""
+
+    if (
+        (response.mimetype == 'application/json')
+        and (not response.is_streamed)
+        and ('Content-Encoding' not in response.headers)
+        and request.accept_encodings.quality('gzip')
+        and (len(response.get_data()) >= GZIP_MIN_SIZE)
+    ):
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
 
 
 @blueprint.route('/v2/scheduler/job/assign', methods=['POST'])
@@ -31,18 +56,30 @@ blueprint = Blueprint('api', __name__)  # pylint: disable=invalid-name
 @blueprint.arguments(api_schema.JobAssignArgsSchema)
 @blueprint.response(HTTPStatus.OK, api_schema.JobAssignmentSchema)
 def v2_scheduler_job_assign_route(args):
-    """assign job for agent"""
+    """
+    assign job for agent
+
+    if long-poll is enabled on server, agent might request to wait for work up to `wait` seconds,
+    server advertises maximum wait time in `X-Assign-Wait-Max` response header.
+    agent sending heartbeats announces it by `heartbeat` flag, its jobs are reaped even if no heartbeat arrives.
+    """
+
+    wait_max = current_app.config['SNER_ASSIGN_WAIT_MAX']
+    headers = {'X-Assign-Wait-Max': str(wait_max)} if wait_max else {}
 
     if current_app.config['SNER_MAINTENANCE']:
-        return {}  # nowork
+        return {}, HTTPStatus.OK, headers  # nowork
 
     try:
-        resp = SchedulerService.job_assign(args.get('queue'), args.get('caps', []))
+        if wait := min(args.get('wait', 0), wait_max):
+            resp = SchedulerService.job_assign_wait(args.get('queue'), args.get('caps', []), wait, args.get('heartbeat', False))
+        else:
+            resp = SchedulerService.job_assign(args.get('queue'), args.get('caps', []), args.get('heartbeat', False))
         if 'id' in resp:
             current_app.logger.info(f'api.scheduler job assign {resp.get("id")}')
     except SchedulerServiceBusyException:
         resp = {}  # nowork
-    return resp
+    return resp, HTTPStatus.OK, headers
 
 
 @blueprint.route('/v2/scheduler/job/output', methods=['POST'])
@@ -64,7 +101,8 @@ def v2_scheduler_job_output_route(args):
 
     try:
         job_id = job.id
-        SchedulerService.job_output(job, args['retval'], output)
+        if not SchedulerService.job_output(job, args['retval'], output):
+            return jsonify({'message': 'discard job'})
     except SchedulerServiceBusyException:
         return jsonify({'message': 'server busy'}), HTTPStatus.TOO_MANY_REQUESTS
 
@@ -72,6 +110,134 @@ def v2_scheduler_job_output_route(args):
     return jsonify({'message': 'success'})
 
 
+class OutputStreamError(Exception):
+    """output stream request error, carries api response"""
+
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST, **kwargs):
+        super().__init__(message)
+        self.data = {'message': message, **kwargs}
+        self.status = status
+
+
+@blueprint.route('/v2/scheduler/job/output/<job_id>', methods=['POST'])
+@apikey_required('agent')
+@blueprint.arguments(api_schema.JobOutputStreamArgsSchema, location='query')
+def v2_scheduler_job_output_stream_route(args, job_id):
+    """
+    receive output from assigned job as raw zip body or multipart upload (file field output)
+
+    * output is streamed into partial file, request might carry single chunk of the output
+      specified by `Content-Range: bytes start-end/total` header in order to resume interrupted uploads
+    * completed output is verified against optional `X-Output-Sha256` header
+    """
+
+    job = Job.query.filter(Job.id == job_id, Job.retval == None).one_or_none()  # noqa: E711  pylint: disable=singleton-comparison
+    if not job:
+        # invalid/repeated requests are silently discarded, agent would delete working data
+        # on it's side as well
+        return jsonify({'message': 'discard job'})
+
+    part_path = Path(f'{job.output_abspath}.part')
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        content_range = _output_content_range(part_path)
+        offset = _output_write_chunk(part_path, content_range)
+        if content_range and (offset != content_range[2]):
+            return jsonify({'message': 'chunk accepted', 'offset': offset}), HTTPStatus.ACCEPTED
+        _output_complete(job, args, part_path, content_range[0] if content_range else 0)
+    except OutputStreamError as exc:
+        return jsonify(exc.data), exc.status
+
+    current_app.logger.info(f'api.scheduler job output {job_id}')
+    return jsonify({'message': 'success'})
+
+
+def _output_content_range(part_path):
+    """
+    parse and validate request content range against partial output file
+
+    :return: (start, end, total) of the chunk or None for whole output upload
+    :rtype: tuple
+    """
+
+    if 'Content-Range' not in request.headers:
+        return None
+
+    if not (content_range := CONTENT_RANGE_REGEXP.match(request.headers['Content-Range'])):
+        raise OutputStreamError('invalid request')
+    start, end, total = map(int, content_range.groups())
+    if not start <= end < total:
+        raise OutputStreamError('invalid request')
+
+    # upload can be always restarted from the beginning
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    if start not in (0, offset):
+        raise OutputStreamError('invalid range', HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, offset=offset)
+
+    return start, end, total
+
+
+def _output_write_chunk(part_path, content_range):
+    """
+    write request body into partial output file
+
+    :return: size of partial output
+    :rtype: int
+    """
+
+    start = content_range[0] if content_range else 0
+    stream = request.files['output'].stream if 'output' in request.files else request.stream
+    with part_path.open('r+b' if start else 'wb') as part_file:
+        part_file.seek(start)
+        shutil.copyfileobj(stream, part_file, OUTPUT_STREAM_BUFSIZE)
+        part_file.truncate()
+        offset = part_file.tell()
+
+    if content_range and (offset != content_range[1] + 1):
+        _truncate_output_part(part_path, start)
+        raise OutputStreamError('invalid request')
+
+    return offset
+
+
+def _output_complete(job, args, part_path, start):
+    """verify and process completed output, last chunk starting at `start` is dropped if server is busy"""
+
+    if ('X-Output-Sha256' in request.headers) and (file_sha256(part_path) != request.headers['X-Output-Sha256'].lower()):
+        part_path.unlink()
+        raise OutputStreamError('checksum mismatch')
+
+    try:
+        if not SchedulerService.job_output(job, args['retval'], part_path, args.get('runtime')):
+            part_path.unlink()
+            raise OutputStreamError('discard job', HTTPStatus.OK)
+    except SchedulerServiceBusyException:
+        # drop last chunk, so the agent can repeat the request
+        _truncate_output_part(part_path, start)
+        raise OutputStreamError('server busy', HTTPStatus.TOO_MANY_REQUESTS) from None
+
+
+@blueprint.route('/v2/scheduler/job/heartbeat', methods=['POST'])
+@apikey_required('agent')
+@blueprint.arguments(api_schema.JobHeartbeatSchema)
+@blueprint.response(HTTPStatus.OK, api_schema.JobHeartbeatSchema)
+def v2_scheduler_job_heartbeat_route(args):
+    """record heartbeat of running jobs, returns ids of jobs still running"""
+
+    return {'ids': JobManager.heartbeat(args['ids'])}
+
+
+def _truncate_output_part(part_path, size):
+    """truncate or remove partial output file"""
+
+    if size:
+        with part_path.open('r+b') as part_file:
+            part_file.truncate(size)
+    else:
+        part_path.unlink()
+
+
 @blueprint.route('/v2/stats/prometheus')
 @blueprint.response(HTTPStatus.OK, {'type': 'string'}, content_type='text/plain')
 def v2_stats_prometheus_route():
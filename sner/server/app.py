@@ -21,9 +21,9 @@ from sner.agent.modules import load_agent_plugins
 from sner.lib import load_yaml
 from sner.server.extensions import api, db, jsglue, migrate, login_manager, oauth, webauthn
 from sner.server.parser import load_parser_plugins
-from sner.server.scheduler.core import ExclMatcher
+from sner.server.scheduler.exclusion import ExclMatcher
 from sner.server.sessions import FilesystemSessionInterface
-from sner.server.utils import error_response
+from sner.server.utils import error_response, GzipRequestMiddleware
 from sner.version import __version__
 
 # blueprints and commands
@@ -79,6 +79,16 @@ DEFAULT_CONFIG = {
     # sner server scheduler
     'SNER_MAINTENANCE': False,
     'SNER_HEATMAP_HOT_LEVEL': 0,
+    'SNER_HEATMAP_PREFIXLEN_IPV4': 24,
+    'SNER_HEATMAP_PREFIXLEN_IPV6': 48,
+    'SNER_RATELIMIT_ENGINE': 'heatmap',
+    'SNER_TOKENBUCKET_RATE': 60,
+    'SNER_TOKENBUCKET_BURST': 10,
+    'SNER_ASSIGN_WAIT_MAX': 0,
+    'SNER_ASSIGN_WAITERS_MAX': 16,
+    'SNER_HEARTBEAT_TIMEOUT': 0,
+    'SNER_OUTPUT_STORE': 'flat',
+    'SNER_OUTPUT_STORE_ZSTD_LEVEL': 0,
     'SNER_EXCLUSIONS': [
         ['regex', r'^tcp://.*:22$'],
         ['network', '127.66.66.0/26']
@@ -195,6 +205,7 @@ def create_app(config_file='/etc/sner.yaml', config_env='SNER_CONFIG'):
 
     if app.config['XFLASK_PROXYFIX']:
         app.wsgi_app = ProxyFix(app.wsgi_app)
+    app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
     app.session_interface = FilesystemSessionInterface(os.path.join(app.config['SNER_VAR'], 'sessions'), app.config['SNER_SESSION_IDLETIME'])
 
     CORS(app, supports_credentials=True)
@@ -276,6 +287,7 @@ def create_app(config_file='/etc/sner.yaml', config_env='SNER_CONFIG'):
             'Heatmap': scheduler_models.Heatmap,
             'Job': scheduler_models.Job,
             'Queue': scheduler_models.Queue,
+            'QueueStats': scheduler_models.QueueStats,
             'Readynet': scheduler_models.Readynet,
             'Target': scheduler_models.Target,
 
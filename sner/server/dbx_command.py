@@ -221,6 +221,7 @@ def initdata_dev():
         host=host,
         name='vulnerability2',
         xtype='testxtype.124',
+        via_target='vhost.localhost',
         severity=SeverityEnum.INFO,
         tags=['info']
     ))
@@ -274,6 +275,7 @@ def initdata_dev():
         host=product_host,
         service=product_service,
         xtype='nmap.banner_dict',
+        via_target='vhost.localhost',
         data='{"product": "Apache httpd", "version": "0.0", "extrainfo": "(xssdummy<script>alert(window);</script>) dummy/1.1"}'
     ))
 
@@ -14,13 +14,13 @@ from time import sleep
 import psycopg2
 from flask import current_app
 from pytimeparse import parse as timeparse
-from sqlalchemy import select
 from sqlalchemy.orm.exc import NoResultFound
 
 from sner.lib import format_host_address, get_nested_key, TerminateContextMixin
 from sner.server.extensions import db
-from sner.server.scheduler.core import enumerate_network, JobManager, QueueManager
-from sner.server.scheduler.models import Queue, Job, Target
+from sner.server.scheduler.core import enumerate_network, JobManager, QueueManager, SchedulerService
+from sner.server.scheduler.models import Queue, Job
+from sner.server.scheduler.outputstore import output_store
 from sner.server.storage.core import StorageManager
 from sner.server.storage.versioninfo import VersioninfoManager
 
@@ -188,10 +188,8 @@ class QueueHandler(Stage):  # pylint: disable=too-few-public-methods
     def task(self, data):
         """enqueue data/targets into all configured queues"""
 
-        already_queued = db.session.connection().execute(select(Target.target).filter(Target.queue == self.queue)).scalars().all()
-        enqueue = list(set(data) - set(already_queued))
-        QueueManager.enqueue(self.queue, enqueue)
-        current_app.logger.info(f'{self.__class__.__name__} enqueued {len(enqueue)} targets to "{self.queue.name}"')
+        enqueued = QueueManager.enqueue(self.queue, data, skip_queued=True)
+        current_app.logger.info(f'{self.__class__.__name__} enqueued {enqueued} targets to "{self.queue.name}"')
 
 
 class DummyStage(Stage):  # pylint: disable=too-few-public-methods
@@ -250,18 +248,21 @@ class StorageSixEnum(Schedule):  # pylint: disable=too-few-public-methods
 class StorageRescan(Schedule):  # pylint: disable=too-few-public-methods
     """storage rescan"""
 
-    def __init__(self, schedule, host_interval, servicedisco_stage, service_interval, servicescan_stages):  # pylint: disable=too-many-arguments
+    def __init__(  # pylint: disable=too-many-arguments
+        self, schedule, host_interval, servicedisco_stage, service_interval, servicescan_stages, limit=None
+    ):
         super().__init__(schedule)
         self.host_interval = host_interval
         self.servicedisco_stage = servicedisco_stage
         self.service_interval = service_interval
         self.servicescan_stages = servicescan_stages
+        self.limit = limit
 
     def _run(self):
         """run"""
 
-        hosts = StorageManager.get_rescan_hosts(self.host_interval)
-        services = StorageManager.get_rescan_services(self.service_interval)
+        hosts = StorageManager.get_rescan_hosts(self.host_interval, self.limit)
+        services = StorageManager.get_rescan_services(self.service_interval, self.limit)
         current_app.logger.info(f'{self.__class__.__name__} rescaning {len(hosts)} hosts {len(services)} services')
         self.servicedisco_stage.task(hosts)
         for stage in self.servicescan_stages:
@@ -321,15 +322,48 @@ class StorageLoader(QueueHandler):
 
 
 class StorageCleanup(Stage):  # pylint: disable=too-few-public-methods
-    """cleanup storage"""
+    """cleanup storage, incremental cleanup processes only items touched since the last run"""
+
+    def __init__(self, incremental=False, log_items=True):
+        self.incremental = incremental
+        self.log_items = log_items
+        self.lastrun_path = Path(f'{current_app.config["SNER_VAR"]}/lastrun.{self.__class__.__name__}')
 
     def run(self):
         """cleanup storage"""
 
-        StorageManager.cleanup_storage()
+        since = None
+        if self.incremental and self.lastrun_path.exists():
+            since = datetime.fromisoformat(self.lastrun_path.read_text(encoding='utf8'))
+
+        start = datetime.utcnow()
+        StorageManager.cleanup_storage(since, self.log_items)
+        if self.incremental:
+            self.lastrun_path.write_text(start.isoformat(), encoding='utf8')
         current_app.logger.debug(f'{self.__class__.__name__} finished')
 
 
+class JobReaper(Stage):  # pylint: disable=too-few-public-methods
+    """reconcile jobs with expired heartbeat"""
+
+    def run(self):
+        """reap jobs"""
+
+        if timeout := current_app.config['SNER_HEARTBEAT_TIMEOUT']:
+            if reaped := JobManager.reap(timeout):
+                current_app.logger.info(f'{self.__class__.__name__} reaped {reaped} jobs')
+
+
+class RateLimitRefill(Stage):  # pylint: disable=too-few-public-methods
+    """activate readynets refilled by scheduler rate-limit engine"""
+
+    def run(self):
+        """refill"""
+
+        if refilled := SchedulerService.ratelimit_refill():
+            current_app.logger.debug(f'{self.__class__.__name__} refilled {refilled} hashvals')
+
+
 class RebuildVersioninfoMap(Schedule):  # pylint: disable=too-few-public-methods
     """recount versioninfo map"""
 
@@ -340,6 +374,16 @@ class RebuildVersioninfoMap(Schedule):  # pylint: disable=too-few-public-methods
         current_app.logger.info(f'{self.__class__.__name__} finished')
 
 
+class OutputStoreGC(Schedule):  # pylint: disable=too-few-public-methods
+    """garbage collect job output store objects"""
+
+    def _run(self):
+        """run"""
+
+        removed = output_store().gc_objects()
+        current_app.logger.info(f'{self.__class__.__name__} removed {removed} objects')
+
+
 class Planner(TerminateContextMixin):
     """planner"""
 
@@ -397,7 +441,8 @@ class Planner(TerminateContextMixin):
             self.config['stage']['storage_rescan']['host_interval'],
             self.stages['service_disco'],
             self.config['stage']['storage_rescan']['service_interval'],
-            sscan_stages
+            sscan_stages,
+            get_nested_key(self.config, 'stage', 'storage_rescan', 'limit')
         )
 
         if standalones := get_nested_key(self.config, 'stage', 'load_standalone', 'queues'):
@@ -405,11 +450,19 @@ class Planner(TerminateContextMixin):
                 queue = Queue.query.filter_by(name=qname).one()
                 self.stages[f'load_standalone-{queue.id}'] = StorageLoader(qname)
 
-        self.stages['storage_cleanup'] = StorageCleanup()
+        self.stages['storage_cleanup'] = StorageCleanup(
+            get_nested_key(self.config, 'stage', 'storage_cleanup', 'incremental') or False,
+            get_nested_key(self.config, 'stage', 'storage_cleanup', 'log_items') is not False
+        )
+        self.stages['job_reaper'] = JobReaper()
+        self.stages['ratelimit_refill'] = RateLimitRefill()
 
         if get_nested_key(self.config, 'stage', 'rebuild_versioninfo_map'):
             self.stages['rebuild_versioninfo_map'] = RebuildVersioninfoMap(self.config['stage']['rebuild_versioninfo_map']['schedule'])
 
+        if get_nested_key(self.config, 'stage', 'output_store_gc'):
+            self.stages['output_store_gc'] = OutputStoreGC(self.config['stage']['output_store_gc']['schedule'])
+
     def terminate(self, signum=None, frame=None):  # pragma: no cover  pylint: disable=unused-argument  ; running over multiprocessing
         """terminate at once"""
 
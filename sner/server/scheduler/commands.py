@@ -5,13 +5,15 @@ scheduler commands
 
 import sys
 from ipaddress import ip_address, summarize_address_range
+from itertools import chain
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
 
-from sner.server.scheduler.core import enumerate_network, QueueManager, SchedulerService
+from sner.server.scheduler.core import enumerate_network, JobManager, QueueManager, SchedulerService
 from sner.server.scheduler.models import Queue
+from sner.server.scheduler.outputstore import output_store
 
 
 @click.group(name='scheduler', help='sner.server scheduler management')
@@ -57,11 +59,11 @@ def queue_enqueue_command(queue_name, targets, **kwargs):
         current_app.logger.error('no such queue')
         sys.exit(1)
 
-    targets = list(targets)
+    # targets are streamed into the queue, input file is not read into memory at once
     if kwargs['file']:
-        targets.extend(kwargs['file'].read().splitlines())
-    if not targets:
-        targets.extend(sys.stdin.readlines())
+        targets = chain(targets, kwargs['file'])
+    elif not targets:
+        targets = sys.stdin
     QueueManager.enqueue(queue, targets)
     sys.exit(0)
 
@@ -96,12 +98,82 @@ def queue_prune_command(queue_name):
     sys.exit(0)
 
 
+@command.command(name='queue-revalidate', help='remove excluded targets from queues validated against previous exclusions')
+@click.argument('queue_names', nargs=-1)
+@click.option('--force', is_flag=True, help='revalidate queues regardless of exclusions version')
+@with_appcontext
+def queue_revalidate_command(queue_names, **kwargs):
+    """remove excluded targets from queues"""
+
+    query = Queue.query
+    if queue_names:
+        query = query.filter(Queue.name.in_(queue_names))
+
+    for queue in query.order_by(Queue.id).all():
+        removed = QueueManager.revalidate(queue, force=kwargs['force'])
+        print(f'{queue.name} {"skipped" if removed is None else f"removed {removed}"}')
+    sys.exit(0)
+
+
+@command.command(name='queue-stats-recount', help='rebuild queue stats counters')
+@with_appcontext
+def queue_stats_recount_command():
+    """rebuild queue stats counters"""
+
+    print(f'queue stats corrected {QueueManager.stats_recount()}')
+    sys.exit(0)
+
+
+@command.command(name='job-reap', help='reconcile jobs with expired heartbeat and reschedule their targets')
+@click.option('--timeout', type=int, help='heartbeat timeout in seconds; defaults to configured heartbeat timeout')
+@with_appcontext
+def job_reap_command(**kwargs):
+    """reconcile jobs with expired heartbeat"""
+
+    if not (timeout := kwargs['timeout'] or current_app.config['SNER_HEARTBEAT_TIMEOUT']):
+        current_app.logger.error('heartbeat timeout not configured')
+        sys.exit(1)
+
+    print(f'jobs reaped {JobManager.reap(timeout)}')
+    sys.exit(0)
+
+
+@command.command(name='output-gc', help='remove output store objects not referenced by any job output')
+@with_appcontext
+def output_gc_command():
+    """garbage collect output store objects"""
+
+    print(f'output objects removed {output_store().gc_objects()}')
+    sys.exit(0)
+
+
+@command.command(name='output-archived', help='list archived job outputs')
+@click.option('--id', 'job_id', help='job id')
+@click.option('--queue', help='queue name')
+@click.option('--date', type=click.DateTime(formats=['%Y-%m-%d']), help='archive date')
+@with_appcontext
+def output_archived_command(**kwargs):
+    """list archived job outputs by job id, queue or date"""
+
+    try:
+        paths = output_store().archived(job_id=kwargs['job_id'], queue_name=kwargs['queue'], date=kwargs['date'] and kwargs['date'].date())
+    except ValueError as exc:
+        current_app.logger.error(exc)
+        sys.exit(1)
+
+    for path in paths:
+        print(path)
+    sys.exit(0)
+
+
 @command.command(name='readynet-recount', help='refresh readynets for current heatmap_hot_level')
+@click.option('--dry', is_flag=True, help='do not update database, only report changes')
 @with_appcontext
-def readynet_recount_command():
+def readynet_recount_command(**kwargs):
     """refresh readynets for current heatmap_hot_level"""
 
-    SchedulerService.readynet_recount()
+    removed, added = SchedulerService.readynet_recount(dry_run=kwargs['dry'])
+    print(f'readynets removed {removed} added {added}')
     sys.exit(0)
 
 
@@ -4,31 +4,36 @@ scheduler shared functions
 """
 
 import json
-import re
-from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
-from datetime import datetime
-from enum import Enum
-from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address
+from collections import Counter, namedtuple
+from csv import writer as csv_writer
+from datetime import datetime, timedelta
+from io import StringIO
+from ipaddress import ip_network
+from itertools import islice
 from pathlib import Path
 from random import random
-from shutil import copy2
+from time import monotonic
 from uuid import uuid4
 
 import yaml
-from flask import current_app
-from sqlalchemy import cast, delete, distinct, func, select
+from flask import current_app, has_app_context
+from sqlalchemy import cast, column, delete, exists, false, func, insert, literal, or_, select, table, text, true, union_all, update, values
 from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY, insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import contains_eager
 
-from sner.agent.modules import SERVICE_TARGET_REGEXP
-from sner.plugin.six_enum_discover.agent import SIXENUM_TARGET_REGEXP
 from sner.server.extensions import db
 from sner.server.parser import REGISTERED_PARSERS
-from sner.server.scheduler.models import Heatmap, Job, Queue, Readynet, Target
+from sner.server.scheduler.exclusion import ExclMatcher
+from sner.server.scheduler.models import Heatmap, Job, Queue, QueueStats, Readynet, Target
+from sner.server.scheduler.outputstore import output_store
+from sner.server.scheduler.ratelimit import HashvalEngine, RATELIMIT_ENGINES
+from sner.server.scheduler.ready import SchedulerReadyListener
+from sner.server.scheduler.stats import QueueStatsMixin
 
 
 SCHEDULER_LOCK_NUMBER = 1
+SCHEDULER_HASHVAL_LOCK_NAMESPACE = 2
 
 
 def enumerate_network(arg):
@@ -52,172 +57,166 @@ def enumerate_network(arg):
     return data
 
 
-def sixenum_target_boundaries(value):
-    """returns tuple(first, last)"""
-
-    if not (mtmp := re.match(SIXENUM_TARGET_REGEXP, value)):
-        raise ValueError('not valid sixenum target')
-
-    addr = mtmp.group('scan6dst')
-
-    if '-' in addr:
-        first, last = addr.split('-')
-        tmp = first.split(':')
-        tmp[-1] = last
-        last = ':'.join(tmp)
-        return first, last
-
-    return addr, addr
-
-
-class ExclFamily(Enum):
-    """exclusion family enum"""
-
-    NETWORK = 'network'
-    REGEX = 'regex'
-
-
-class ExclMatcher():
-    """object matching value againts set of exclusions/rules"""
-
-    MATCHERS = {}
-
-    @staticmethod
-    def register(family):
-        """register matcher class to the excl.family"""
-
-        def register_real(cls):
-            if cls not in ExclMatcher.MATCHERS:
-                ExclMatcher.MATCHERS[family] = cls
-            return cls
-        return register_real
-
-    def __init__(self, config):
-        self.excls = [
-            ExclMatcher.MATCHERS[ExclFamily(family)](value)
-            for family, value in config
-        ]
-
-    def match(self, value):
-        """match value against all exclusions/matchers"""
-
-        for excl in self.excls:
-            if excl.match(value):
-                return True
-        return False
-
-
-class ExclMatcherImplBase(ABC):  # pylint: disable=too-few-public-methods
-    """base interface which must  be implemented by all available matchers"""
+class QueueManager(QueueStatsMixin):
+    """Governs queues, readynets and targets"""
 
-    def __init__(self, match_to):
-        self.match_to = self._initialize(match_to)
+    ENQUEUE_CHUNKSIZE = 100000
 
-    @abstractmethod
-    def _initialize(self, match_to):
-        """initialize matcher impl"""
+    @classmethod
+    def enqueue(cls, queue, targets, skip_queued=False):
+        """
+        enqueue targets to queue
 
-    @abstractmethod
-    def match(self, value):
-        """returns bool if value matches the initialized match_to"""
+        Targets are streamed in chunks via COPY into temporary staging table,
+        scheduler lock is held only while staged targets are moved into the
+        queue and corresponding readynets are derived. Targets matching
+        current exclusions are discarded.
 
-    def __repr__(self):
-        return f'<{self.__class__.__name__} {self.match_to}>'
+        :param targets: iterable of targets, eg. list or opened file
+        :param skip_queued: skip targets already present in queue, also deduplicates input
+        :return: number of enqueued targets
+        :rtype: int
+        """
 
+        conn = db.session.connection()
+        staging = table('target_staging', column('target'), column('hashval'))
+        blacklist = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS'])
 
-@ExclMatcher.register(ExclFamily.NETWORK)
-class NetworkExclMatcher(ExclMatcherImplBase):  # pylint: disable=too-few-public-methods
-    """network matcher"""
+        targets = filter(lambda x: x and not blacklist.match(x), map(lambda x: x.strip(), targets))
+        staged = 0
+        while chunk := list(islice(targets, cls.ENQUEUE_CHUNKSIZE)):
+            if not staged:
+                conn.execute(text('CREATE TEMPORARY TABLE target_staging (target TEXT NOT NULL, hashval TEXT NOT NULL) ON COMMIT DROP'))
 
-    def _initialize(self, match_to):
-        return ip_network(match_to)
+            buf = StringIO()
+            csv_writer(buf).writerows(zip(chunk, SchedulerService.hashvals(chunk)))
+            buf.seek(0)
+            conn.connection.cursor().copy_expert('COPY target_staging (target, hashval) FROM STDIN WITH (FORMAT csv)', buf)
+            staged += len(chunk)
 
-    def _test_addr(self, value):
-        try:
-            return ip_address(value) in self.match_to
-        except ValueError:
-            return False
+        if not staged:
+            return 0
 
-    def match(self, value):
-        # test value as plain address
-        if self._test_addr(value):
-            return True
+        source = select(literal(queue.id), staging.c.target, staging.c.hashval)
+        if skip_queued:
+            source = source.distinct().filter(~exists().where(Target.queue_id == queue.id, Target.target == staging.c.target))
 
-        # test value as service target
-        if mtmp := re.match(SERVICE_TARGET_REGEXP, value):
-            return self._test_addr(mtmp.group('host').replace('[', '').replace(']', ''))
+        SchedulerService.get_lock()
 
-        # test value as sixenum target
-        if mtmp := re.match(SIXENUM_TARGET_REGEXP, value):
-            first, last = map(ip_address, sixenum_target_boundaries(value))
+        # rate-limit state must be read after the lock is acquired
+        readynets = select(literal(queue.id), staging.c.hashval).distinct()
+        if (capacity := SchedulerService.ratelimit().capacity(staging.c.hashval)) is not None:
+            readynets = readynets.filter(capacity > 0)
+
+        # targets of empty queue are valid for any exclusions version
+        if not conn.execute(select(exists().where(Target.queue_id == queue.id))).scalar():
+            queue.excl_version = blacklist.version
+        enqueued = conn.execute(insert(Target).from_select(['queue_id', 'target', 'hashval'], source)).rowcount
+        added = conn.execute(
+            pg_insert(Readynet)
+            .from_select(['queue_id', 'hashval'], readynets)
+            .on_conflict_do_nothing(constraint='readynet_pkey')
+        ).rowcount
+        cls.stats_account('nr_targets', {queue.id: enqueued})
+        cls.stats_account('nr_readynets', {queue.id: added})
+        db.session.commit()
+        return enqueued
 
-            # first or last enum addr is in excluded range
-            if self._test_addr(first) or self._test_addr(last):
-                return True
+    @classmethod
+    def flush(cls, queue):
+        """queue flush; flush all targets from queue"""
 
-            # excluded range could be smaller than enum, check if excluded range does not belong into enum itself
-            if (
-                (first.version == self.match_to.version)
-                and ((first <= self.match_to.network_address <= last) or (first <= self.match_to.broadcast_address <= last))
-            ):
-                return True
+        SchedulerService.get_lock()
 
-        return False
+        cls.stats_account('nr_targets', {queue.id: -Target.query.filter(Target.queue_id == queue.id).delete()})
+        cls.stats_account('nr_readynets', {queue.id: -Readynet.query.filter(Readynet.queue_id == queue.id).delete()})
+        queue.excl_version = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS']).version
+        db.session.commit()
 
+    @classmethod
+    def revalidate(cls, queue, force=False):
+        """
+        remove targets matching current exclusions from queue
 
-@ExclMatcher.register(ExclFamily.REGEX)
-class RegexExclMatcher(ExclMatcherImplBase):  # pylint: disable=too-few-public-methods
-    """regex matcher"""
+        queue is skipped if it was already validated against current exclusions version.
 
-    def _initialize(self, match_to):
-        return re.compile(match_to)
+        :param force: revalidate queue regardless of exclusions version
+        :return: number of removed targets or None if queue was skipped
+        :rtype: int
+        """
 
-    def match(self, value):
-        return bool(self.match_to.search(value))
+        blacklist = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS'])
+        if (queue.excl_version == blacklist.version) and (not force):
+            return None
 
+        SchedulerService.get_lock()
+        conn = db.session.connection()
 
-class QueueManager:
-    """Governs queues, readynets and targets"""
+        excluded = [
+            row.id
+            for row in conn.execution_options(stream_results=True).execute(
+                select(Target.id, Target.target).filter(Target.queue_id == queue.id)
+            )
+            if blacklist.match(row.target)
+        ]
+        for idx in range(0, len(excluded), cls.ENQUEUE_CHUNKSIZE):
+            conn.execute(delete(Target).filter(Target.id.in_(excluded[idx:idx+cls.ENQUEUE_CHUNKSIZE])))
+        removed = conn.execute(
+            delete(Readynet)
+            .filter(
+                Readynet.queue_id == queue.id,
+                ~exists().where(Target.queue_id == queue.id, Target.hashval == Readynet.hashval)
+            )
+        ).rowcount
+        cls.stats_account('nr_targets', {queue.id: -len(excluded)})
+        cls.stats_account('nr_readynets', {queue.id: -removed})
+        queue.excl_version = blacklist.version
+        db.session.commit()
+        return len(excluded)
 
     @staticmethod
-    def enqueue(queue, targets):
-        """enqueue targets to queue"""
+    def stats_recount():
+        """
+        rebuild queue stats from targets, readynets and jobs
 
-        enqueued = []
-        enqueued_hashvals = set()
+        :return: number of corrected queue stats
+        :rtype: int
+        """
 
-        for target in filter(None, map(lambda x: x.strip(), targets)):
-            thashval = SchedulerService.hashval(target)
-            enqueued.append({'queue_id': queue.id, 'target': target, 'hashval': thashval})
-            enqueued_hashvals.add(thashval)
+        SchedulerService.get_lock()
+        conn = db.session.connection()
 
-        if enqueued:
-            SchedulerService.get_lock()
+        def count_by_queue(model, *filters):
+            return select(func.count()).select_from(model).filter(model.queue_id == Queue.id, *filters).scalar_subquery()
+
+        actual = select(
+            Queue.id.label('queue_id'),
+            count_by_queue(Target).label('nr_targets'),
+            count_by_queue(Readynet).label('nr_readynets'),
+            count_by_queue(Job, Job.retval == None).label('nr_running')  # noqa: E711  pylint: disable=singleton-comparison
+        ).subquery()
+        stale = (
+            select(actual)
+            .outerjoin(QueueStats, QueueStats.queue_id == actual.c.queue_id)
+            .filter(or_(
+                QueueStats.queue_id == None,  # noqa: E711  pylint: disable=singleton-comparison
+                QueueStats.nr_targets != actual.c.nr_targets,
+                QueueStats.nr_readynets != actual.c.nr_readynets,
+                QueueStats.nr_running != actual.c.nr_running
+            ))
+        )
 
-            conn = db.session.connection()
-            conn.execute(pg_insert(Target), enqueued)
-            hot_hashvals = set(SchedulerService.grep_hot_hashvals(enqueued_hashvals))
-            for thashval in (enqueued_hashvals - hot_hashvals):
-                conn.execute(
-                    pg_insert(Readynet)
-                    .values(queue_id=queue.id, hashval=thashval)
-                    .on_conflict_do_nothing(constraint='readynet_pkey')
+        corrected = 0
+        if rows := [row._asdict() for row in conn.execute(stale).all()]:
+            stmt = pg_insert(QueueStats).values(rows)
+            corrected = conn.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[QueueStats.queue_id],
+                    set_={name: getattr(stmt.excluded, name) for name in ['nr_targets', 'nr_readynets', 'nr_running']}
                 )
-            db.session.commit()
-
-            SchedulerService.release_lock()
-
-    @staticmethod
-    def flush(queue):
-        """queue flush; flush all targets from queue"""
-
-        SchedulerService.get_lock()
-
-        Target.query.filter(Target.queue_id == queue.id).delete()
-        Readynet.query.filter(Readynet.queue_id == queue.id).delete()
+            ).rowcount
         db.session.commit()
-
-        SchedulerService.release_lock()
+        return corrected
 
     @staticmethod
     def prune(queue):
@@ -233,6 +232,7 @@ class QueueManager:
         for job in queue.jobs:
             JobManager.delete(job)
 
+        output_store().cleanup_queue(queue)
         try:
             qpath = Path(queue.data_abspath)
             if qpath.exists():
@@ -243,17 +243,17 @@ class QueueManager:
         SchedulerService.get_lock()
         db.session.delete(queue)
         db.session.commit()
-        SchedulerService.release_lock()
 
 
 class JobManager:
     """job governance"""
 
     @staticmethod
-    def create(queue, assigned_targets):
+    def create(queue, assigned_targets, heartbeat=False):
         """
         create job for queue with targets
 
+        :param heartbeat: agent sends heartbeats, job expires by reap if the first heartbeat does not arrive
         :return: agent assignment data
         :rtype: dict
         """
@@ -263,20 +263,37 @@ class JobManager:
             'config': {} if queue.config is None else yaml.safe_load(queue.config),
             'targets': assigned_targets
         }
-        db.session.add(Job(id=assignment['id'], queue=queue, assignment=json.dumps(assignment)))
+        db.session.add(Job(
+            id=assignment['id'],
+            queue=queue,
+            assignment=json.dumps(assignment),
+            time_heartbeat=datetime.utcnow() if heartbeat else None
+        ))
+        QueueManager.stats_account('nr_running', {queue.id: 1})
         db.session.commit()
         return assignment
 
     @staticmethod
-    def finish(job, retval, output):
-        """writeback job results"""
+    def finish(job, retval, output, runtime=None):
+        """
+        writeback job results, does not commit
 
-        opath = Path(job.output_abspath)
-        opath.parent.mkdir(parents=True, exist_ok=True)
-        opath.write_bytes(output)
+        :param output: output data or path to already received output file which is moved in place
+        :type output: bytes or pathlib.Path
+        :param runtime: job execution time reported by agent, defaults to time since assignment
+        :type runtime: float
+        """
+
+        output_store().put(job, output)
+        time_end = datetime.utcnow()
+        if job.retval is None:
+            QueueManager.stats_account('nr_running', {job.queue_id: -1})
+            if runtime is None and job.time_start:
+                runtime = (time_end - job.time_start).total_seconds()
+            if (retval == 0) and (runtime is not None) and (targets := json.loads(job.assignment)['targets']):
+                QueueManager.stats_account_runtime(job.queue_id, runtime / len(targets))
         job.retval = retval
-        job.time_end = datetime.utcnow()
-        db.session.commit()
+        job.time_end = time_end
 
     @staticmethod
     def reconcile(job):
@@ -292,10 +309,10 @@ class JobManager:
         SchedulerService.get_lock()
 
         job.retval = -1
-        for target in json.loads(job.assignment)['targets']:
-            SchedulerService.heatmap_pop(SchedulerService.hashval(target))
-
-        SchedulerService.release_lock()
+        QueueManager.stats_account('nr_running', {job.queue_id: -1})
+        if hashval_counts := Counter(SchedulerService.hashvals(json.loads(job.assignment)['targets'])):
+            SchedulerService.ratelimit().release(hashval_counts)
+        db.session.commit()
 
     @staticmethod
     def repeat(job):
@@ -303,6 +320,54 @@ class JobManager:
 
         QueueManager.enqueue(job.queue, json.loads(job.assignment)['targets'])
 
+    @staticmethod
+    def heartbeat(job_ids):
+        """
+        record heartbeat for running jobs
+
+        :return: ids of jobs still running
+        :rtype: list
+        """
+
+        running = db.session.execute(
+            update(Job)
+            .filter(Job.id.in_(job_ids), Job.retval == None)  # noqa: E711  pylint: disable=singleton-comparison
+            .values(time_heartbeat=datetime.utcnow())
+            .returning(Job.id)
+        ).scalars().all()
+        db.session.commit()
+        return running
+
+    @classmethod
+    def reap(cls, timeout):
+        """
+        reconcile running jobs with expired heartbeat and reschedule their targets.
+        jobs of agents supporting heartbeats are created with initial heartbeat, so missing first heartbeat expires as well.
+        jobs without any heartbeat (agents without heartbeat support) must be reconciled manually.
+
+        :return: number of reaped jobs
+        :rtype: int
+        """
+
+        horizont = datetime.utcnow() - timedelta(seconds=timeout)
+        expired = [Job.retval == None, Job.time_heartbeat < horizont]  # noqa: E711  pylint: disable=singleton-comparison
+
+        reaped = 0
+        for job_id in db.session.execute(select(Job.id).filter(*expired)).scalars().all():
+            # job might have been finished or seen alive meanwhile
+            SchedulerService.get_lock()
+            job = Job.query.filter(Job.id == job_id, *expired).with_for_update().one_or_none()
+            if not job:
+                db.session.commit()
+                continue
+
+            current_app.logger.warning(f'reaping job {job.id} ({job.queue.name}), last heartbeat {job.time_heartbeat}')
+            cls.reconcile(job)
+            cls.repeat(job)
+            reaped += 1
+
+        return reaped
+
     @staticmethod
     def parse(job):
         """parse job and return data"""
@@ -316,9 +381,7 @@ class JobManager:
         """job archive"""
 
         current_app.logger.info(f'archive_job {job.id} ({job.queue.name})')
-        archive_dir = Path(current_app.config['SNER_VAR']) / 'planner_archive'
-        archive_dir.mkdir(parents=True, exist_ok=True)
-        copy2(job.output_abspath, archive_dir)
+        output_store().archive(job)
 
     @staticmethod
     def delete(job):
@@ -329,9 +392,7 @@ class JobManager:
             current_app.logger.error('cannot delete running job %s', job.id)
             raise RuntimeError('cannot delete running job')
 
-        opath = Path(job.output_abspath)
-        if opath.exists():
-            opath.unlink()
+        output_store().remove(job)
         db.session.delete(job)
         db.session.commit()
 
@@ -361,14 +422,24 @@ class SchedulerService:
     TIMEOUT_JOB_ASSIGN = 3
     TIMEOUT_JOB_OUTPUT = 30
     HEATMAP_GC_PROBABILITY = 0.1
+    HASHVAL_LOCK_ATTEMPTS = 5
 
     @staticmethod
-    def get_lock(timeout=0):
-        """wait for database lock or raise exception"""
+    def get_lock(timeout=0, shared=False):
+        """
+        wait for database lock or raise exception
+
+        shared lock is used by job assignment and output processing which are synchronized
+        on per-hashval level, exclusive lock is used by bulk queue and heatmap maintenance.
+        lock is transaction-level and it's released by the commit or rollback, session-level lock
+        could not be reliably released by the same pooled connection after the commit.
+        """
 
+        lockfunc = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
         try:
+            # timeout applies only to the scheduler lock, other waits within the transaction must not inherit it
             db.session.execute(
-                'SET LOCAL lock_timeout=:timeout; SELECT pg_advisory_lock(:locknum);',
+                f'SET LOCAL lock_timeout=:timeout; SELECT {lockfunc}(:locknum); SET LOCAL lock_timeout TO DEFAULT;',
                 {'timeout': timeout*100, 'locknum': SCHEDULER_LOCK_NUMBER}
             )
         except SQLAlchemyError:
@@ -377,73 +448,150 @@ class SchedulerService:
             raise SchedulerServiceBusyException() from None
 
     @staticmethod
-    def release_lock():
-        """release scheduling lock"""
+    def hashval_lock_key(hashval_column):
+        """hashval advisory lock key expression"""
+
+        return func.hashtext(hashval_column)
 
-        db.session.execute('SELECT pg_advisory_unlock(:locknum);', {'locknum': SCHEDULER_LOCK_NUMBER})
+    @classmethod
+    def hashval_try_lock(cls, hashval_column):
+        """hashval transaction-level advisory try-lock expression"""
+
+        return func.pg_try_advisory_xact_lock(SCHEDULER_HASHVAL_LOCK_NAMESPACE, cls.hashval_lock_key(hashval_column))
+
+    @classmethod
+    def lock_hashvals(cls, hashvals):
+        """
+        wait for transaction-level locks of hashvals, locks are taken in sorted order to prevent deadlocks
+        between concurrent job outputs, assignments only try-lock hashvals and never wait for them
+        """
+
+        hashvals = values(column('hashval', db.String), name='hashvals').data([(x,) for x in set(hashvals)])
+        keys = select(cls.hashval_lock_key(hashvals.c.hashval).label('key')).distinct().order_by('key').subquery()
+        db.session.connection().execute(select(func.pg_advisory_xact_lock(SCHEDULER_HASHVAL_LOCK_NAMESPACE, keys.c.key)))
+
+    @staticmethod
+    def hashval_engine():
+        """get hashval engine for current configuration"""
+
+        if not has_app_context():
+            return HashvalEngine.get()
+        return HashvalEngine.get(current_app.config['SNER_HEATMAP_PREFIXLEN_IPV4'], current_app.config['SNER_HEATMAP_PREFIXLEN_IPV6'])
 
     @staticmethod
     def hashval(value):
         """computes rate-limit heatmap hash value"""
 
-        if mtmp := re.match(SERVICE_TARGET_REGEXP, value):
-            value = mtmp.group('host')
-            if (value[0] == '[') and (value[-1] == ']'):
-                value = value[1:-1]
+        return SchedulerService.hashval_engine().hashval(value)
 
-        if mtmp := re.match(SIXENUM_TARGET_REGEXP, value):
-            value = mtmp.group('scan6dst').split('-')[0]
+    @staticmethod
+    def hashvals(values_list):
+        """computes rate-limit heatmap hash values for list of values"""
 
-        try:
-            addr = ip_address(value)
-            if isinstance(addr, IPv4Address):
-                return str(ip_network(f'{ip_address(value)}/24', strict=False))
-            if isinstance(addr, IPv6Address):
-                return str(ip_network(f'{ip_address(value)}/48', strict=False))
-        except ValueError:
-            pass
+        return SchedulerService.hashval_engine().hashvals(values_list)
 
-        return value
+    @staticmethod
+    def ratelimit():
+        """get rate-limit engine for current configuration"""
+
+        return RATELIMIT_ENGINES[current_app.config['SNER_RATELIMIT_ENGINE']].from_config(SchedulerService, current_app.config)
 
     @staticmethod
     def heatmap_put(hashval):
         """account value (increment counter) in heatmap and update readynets"""
 
+        heat_count = SchedulerService.heatmap_put_many({hashval: 1})[hashval]
+        db.session.commit()
+        return heat_count
+
+    @staticmethod
+    def heatmap_put_many(hashval_counts):
+        """
+        account values (increment counters) in heatmap and update readynets in bulk, does not commit
+
+        :param hashval_counts: number of accounted targets per hashval
+        :type hashval_counts: dict
+        :return: updated heat counts per hashval
+        :rtype: dict
+        """
+
         conn = db.session.connection()
-        heat_count = conn.execute(
-            pg_insert(Heatmap)
-            .values(hashval=hashval, count=1)
-            .on_conflict_do_update(constraint='heatmap_pkey', set_=dict(count=Heatmap.count+1))
-            .returning(Heatmap.count)
-        ).scalar()
+        stmt = pg_insert(Heatmap).values([{'hashval': key, 'count': val} for key, val in hashval_counts.items()])
+        heat_counts = dict(conn.execute(
+            stmt
+            .on_conflict_do_update(constraint='heatmap_pkey', set_=dict(count=Heatmap.count+stmt.excluded.count))
+            .returning(Heatmap.hashval, Heatmap.count)
+        ).all())
 
-        if current_app.config['SNER_HEATMAP_HOT_LEVEL'] and (heat_count >= current_app.config['SNER_HEATMAP_HOT_LEVEL']):
-            conn.execute(delete(Readynet).filter(Readynet.hashval == hashval))
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        if hot_level and (hot_hashvals := [key for key, val in heat_counts.items() if val >= hot_level]):
+            SchedulerService.readynets_deactivate(hot_hashvals)
 
-        db.session.commit()
-        return heat_count
+        return heat_counts
 
     @classmethod
-    def heatmap_pop(cls, hashval):
-        """account value (decrement counter) in heatmap and update readynets"""
+    def heatmap_pop_many(cls, hashval_counts):
+        """
+        account values (decrement counters) in heatmap and update readynets in bulk, does not commit
+
+        hashvals are locked for the rest of the transaction in order to synchronize with concurrent assignments.
+
+        :param hashval_counts: number of released targets per hashval
+        :type hashval_counts: dict
+        :return: updated heat counts per hashval
+        :rtype: dict
+        """
 
+        cls.lock_hashvals(hashval_counts)
         conn = db.session.connection()
-        heat_count = conn.execute(
-            pg_insert(Heatmap)
-            .values(hashval=hashval, count=1)
-            .on_conflict_do_update(constraint='heatmap_pkey', set_=dict(count=Heatmap.count-1))
-            .returning(Heatmap.count)
-        ).scalar()
+        decrements = (
+            values(column('hashval', db.String), column('count', db.Integer), name='decrements')
+            .data(list(hashval_counts.items()))
+        )
+        updated = conn.execute(
+            update(Heatmap)
+            .where(Heatmap.hashval == decrements.c.hashval)
+            .values(count=Heatmap.count-decrements.c.count)
+            .returning(Heatmap.hashval, Heatmap.count, decrements.c.count.label('decrement'))
+        ).all()
 
         if random() < cls.HEATMAP_GC_PROBABILITY:
-            conn.execute(delete(Heatmap).filter(Heatmap.count == 0))
+            # skip rows being updated by concurrent transactions
+            conn.execute(
+                delete(Heatmap)
+                .filter(Heatmap.hashval.in_(select(Heatmap.hashval).filter(Heatmap.count == 0).with_for_update(skip_locked=True)))
+            )
 
-        if current_app.config['SNER_HEATMAP_HOT_LEVEL'] and (heat_count+1 == current_app.config['SNER_HEATMAP_HOT_LEVEL']):
-            for queue_id in db.session.execute(select(func.distinct(Target.queue_id)).filter(Target.hashval == hashval)).scalars().all():
-                conn.execute(pg_insert(Readynet).values(queue_id=queue_id, hashval=hashval))
+        # reactivate readynets for all queues if hashval became cool
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        if hot_level and (cool_hashvals := [row.hashval for row in updated if row.count < hot_level <= row.count+row.decrement]):
+            cls.readynets_activate(cool_hashvals)
 
-        db.session.commit()
-        return heat_count
+        return {row.hashval: row.count for row in updated}
+
+    @staticmethod
+    def readynets_deactivate(hashvals):
+        """remove readynets of exhausted hashvals for all queues, does not commit"""
+
+        removed = Counter(db.session.connection().execute(
+            delete(Readynet).filter(Readynet.hashval.in_(hashvals)).returning(Readynet.queue_id)
+        ).scalars())
+        QueueManager.stats_account('nr_readynets', {queue_id: -cnt for queue_id, cnt in removed.items()})
+
+    @classmethod
+    def readynets_activate(cls, hashvals):
+        """add readynets of hashvals for all queues holding their targets if rate-limit engine allows, does not commit"""
+
+        query = select(Target.queue_id, Target.hashval).distinct().filter(Target.hashval.in_(hashvals))
+        if (capacity := cls.ratelimit().capacity(Target.hashval)) is not None:
+            query = query.filter(capacity > 0)
+        added = Counter(db.session.connection().execute(
+            pg_insert(Readynet)
+            .from_select(['queue_id', 'hashval'], query)
+            .on_conflict_do_nothing(constraint='readynet_pkey')
+            .returning(Readynet.queue_id)
+        ).scalars())
+        QueueManager.stats_account('nr_readynets', added)
 
     @staticmethod
     def grep_hot_hashvals(hashvals):
@@ -475,10 +623,10 @@ class SchedulerService:
         :rtype: sner.server.scheduler.model.Queue
         """
 
-        query = select(Queue).filter(
+        query = select(Queue).join(QueueStats).options(contains_eager(Queue.stats)).filter(
             Queue.active,
             Queue.reqs.contained_by(cast(client_caps, pg_ARRAY(db.String))),
-            Queue.id.in_(select(distinct(Readynet.queue_id)))
+            QueueStats.nr_readynets > 0
         )
         if queue_name:
             query = query.filter(Queue.name == queue_name)
@@ -486,131 +634,319 @@ class SchedulerService:
         return db.session.execute(query).scalars().first()
 
     @staticmethod
-    def _pop_random_target(queue):
+    def _random_window(columns, rand_column, filters, count):
         """
-        pop random target from queue and update readynet info
+        select up to count rows following random pivot in order of random sort key, wrapping around the key space
 
-        :return: random target properties as tuple
-        :rtype: sner.server.scheduler.core.RandomTarget
+        * both parts of the window are resolved by index range scans instead of sorting the whole candidate set
+        * outer query must order rows by (wrap, rand) and apply the final limit
+        * rows are picked uniformly as long as sort keys are independent uniform values
+
+        :rtype: sqlalchemy.sql.expression.CompoundSelect
+        """
+
+        pivot = random()
+        return union_all(*[
+            select(*columns, literal(wrap).label('wrap'), rand_column.label('rand'))
+            .filter(*filters, condition)
+            .order_by(rand_column)
+            .limit(count)
+            for wrap, condition in enumerate([rand_column >= pivot, rand_column < pivot])
+        ])
+
+    @classmethod
+    def _lock_random_readynets(cls, queue, count):
+        """
+        select up to count random readynets for queue and try-lock their hashvals
+
+        :return: locked hashvals
+        :rtype: list
+        """
+
+        tried, hashvals = [], []
+        for _ in range(cls.HASHVAL_LOCK_ATTEMPTS):
+            window = cls._random_window(
+                [Readynet.hashval],
+                Readynet.rand,
+                [Readynet.queue_id == queue.id, Readynet.hashval.not_in(tried)],
+                count
+            ).subquery()
+            candidates = select(window.c.hashval).order_by(window.c.wrap, window.c.rand).limit(count).subquery()
+            rows = db.session.connection().execute(
+                select(candidates.c.hashval, cls.hashval_try_lock(candidates.c.hashval).label('locked'))
+            ).all()
+            hashvals = [row.hashval for row in rows if row.locked]
+            if hashvals or (len(rows) < count):
+                break
+            tried += [row.hashval for row in rows]
+        return hashvals
+
+    @classmethod
+    def _pop_random_targets(cls, queue, count):
+        """
+        pop up to count random targets from queue and update readynet info
+
+        * select up to count random readynets for queue and try-lock their hashvals, readynets locked by concurrent
+          transactions are skipped, acquired hashval locks are held until the end of the transaction
+        * if all selected readynets are locked, other readynets are tried (up to HASHVAL_LOCK_ATTEMPTS selections)
+        * random selections are index range scans over precomputed random sort keys
+        * compute capacity of locked readynets given by current rate-limit engine state
+        * select random targets within locked readynets, at most capacity targets per readynet
+        * targets are taken round-robin over selected readynets in order to spread the load
+        * cleanup readynets if queue does not hold any target in same readynet, reshuffle sort keys of the rest
+
+        :return: list of random target properties as tuple
+        :rtype: list of sner.server.scheduler.core.RandomTarget
         """
 
         conn = db.session.connection()
 
-        readynet_hashval = conn.execute(
-            select(Readynet.hashval).filter(Readynet.queue_id == queue.id).order_by(func.random()).limit(1)
-        ).scalar()
-        if not readynet_hashval:
-            return None
+        if not (hashvals := cls._lock_random_readynets(queue, count)):
+            return []
 
-        target_id, target = conn.execute(
-            select(Target.id, Target.target)
-            .filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval)
-            .order_by(func.random())
-            .limit(1)
-        ).first()
+        # rate-limit state must be read by statement started after hashvals has been locked
+        if (capacity := cls.ratelimit().capacity(Readynet.hashval)) is None:
+            capacity = literal(count)
+        readynets = (
+            select(Readynet.hashval, func.least(capacity, count).label('capacity'))
+            .filter(Readynet.queue_id == queue.id, Readynet.hashval.in_(hashvals), capacity > 0)
+            .subquery()
+        )
+        targets = cls._random_window(
+            [Target.id],
+            Target.rand,
+            [Target.queue_id == queue.id, Target.hashval == readynets.c.hashval],
+            readynets.c.capacity
+        ).lateral()
+        ranked = (
+            select(
+                targets.c.id,
+                readynets.c.capacity,
+                func.row_number().over(partition_by=readynets.c.hashval, order_by=(targets.c.wrap, targets.c.rand)).label('rank')
+            )
+            .select_from(readynets.join(targets, true()))
+            .subquery()
+        )
+        picked = (
+            select(ranked.c.id)
+            .filter(ranked.c.rank <= ranked.c.capacity)
+            .order_by(ranked.c.rank, func.random())
+            .limit(count)
+        )
 
-        conn.execute(delete(Target).filter(Target.id == target_id))
-        # prune readynet if no targets left for current queue
-        conn.execute(
+        rtargets = [
+            RandomTarget(*row)
+            for row in conn.execute(
+                delete(Target)
+                .filter(Target.id.in_(picked))
+                .returning(Target.id, Target.target, Target.hashval)
+            ).all()
+        ]
+
+        # prune readynets if no targets left for current queue
+        pruned = conn.execute(
             delete(Readynet)
             .filter(
                 Readynet.queue_id == queue.id,
-                Readynet.hashval == readynet_hashval,
-                select(func.count(Target.id)).filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval).scalar_subquery() == 0
+                Readynet.hashval.in_(hashvals),
+                ~exists().where(Target.queue_id == queue.id, Target.hashval == Readynet.hashval)
             )
+        ).rowcount
+        QueueManager.stats_account('nr_targets', {queue.id: -len(rtargets)})
+        QueueManager.stats_account('nr_readynets', {queue.id: -pruned})
+        # reshuffle picked readynets, rows picked repeatedly by the same sort key would be biased by key gaps
+        conn.execute(
+            update(Readynet)
+            .filter(Readynet.queue_id == queue.id, Readynet.hashval.in_(hashvals))
+            .values(rand=func.random())
         )
 
-        db.session.commit()
-        return RandomTarget(target_id, target, readynet_hashval)
+        return rtargets
 
     @classmethod
-    def job_assign(cls, queue_name, client_caps):
+    def job_assign(cls, queue_name, client_caps, heartbeat=False):
         """
         assign job for agent
 
+        * refill rate-limit engine, readynets of hashvals which became available over time are activated
         * select suitable queue
-        * pop random target
-            * select random readynet for queue (readynets reflects current rate-limit heatmap state)
-            * pop random target within selected readynet
-            * cleanup readynet if queue does not hold any target in same readynet
-        * update rate-limit heatmap
-            * deactivate readynet for all queues if it becomes hot
+        * pop random targets in batch
+            * select random readynets for queue (readynets reflects current rate-limit engine state)
+            * pop random targets within selected readynets up to their rate-limit capacity
+            * cleanup readynets if queue does not hold any target in same readynet
+        * update rate-limit engine state in bulk
+            * deactivate readynet for all queues if it becomes exhausted
+        * repeat until group_size is filled up (excluded targets are discarded) or queue is exhausted
+            * group_size is adapted to observed job runtime if queue group_runtime is configured
+            * targets are matched against exclusions only if queue was not validated against current exclusions version
+        * whole assignment is commited in single transaction
+        * concurrent assignments are synchronized only by hashval locks acquired during target selection
         """
 
-        cls.get_lock(cls.TIMEOUT_JOB_ASSIGN)
+        ratelimit = cls.ratelimit()
+        cls.get_lock(cls.TIMEOUT_JOB_ASSIGN, shared=True)
+        if ratelimit.refill():
+            # refilled readynets must be accounted in queue stats before queue selection
+            db.session.commit()
+            cls.get_lock(cls.TIMEOUT_JOB_ASSIGN, shared=True)
 
         assignment = {}  # nowork
         assigned_targets = []
-        blacklist = ExclMatcher(current_app.config['SNER_EXCLUSIONS'])
+        blacklist = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS'])
 
         queue = cls._get_assignment_queue(queue_name, client_caps)
         if not queue:
-            SchedulerService.release_lock()
+            db.session.commit()
             return assignment
 
-        while len(assigned_targets) < queue.group_size:
-            rtarget = cls._pop_random_target(queue)
-            if not rtarget:
+        validated = queue.excl_version == blacklist.version
+        group_size = queue.group_size_effective
+        while len(assigned_targets) < group_size:
+            rtargets = cls._pop_random_targets(queue, group_size - len(assigned_targets))
+            if not rtargets:
                 break
-            if blacklist.match(rtarget.target):
-                continue
-            assigned_targets.append(rtarget.target)
-            cls.heatmap_put(rtarget.hashval)
+
+            accounted_hashvals = Counter()
+            for rtarget in rtargets:
+                if (not validated) and blacklist.match(rtarget.target):
+                    continue
+                assigned_targets.append(rtarget.target)
+                accounted_hashvals[rtarget.hashval] += 1
+
+            if accounted_hashvals:
+                ratelimit.consume(accounted_hashvals)
 
         if assigned_targets:
-            assignment = JobManager.create(queue, assigned_targets)
+            assignment = JobManager.create(queue, assigned_targets, heartbeat)
+        else:
+            db.session.commit()
 
-        cls.release_lock()
         return assignment
 
     @classmethod
-    def job_output(cls, job, retval, output):
+    def job_assign_wait(cls, queue_name, client_caps, timeout, heartbeat=False):
+        """
+        assign job for agent, long-poll variant
+
+        * if there's no work available, wait for scheduler ready notification (targets enqueued or readynets
+          reactivated by heatmap cool-down) and retry the assignment until timeout expires
+        * wait is cut short when rate-limit engine refills any hashval over time
+        * listener generation is taken before the first attempt in order not to miss notifications
+        * if maximum number of concurrent waiters is reached, single assignment attempt is made without waiting
+        """
+
+        listener = SchedulerReadyListener.get()
+        with listener.waiter() as waiting:
+            if not waiting:
+                return cls.job_assign(queue_name, client_caps, heartbeat)
+
+            deadline = monotonic() + timeout
+            generation = listener.generation
+            while not (assignment := cls.job_assign(queue_name, client_caps, heartbeat)):
+                if (remaining := deadline - monotonic()) <= 0:
+                    break
+                if (refill_delay := cls.ratelimit().refill_delay()) is not None:
+                    remaining = min(remaining, refill_delay)
+                # do not hold database connection while waiting
+                db.session.commit()
+                generation = listener.wait(generation, remaining)
+
+        return assignment
+
+    @classmethod
+    def job_output(cls, job, retval, output, runtime=None):
         """
         receive output from assigned job
 
-        * for each target update rate-limit heatmap
-            * if readynet of the target becomes cool activate it for all queues
+        * aggregate job targets to per-hashval counts and update rate-limit engine state in bulk
+            * if readynet of the target becomes available activate it for all queues
+        * whole output is commited in single transaction
+        * concurrent outputs and assignments are synchronized by hashval locks
+        * job row is locked, output for job already finished or reaped is discarded
+
+        :return: False if output was discarded
+        :rtype: bool
         """
 
-        cls.get_lock(cls.TIMEOUT_JOB_OUTPUT)
+        cls.get_lock(cls.TIMEOUT_JOB_OUTPUT, shared=True)
 
-        JobManager.finish(job, retval, output)
-        for target in json.loads(job.assignment)['targets']:
-            cls.heatmap_pop(cls.hashval(target))
+        db.session.refresh(job, with_for_update=True)
+        if job.retval is not None:
+            db.session.commit()
+            return False
 
-        cls.release_lock()
+        JobManager.finish(job, retval, output, runtime)
+        if hashval_counts := Counter(cls.hashvals(json.loads(job.assignment)['targets'])):
+            cls.ratelimit().release(hashval_counts)
+        db.session.commit()
+        return True
 
     @classmethod
-    def readynet_recount(cls):
+    def readynet_recount(cls, dry_run=False):
         """
-        rescan targets and update readynets table for new heatmap hot level
+        rescan targets and update readynets table for new heatmap hot level or rate-limit engine
+
+        readynets are rebuilt server-side from targets filtered by rate-limit engine capacity,
+        stale readynets (exhausted or without any target) are removed, missing ones are added.
+
+        :param dry_run: only count the changes, do not update the readynets
+        :return: number of removed and added readynets
+        :rtype: tuple
         """
 
         cls.get_lock()
         conn = db.session.connection()
+        ratelimit = cls.ratelimit()
 
-        if current_app.config['SNER_HEATMAP_HOT_LEVEL']:
-            hot_hashvals = set(conn.execute(
-                select(Heatmap.hashval).filter(Heatmap.count >= current_app.config['SNER_HEATMAP_HOT_LEVEL'])
-            ).scalars().all())
+        def is_hot(hashval_column):
+            if (capacity := ratelimit.capacity(hashval_column)) is None:
+                return false()
+            return capacity <= 0
 
-            # all heatmap hashvals over limit remove from readynet
-            conn.execute(delete(Readynet).filter(Readynet.hashval.in_(hot_hashvals)))
+        stale = or_(
+            is_hot(Readynet.hashval),
+            ~exists().where(Target.queue_id == Readynet.queue_id, Target.hashval == Readynet.hashval)
+        )
+        missing = (
+            select(Target.queue_id, Target.hashval)
+            .distinct()
+            .filter(
+                ~is_hot(Target.hashval),
+                ~exists().where(Readynet.queue_id == Target.queue_id, Readynet.hashval == Target.hashval)
+            )
+        )
+
+        if dry_run:
+            removed = conn.execute(select(func.count()).select_from(Readynet).filter(stale)).scalar()
+            added = conn.execute(select(func.count()).select_from(missing.subquery())).scalar()
         else:
-            hot_hashvals = set()
-
-        # for all target hashvals except over limit insert as readynet for all queues
-        all_hashvals = set(conn.execute(select(func.distinct(Target.hashval))).scalars().all())
-        for thashval in (all_hashvals - hot_hashvals):
-            for queue_id in conn.execute(select(func.distinct(Target.queue_id)).filter(Target.hashval == thashval)).scalars().all():
-                conn.execute(
-                    pg_insert(Readynet)
-                    .values(queue_id=queue_id, hashval=thashval)
-                    .on_conflict_do_nothing(constraint='readynet_pkey')
-                )
+            removed_queues = Counter(conn.execute(delete(Readynet).filter(stale).returning(Readynet.queue_id)).scalars())
+            added_queues = Counter(conn.execute(
+                pg_insert(Readynet)
+                .from_select(['queue_id', 'hashval'], missing)
+                .on_conflict_do_nothing(constraint='readynet_pkey')
+                .returning(Readynet.queue_id)
+            ).scalars())
+            QueueManager.stats_account('nr_readynets', {queue_id: -cnt for queue_id, cnt in removed_queues.items()})
+            QueueManager.stats_account('nr_readynets', added_queues)
+            removed, added = sum(removed_queues.values()), sum(added_queues.values())
 
         db.session.commit()
-        cls.release_lock()
+        return removed, added
+
+    @classmethod
+    def ratelimit_refill(cls):
+        """
+        refill rate-limit engine, activate readynets of hashvals which became available over time
+
+        :return: number of refilled hashvals
+        :rtype: int
+        """
+
+        cls.get_lock(cls.TIMEOUT_JOB_ASSIGN, shared=True)
+        refilled = cls.ratelimit().refill()
+        db.session.commit()
+        return refilled
 
     @classmethod
     def heatmap_check(cls):
@@ -623,10 +959,9 @@ class SchedulerService:
 
         cls.get_lock()
 
-        ref_heatmap = defaultdict(int)
+        ref_heatmap = Counter()
         for job in Job.query.filter(Job.retval == None).all():  # noqa: E711  pylint: disable=singleton-comparison
-            for target in json.loads(job.assignment)['targets']:
-                ref_heatmap[SchedulerService.hashval(target)] += 1
+            ref_heatmap.update(cls.hashvals(json.loads(job.assignment)['targets']))
 
         db_heatmap = {
             item.hashval: item.count
@@ -643,5 +978,5 @@ class SchedulerService:
         }
 
         heatmaps_equal = not bool(keys_only_in_dict1 or keys_only_in_dict2 or different_values)
-        cls.release_lock()
+        db.session.commit()
         return heatmaps_equal
@@ -0,0 +1,196 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler target exclusions
+"""
+
+import json
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from enum import Enum
+from functools import lru_cache
+from hashlib import md5
+from ipaddress import ip_address, ip_network
+
+from sner.agent.modules import SERVICE_TARGET_REGEXP
+from sner.plugin.six_enum_discover.agent import SIXENUM_TARGET_REGEXP
+
+
+SERVICE_TARGET_RE = re.compile(SERVICE_TARGET_REGEXP)
+SIXENUM_TARGET_RE = re.compile(SIXENUM_TARGET_REGEXP)
+
+
+def sixenum_target_boundaries(value):
+    """returns tuple(first, last)"""
+
+    if not (mtmp := re.match(SIXENUM_TARGET_REGEXP, value)):
+        raise ValueError('not valid sixenum target')
+
+    addr = mtmp.group('scan6dst')
+
+    if '-' in addr:
+        first, last = addr.split('-')
+        tmp = first.split(':')
+        tmp[-1] = last
+        last = ':'.join(tmp)
+        return first, last
+
+    return addr, addr
+
+
+class ExclFamily(Enum):
+    """exclusion family enum"""
+
+    NETWORK = 'network'
+    REGEX = 'regex'
+
+
+class ExclTarget(namedtuple('ExclTarget', ['value', 'version', 'first', 'last'])):
+    """
+    target parsed for exclusion matching, address targets carry ip version and first/last address
+    as integers (sixenum target is a range of addresses), non-address targets carry only the value
+    """
+
+    @classmethod
+    def parse(cls, value):
+        """parse target value"""
+
+        addrs = None
+        if mtmp := SERVICE_TARGET_RE.match(value):
+            addrs = (mtmp.group('host').replace('[', '').replace(']', ''),) * 2
+        elif SIXENUM_TARGET_RE.match(value):
+            addrs = sixenum_target_boundaries(value)
+        else:
+            addrs = (value, value)
+
+        try:
+            first, last = sorted(map(ip_address, addrs))
+        except (TypeError, ValueError):
+            return cls(value, None, None, None)
+        return cls(value, first.version, int(first), int(last))
+
+
+class ExclMatcher():
+    """
+    object matching value againts set of exclusions/rules
+
+    rules are grouped by family and each family is compiled into single matcher,
+    value is parsed only once for all matchers.
+    """
+
+    MATCHERS = {}
+
+    @staticmethod
+    def register(family):
+        """register matcher class to the excl.family"""
+
+        def register_real(cls):
+            if cls not in ExclMatcher.MATCHERS:
+                ExclMatcher.MATCHERS[family] = cls
+            return cls
+        return register_real
+
+    def __init__(self, config):
+        rules = defaultdict(list)
+        for family, value in config:
+            rules[ExclFamily(family)].append(value)
+        self.excls = [ExclMatcher.MATCHERS[family](values) for family, values in rules.items()]
+        self.version = md5(json.dumps(list(map(list, config))).encode()).hexdigest()
+
+    @classmethod
+    def from_config(cls, config):
+        """get compiled matcher for config, matchers are cached across calls"""
+
+        return _excl_matcher_cached(tuple(map(tuple, config)))
+
+    def match(self, value):
+        """match value against all exclusions/matchers"""
+
+        target = ExclTarget.parse(value)
+        for excl in self.excls:
+            if excl.match(target):
+                return True
+        return False
+
+
+@lru_cache(maxsize=8)
+def _excl_matcher_cached(config):
+    return ExclMatcher(config)
+
+
+class ExclMatcherImplBase(ABC):  # pylint: disable=too-few-public-methods
+    """base interface which must  be implemented by all available matchers"""
+
+    def __init__(self, match_to):
+        self.match_to = self._initialize(match_to)
+
+    @abstractmethod
+    def _initialize(self, match_to):
+        """initialize matcher impl from list of rule values"""
+
+    @abstractmethod
+    def match(self, target):
+        """returns bool if parsed target (ExclTarget) matches the initialized match_to"""
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.match_to}>'
+
+
+@ExclMatcher.register(ExclFamily.NETWORK)
+class NetworkExclMatcher(ExclMatcherImplBase):  # pylint: disable=too-few-public-methods
+    """
+    network matcher
+
+    excluded networks are merged into sorted lists of disjoint intervals per ip version,
+    target (address or address range) matches if it overlaps any excluded interval.
+    """
+
+    def _initialize(self, match_to):
+        index = {}
+        intervals = defaultdict(list)
+        for item in map(ip_network, match_to):
+            intervals[item.version].append((int(item.network_address), int(item.broadcast_address)))
+
+        for version, items in intervals.items():
+            merged = []
+            for first, last in sorted(items):
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            index[version] = ([item[0] for item in merged], [item[1] for item in merged])
+
+        return index
+
+    def match(self, target):
+        if target.version not in self.match_to:
+            return False
+
+        firsts, lasts = self.match_to[target.version]
+        idx = bisect_right(firsts, target.last) - 1
+        return (idx >= 0) and (lasts[idx] >= target.first)
+
+
+@ExclMatcher.register(ExclFamily.REGEX)
+class RegexExclMatcher(ExclMatcherImplBase):  # pylint: disable=too-few-public-methods
+    """
+    regex matcher, rules are combined into single alternation
+
+    * numbered backreferences would be shifted by groups of preceding rules, such rules are matched separately
+    * rules not combinable (eg. inline global flags) are matched one by one
+    """
+
+    BACKREFERENCE_RE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]')
+
+    def _initialize(self, match_to):
+        separate = [item for item in match_to if self.BACKREFERENCE_RE.search(item)]
+        combined = [item for item in match_to if item not in separate]
+        try:
+            compiled = [re.compile('|'.join(f'(?:{item})' for item in combined))] if combined else []
+        except re.error:
+            return list(map(re.compile, match_to))
+        return compiled + list(map(re.compile, separate))
+
+    def match(self, target):
+        return any(item.search(target.value) for item in self.match_to)
@@ -7,7 +7,7 @@ import yaml
 from flask_wtf import FlaskForm
 from schema import SchemaError
 from wtforms import BooleanField, IntegerField, SubmitField, ValidationError
-from wtforms.validators import InputRequired, Length, NumberRange
+from wtforms.validators import InputRequired, Length, NumberRange, Optional
 
 from sner.agent.modules import REGISTERED_MODULES
 from sner.server.forms import StringNoneField, TextAreaListField, TextAreaNoneField
@@ -30,12 +30,22 @@ def valid_agent_config(_, field):
         raise ValidationError(f'Invalid config: {str(exc)}') from None
 
 
+def valid_group_size_max(form, field):
+    """validate adaptive group size bounds"""
+
+    if (field.data is not None) and (form.group_size_min.data is not None) and (field.data < form.group_size_min.data):
+        raise ValidationError('Must not be lower than group size min')
+
+
 class QueueForm(FlaskForm):
     """queue edit form"""
 
     name = StringNoneField('Name', [InputRequired(), Length(min=1, max=250)])
     config = TextAreaNoneField('Config', [valid_agent_config], render_kw={'rows': '10'})
     group_size = IntegerField('Group size', [InputRequired(), NumberRange(min=1)], default=1)
+    group_runtime = IntegerField('Group runtime', [Optional(), NumberRange(min=1)])
+    group_size_min = IntegerField('Group size min', [Optional(), NumberRange(min=1)])
+    group_size_max = IntegerField('Group size max', [Optional(), NumberRange(min=1), valid_group_size_max])
     priority = IntegerField('Priority', [InputRequired()], default=0)
     active = BooleanField('Active')
     reqs = TextAreaListField('Requirements', render_kw={'class': 'form-control tageditor'})
@@ -8,11 +8,14 @@ import os
 from datetime import datetime
 
 from flask import current_app
+from sqlalchemy import case, cast, func, select, text
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Index, PrimaryKeyConstraint
 
 from sner.server.extensions import db
+from sner.server.scheduler.outputstore import output_store
 
 
 class Queue(db.Model):
@@ -22,12 +25,17 @@ class Queue(db.Model):
     name = db.Column(db.String(250), nullable=False, unique=True)
     config = db.Column(db.Text)
     group_size = db.Column(db.Integer, nullable=False)
+    group_runtime = db.Column(db.Integer)
+    group_size_min = db.Column(db.Integer)
+    group_size_max = db.Column(db.Integer)
     priority = db.Column(db.Integer, nullable=False)
     active = db.Column(db.Boolean, nullable=False, default=True)
     reqs = db.Column(postgresql.ARRAY(db.String, dimensions=1), nullable=False, default=list)
+    excl_version = db.Column(db.String(32))
 
     targets = relationship('Target', back_populates='queue', cascade='delete,delete-orphan', passive_deletes=True)
     jobs = relationship('Job', back_populates='queue', cascade='delete,delete-orphan', passive_deletes=True)
+    stats = relationship('QueueStats', back_populates='queue', uselist=False, cascade='delete,delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<Queue {self.id}: {self.name}>'
@@ -37,6 +45,48 @@ class Queue(db.Model):
         """return absolute path of the queue data directory"""
         return os.path.join(current_app.config['SNER_VAR'], 'scheduler', f'queue-{self.id}') if self.id else None
 
+    @hybrid_property
+    def group_size_effective(self):
+        """
+        return number of targets per assignment
+
+        if group_runtime is set, size is adapted to observed runtime per target within
+        group_size_min (default 1) and group_size_max (default group_size) bounds
+        """
+
+        if (self.group_runtime is None) or (self.stats is None) or (self.stats.target_runtime is None):
+            return self.group_size
+        size = round(self.group_runtime / max(self.stats.target_runtime, QueueStats.RUNTIME_MIN))
+        return max(self.group_size_min or 1, min(self.group_size_max or self.group_size, size))
+
+    @group_size_effective.expression
+    def group_size_effective(cls):  # pylint: disable=no-self-argument
+        """sql expression of effective group size"""
+
+        target_runtime = select(QueueStats.target_runtime).filter(QueueStats.queue_id == cls.id).correlate_except(QueueStats).scalar_subquery()
+        size = cast(func.round(cls.group_runtime / func.greatest(target_runtime, QueueStats.RUNTIME_MIN)), db.Integer)
+        return case(
+            (size == None, cls.group_size),  # noqa: E711  pylint: disable=singleton-comparison
+            else_=func.greatest(func.coalesce(cls.group_size_min, 1), func.least(func.coalesce(cls.group_size_max, cls.group_size), size))
+        )
+
+
+class QueueStats(db.Model):
+    """queue counters maintained by scheduler along with targets, readynets and jobs changes"""
+
+    queue_id = db.Column(db.Integer, db.ForeignKey('queue.id', ondelete='CASCADE'), primary_key=True)
+    nr_targets = db.Column(db.Integer, nullable=False, default=0)
+    nr_readynets = db.Column(db.Integer, nullable=False, default=0)
+    nr_running = db.Column(db.Integer, nullable=False, default=0)
+    target_runtime = db.Column(db.Float)
+
+    queue = relationship('Queue', back_populates='stats')
+
+    RUNTIME_MIN = 0.001
+
+    def __repr__(self):
+        return f'<QueueStats {self.queue_id}: {self.nr_targets} {self.nr_readynets} {self.nr_running}>'
+
 
 class Target(db.Model):
     """single target in queue"""
@@ -45,11 +95,12 @@ class Target(db.Model):
     queue_id = db.Column(db.Integer, db.ForeignKey('queue.id', ondelete='CASCADE'), nullable=False)
     target = db.Column(db.Text, nullable=False)
     hashval = db.Column(db.Text, nullable=False)
+    rand = db.Column(db.Float, nullable=False, server_default=text('random()'))
 
     queue = relationship('Queue', back_populates='targets')
 
     __table_args__ = (
-        Index('target_queueid_hashval', 'queue_id', 'hashval'),  # get_assignment: select random target from queue
+        Index('target_queueid_hashval_rand', 'queue_id', 'hashval', 'rand'),  # get_assignment: select random target from queue
         Index('target_hashval', 'hashval')  # job_done: enable readynet on all queues
     )
 
@@ -71,14 +122,33 @@ class Heatmap(db.Model):
         return f'<Heatmap {self.hashval}: {self.count}>'
 
 
+class TokenBucket(db.Model):
+    """rate-limit token bucket item"""
+
+    hashval = db.Column(db.String, nullable=False)
+    tokens = db.Column(db.Float, nullable=False)
+    time_update = db.Column(db.DateTime, nullable=False)
+    time_ready = db.Column(db.DateTime)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('hashval', name='token_bucket_pkey'),
+        Index('token_bucket_time_ready', 'time_ready', postgresql_where=text('time_ready IS NOT NULL'))  # refill: select exhausted buckets
+    )
+
+    def __repr__(self):
+        return f'<TokenBucket {self.hashval}: {self.tokens}>'
+
+
 class Readynet(db.Model):
     """represents list of networks available for job assignment"""
 
     queue_id = db.Column(db.Integer, db.ForeignKey('queue.id', ondelete='CASCADE'), nullable=False)
     hashval = db.Column(db.String, nullable=False)
+    rand = db.Column(db.Float, nullable=False, server_default=text('random()'))
 
     __table_args__ = (
         PrimaryKeyConstraint('queue_id', 'hashval', name='readynet_pkey'),  # enqueue: ensure uniqueness
+        Index('readynet_queueid_rand', 'queue_id', 'rand'),  # get_assignment: select random readynet from queue
         Index('readynet_hashval', 'hashval')  # get_assignment: remove readynet when hot
     )
 
@@ -95,13 +165,18 @@ class Job(db.Model):
     retval = db.Column(db.Integer)
     time_start = db.Column(db.DateTime, default=datetime.utcnow)
     time_end = db.Column(db.DateTime)
+    time_heartbeat = db.Column(db.DateTime)
 
     queue = relationship('Queue', back_populates='jobs')
 
+    __table_args__ = (
+        Index('job_running_heartbeat', 'time_heartbeat', postgresql_where=text('retval IS NULL')),  # reap: select expired running jobs
+    )
+
     def __repr__(self):
         return f'<Job {self.id}>'
 
     @property
     def output_abspath(self):
         """return absolute path to the output data file acording to current app config"""
-        return os.path.join(self.queue.data_abspath, self.id)
+        return output_store().job_path(self)
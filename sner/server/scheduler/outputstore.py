@@ -0,0 +1,283 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler job output store
+"""
+
+import errno
+import os
+from io import BytesIO
+from pathlib import Path
+from shutil import copy2
+from uuid import uuid4
+
+from flask import current_app
+
+from sner.lib import file_sha256
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover  ; optional dependency
+    zstandard = None
+
+# hardlinks not supported across filesystems or by filesystem itself
+LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EPERM)
+
+
+class FlatOutputStore:
+    """
+    legacy job output store
+
+    Outputs are stored as flat files in queue data directory, archive copies outputs into single
+    flat archive directory.
+    """
+
+    def __init__(self, var_dir, **kwargs):  # pylint: disable=unused-argument
+        self.var_dir = Path(var_dir)
+        self.archive_dir = self.var_dir / 'planner_archive'
+
+    def job_path(self, job):
+        """return absolute path to the job output file"""
+        return os.path.join(job.queue.data_abspath, job.id)
+
+    def put(self, job, output):
+        """
+        store job output
+
+        :param output: output data or path to already received output file which is moved in place
+        :type output: bytes or pathlib.Path
+        """
+
+        opath = Path(self.job_path(job))
+        opath.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(output, Path):
+            output.replace(opath)
+        else:
+            opath.write_bytes(output)
+
+    def remove(self, job):
+        """remove job output"""
+
+        opath = Path(self.job_path(job))
+        if opath.exists():
+            opath.unlink()
+
+    def cleanup_queue(self, queue):
+        """cleanup store structures in queue data directory before it's removal"""
+
+    def gc_objects(self):
+        """garbage collect unreferenced store objects, return number of removed objects"""
+        return 0
+
+    def archive(self, job):
+        """archive job output"""
+
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        copy2(self.job_path(job), self.archive_dir)
+
+    def archived(self, job_id=None, queue_name=None, date=None):
+        """list archived outputs, flat archive can be searched only by job id"""
+
+        if queue_name or date:
+            raise ValueError('flat archive cannot be searched by queue or date')
+        return sorted(self.archive_dir.glob(job_id or '*'))
+
+    @staticmethod
+    def read_archived(path):
+        """read archived output data"""
+        return Path(path).read_bytes()
+
+
+class ShardedOutputStore(FlatOutputStore):
+    """
+    sharded and deduplicated job output store
+
+    * job outputs are stored in queue data directory sharded by job id prefix
+    * identical outputs are deduplicated by hardlinking to content-addressed objects
+      (`scheduler/objects/<sha256 prefix>/<sha256>`), job output removal only unlinks the output,
+      objects no longer referenced by any job output are removed by `gc_objects`
+    * archive does not copy the data, archived output is hardlinked into index views by date/queue
+      (`planner_archive/<YYYY>/<MM>/<DD>/<queue name>/<job id>`) and by job id
+      (`planner_archive/by-id/<job id prefix>/<job id>`)
+    * optionally, archived outputs are recompressed with zstd (requires zstandard module) and
+      stored deduplicated in `planner_archive/objects`; views then carry `.zst` suffix
+    * data are copied instead of hardlinked if filesystem does not support hardlinks
+    """
+
+    SHARD_LEN = 2
+    ZSTD_SUFFIX = '.zst'
+
+    def __init__(self, var_dir, zstd_level=0, **kwargs):
+        super().__init__(var_dir, **kwargs)
+        if zstd_level and (zstandard is None):
+            raise RuntimeError('zstandard module required for output store compression')
+        self.zstd_level = zstd_level
+        self.objects_dir = self.var_dir / 'scheduler' / 'objects'
+
+    def job_path(self, job):
+        """return absolute path to the job output file, outputs stored by legacy store are still honored"""
+
+        legacy_path = super().job_path(job)
+        if os.path.exists(legacy_path):
+            return legacy_path
+        return os.path.join(job.queue.data_abspath, job.id[:self.SHARD_LEN], job.id)
+
+    @classmethod
+    def object_path(cls, objects_dir, digest, suffix=''):
+        """return path of content-addressed object"""
+        return objects_dir / digest[:cls.SHARD_LEN] / f'{digest}{suffix}'
+
+    @staticmethod
+    def _link(src, dst):
+        """atomically place hardlink (or copy if hardlinks are not supported) of src to dst"""
+
+        tmp_path = dst.with_name(f'{dst.name}.{uuid4()}.tmp')
+        try:
+            os.link(src, tmp_path)
+        except OSError as exc:
+            if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+            copy2(src, tmp_path)
+        tmp_path.replace(dst)
+
+    def put(self, job, output):
+        """store job output and deduplicate it with already stored objects"""
+
+        # existing output might be shared with other jobs, must not be rewritten in place
+        self.remove(job)
+        super().put(job, output)
+
+        opath = Path(self.job_path(job))
+        obj_path = self.object_path(self.objects_dir, file_sha256(opath))
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # register new object
+            os.link(opath, obj_path)
+        except FileExistsError:
+            try:
+                self._link(obj_path, opath)
+            except FileNotFoundError:  # pragma: no cover  ; race with removal, output stays stored undeduplicated
+                pass
+        except OSError as exc:
+            # output stays stored undeduplicated
+            if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+
+    def cleanup_queue(self, queue):
+        """remove empty shard directories"""
+
+        qpath = Path(queue.data_abspath)
+        if not qpath.exists():
+            return
+        for shard in qpath.iterdir():
+            if shard.is_dir() and (len(shard.name) == self.SHARD_LEN) and (not any(shard.iterdir())):
+                shard.rmdir()
+
+    def gc_objects(self):
+        """
+        remove objects not referenced by any job output
+
+        objects are not tracked by job, nor by link count as they might be shared with archive views,
+        references are resolved by inode scan of queue data directories. views keep the data after object removal.
+        """
+
+        referenced = set()
+        for qpath in (self.var_dir / 'scheduler').glob('queue-*'):
+            for path in qpath.rglob('*'):
+                if path.is_file():
+                    stat = path.stat()
+                    referenced.add((stat.st_dev, stat.st_ino))
+
+        removed = 0
+        for obj_path in self.objects_dir.glob('*/*'):
+            stat = obj_path.stat()
+            if (stat.st_dev, stat.st_ino) not in referenced:
+                obj_path.unlink()
+                removed += 1
+        return removed
+
+    def _archive_source(self, opath):
+        """return path of the data to be linked into archive views, compress if configured"""
+
+        if not self.zstd_level:
+            return opath
+
+        obj_path = self.object_path(self.archive_dir / 'objects', file_sha256(opath), self.ZSTD_SUFFIX)
+        if not obj_path.exists():
+            obj_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = obj_path.with_name(f'{obj_path.name}.{uuid4()}.tmp')
+            with opath.open('rb') as src, tmp_path.open('wb') as dst:
+                zstandard.ZstdCompressor(level=self.zstd_level).copy_stream(src, dst)
+            try:
+                os.link(tmp_path, obj_path)
+            except FileExistsError:  # pragma: no cover  ; race with concurrent archive
+                pass
+            except OSError as exc:
+                if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+                    raise
+                tmp_path.replace(obj_path)
+                return obj_path
+            tmp_path.unlink()
+        return obj_path
+
+    def archive(self, job):
+        """archive job output by linking into index views"""
+
+        source = self._archive_source(Path(self.job_path(job)))
+        suffix = self.ZSTD_SUFFIX if self.zstd_level else ''
+        date = (job.time_end or job.time_start).strftime('%Y/%m/%d')
+        queue_name = job.queue.name.replace(os.sep, '_')
+
+        for view_path in [
+            self.archive_dir / date / queue_name / f'{job.id}{suffix}',
+            self.archive_dir / 'by-id' / job.id[:self.SHARD_LEN] / f'{job.id}{suffix}'
+        ]:
+            view_path.parent.mkdir(parents=True, exist_ok=True)
+            self._link(source, view_path)
+
+    def archived(self, job_id=None, queue_name=None, date=None):
+        """
+        list archived outputs
+
+        :param job_id: job id
+        :param queue_name: queue name
+        :param date: archive date
+        :type date: datetime.date
+        """
+
+        if job_id:
+            paths = self.archive_dir.glob(f'by-id/{job_id[:self.SHARD_LEN]}/{job_id}*')
+        else:
+            date_pattern = date.strftime('%Y/%m/%d') if date else '*/*/*'
+            queue_pattern = queue_name.replace(os.sep, '_') if queue_name else '*'
+            paths = self.archive_dir.glob(f'{date_pattern}/{queue_pattern}/*')
+        return sorted(path for path in paths if not path.name.endswith('.tmp'))
+
+    @classmethod
+    def read_archived(cls, path):
+        """read archived output data, decompress if required"""
+
+        path = Path(path)
+        if path.suffix != cls.ZSTD_SUFFIX:
+            return path.read_bytes()
+
+        if zstandard is None:  # pragma: no cover  ; optional dependency
+            raise RuntimeError('zstandard module required to read compressed output')
+        buf = BytesIO()
+        with path.open('rb') as src:
+            zstandard.ZstdDecompressor().copy_stream(src, buf)
+        return buf.getvalue()
+
+
+OUTPUT_STORES = {
+    'flat': FlatOutputStore,
+    'sharded': ShardedOutputStore
+}
+
+
+def output_store():
+    """return output store configured for current app"""
+
+    return OUTPUT_STORES[current_app.config['SNER_OUTPUT_STORE']](
+        current_app.config['SNER_VAR'],
+        zstd_level=current_app.config['SNER_OUTPUT_STORE_ZSTD_LEVEL']
+    )
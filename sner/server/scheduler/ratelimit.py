@@ -0,0 +1,259 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler rate-limit engines
+"""
+
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+from ipaddress import ip_address, IPv4Address, IPv6Address
+from random import random
+
+from sqlalchemy import cast, column, delete, func, literal, select, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from sner.agent.modules import SERVICE_TARGET_REGEXP
+from sner.plugin.six_enum_discover.agent import SIXENUM_TARGET_REGEXP
+from sner.server.extensions import db
+from sner.server.scheduler.models import Heatmap, TokenBucket
+
+
+SERVICE_TARGET_RE = re.compile(SERVICE_TARGET_REGEXP)
+SIXENUM_TARGET_RE = re.compile(SIXENUM_TARGET_REGEXP)
+
+
+class HashvalEngine:
+    """
+    rate-limit heatmap hash value engine
+
+    Address targets (plain, service and sixenum targets) are hashed to the network of configured
+    prefix length per address family, other targets are used as is. Networks are computed by integer
+    masking and the results are memoized.
+    """
+
+    MEMO_SIZE = 65536
+
+    def __init__(self, prefixlen4=24, prefixlen6=48):
+        self.prefixlen = {4: prefixlen4, 6: prefixlen6}
+        self.mask = {
+            4: ((1 << 32) - 1) ^ ((1 << (32 - prefixlen4)) - 1),
+            6: ((1 << 128) - 1) ^ ((1 << (128 - prefixlen6)) - 1)
+        }
+        self.hashval = lru_cache(maxsize=self.MEMO_SIZE)(self._hashval)
+        self.network = lru_cache(maxsize=self.MEMO_SIZE)(self._network)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def get(prefixlen4=24, prefixlen6=48):
+        """get shared engine instance for given prefix lengths"""
+
+        return HashvalEngine(prefixlen4, prefixlen6)
+
+    def _network(self, version, masked):
+        """format network of masked address"""
+
+        return f'{IPv4Address(masked) if version == 4 else IPv6Address(masked)}/{self.prefixlen[version]}'
+
+    def _hashval(self, value):
+        """computes hash value for single value"""
+
+        addr = value
+        if mtmp := SERVICE_TARGET_RE.match(value):
+            addr = mtmp.group('host')
+            if (addr[0] == '[') and (addr[-1] == ']'):
+                addr = addr[1:-1]
+        elif mtmp := SIXENUM_TARGET_RE.match(value):
+            addr = mtmp.group('scan6dst').split('-')[0]
+
+        try:
+            parsed = ip_address(addr)
+        except ValueError:
+            return addr
+        return self.network(parsed.version, int(parsed) & self.mask[parsed.version])
+
+    def hashvals(self, values_list):
+        """computes hash values for list of values"""
+
+        return list(map(self.hashval, values_list))
+
+
+class HeatmapRateLimit:
+    """
+    heatmap rate-limit engine
+
+    Limits number of concurrently assigned targets per hashval, hashval is ready as long as it's heat count
+    is below the hot level. Heat counts are accounted on assignment and released on job output.
+
+    Engine operates on heatmap and readynets through scheduler service given on creation.
+    """
+
+    def __init__(self, scheduler, hot_level=0):
+        self.scheduler = scheduler
+        self.hot_level = hot_level
+
+    @classmethod
+    def from_config(cls, scheduler, config):
+        """create engine from app config"""
+
+        return cls(scheduler, config['SNER_HEATMAP_HOT_LEVEL'])
+
+    def capacity(self, hashval_column):
+        """
+        sql expression of number of targets assignable at the moment for hashval
+
+        :return: capacity expression or None if hashvals are not limited
+        """
+
+        if not self.hot_level:
+            return None
+        return self.hot_level - func.coalesce(select(Heatmap.count).filter(Heatmap.hashval == hashval_column).scalar_subquery(), 0)
+
+    def consume(self, hashval_counts):
+        """account assigned targets, deactivate readynets of exhausted hashvals, does not commit"""
+
+        self.scheduler.heatmap_put_many(hashval_counts)
+
+    def release(self, hashval_counts):
+        """account released targets, activate readynets of available hashvals, does not commit"""
+
+        self.scheduler.heatmap_pop_many(hashval_counts)
+
+    def refill(self):
+        """
+        activate readynets of hashvals which became available over time, does not commit
+
+        :return: number of refilled hashvals
+        :rtype: int
+        """
+
+        return 0
+
+    def refill_delay(self):
+        """
+        get time until next hashval becomes available over time
+
+        :return: delay in seconds or None if there's no hashval waiting for refill
+        :rtype: float
+        """
+
+        return None
+
+
+class TokenBucketRateLimit(HeatmapRateLimit):
+    """
+    token bucket rate-limit engine
+
+    Limits rate of assigned targets per hashval. Each hashval has a bucket of burst tokens refilled at constant rate,
+    each assigned target consumes one token. Hashval is ready as long as there's at least one token in the bucket.
+    Buckets are stored with tokens count at the time of the last update, exhausted buckets keep time when they
+    become ready again and readynets of such hashvals are activated by refill (on assignment or by planner).
+
+    * missing bucket is considered full, full buckets are garbage collected
+    * heatmap is accounted along with buckets, concurrency is limited by hot level if configured
+    """
+
+    REFILL_BATCH = 1000
+
+    def __init__(self, scheduler, hot_level=0, rate=60, burst=10):
+        super().__init__(scheduler, hot_level)
+        self.rate = rate / 60
+        self.burst = burst
+
+    @classmethod
+    def from_config(cls, scheduler, config):
+        """create engine from app config"""
+
+        return cls(scheduler, config['SNER_HEATMAP_HOT_LEVEL'], config['SNER_TOKENBUCKET_RATE'], config['SNER_TOKENBUCKET_BURST'])
+
+    @staticmethod
+    def now():
+        """current time, bucket states are evaluated against"""
+
+        return datetime.utcnow()
+
+    def tokens(self, now):
+        """sql expression of bucket tokens available at the time"""
+
+        return func.least(self.burst, TokenBucket.tokens + func.extract('epoch', literal(now) - TokenBucket.time_update) * self.rate)
+
+    def capacity(self, hashval_column):
+        """sql expression of number of targets assignable at the moment for hashval"""
+
+        tokens = select(func.floor(self.tokens(self.now()))).filter(TokenBucket.hashval == hashval_column).scalar_subquery()
+        capacity = cast(func.coalesce(tokens, self.burst), db.Integer)
+        if (heat_capacity := super().capacity(hashval_column)) is not None:
+            return func.least(heat_capacity, capacity)
+        return capacity
+
+    def consume(self, hashval_counts):
+        """account assigned targets, deactivate readynets of exhausted hashvals, does not commit"""
+
+        super().consume(hashval_counts)
+
+        conn = db.session.connection()
+        now = self.now()
+        # inserted tokens holds burst reduced by consumed tokens, consumed tokens are subtracted from updated buckets as well
+        stmt = pg_insert(TokenBucket).values([
+            {'hashval': key, 'tokens': self.burst - val, 'time_update': now}
+            for key, val in hashval_counts.items()
+        ])
+        buckets = conn.execute(
+            stmt
+            .on_conflict_do_update(
+                constraint='token_bucket_pkey',
+                set_=dict(tokens=self.tokens(now) - self.burst + stmt.excluded.tokens, time_update=now)
+            )
+            .returning(TokenBucket.hashval, TokenBucket.tokens)
+        ).all()
+
+        if exhausted := {row.hashval: now + timedelta(seconds=(1 - row.tokens) / self.rate) for row in buckets if row.tokens < 1}:
+            ready = values(column('hashval', db.String), column('time_ready', db.DateTime), name='ready').data(list(exhausted.items()))
+            conn.execute(update(TokenBucket).where(TokenBucket.hashval == ready.c.hashval).values(time_ready=ready.c.time_ready))
+            self.scheduler.readynets_deactivate(list(exhausted))
+
+    def refill(self):
+        """
+        activate readynets of hashvals which became available over time, does not commit
+
+        ready buckets locked by concurrent transactions are skipped and refilled later.
+
+        :return: number of refilled hashvals
+        :rtype: int
+        """
+
+        conn = db.session.connection()
+        now = self.now()
+
+        candidates = select(TokenBucket.hashval).filter(TokenBucket.time_ready <= now).limit(self.REFILL_BATCH).subquery()
+        hashvals = conn.execute(
+            select(candidates.c.hashval)
+            .filter(self.scheduler.hashval_try_lock(candidates.c.hashval))
+        ).scalars().all()
+        if hashvals:
+            conn.execute(update(TokenBucket).filter(TokenBucket.hashval.in_(hashvals)).values(time_ready=None))
+            self.scheduler.readynets_activate(hashvals)
+
+        if random() < self.scheduler.HEATMAP_GC_PROBABILITY:
+            # skip rows being updated by concurrent transactions
+            conn.execute(
+                delete(TokenBucket)
+                .filter(TokenBucket.hashval.in_(
+                    select(TokenBucket.hashval)
+                    .filter(TokenBucket.time_ready == None, self.tokens(now) >= self.burst)  # noqa: E711  pylint: disable=singleton-comparison
+                    .with_for_update(skip_locked=True)
+                ))
+            )
+
+        return len(hashvals)
+
+    def refill_delay(self):
+        """get time until next hashval becomes available over time"""
+
+        time_ready = db.session.connection().execute(select(func.min(TokenBucket.time_ready))).scalar()
+        return max((time_ready - self.now()).total_seconds(), 0) if time_ready else None
+
+
+RATELIMIT_ENGINES = {
+    'heatmap': HeatmapRateLimit,
+    'tokenbucket': TokenBucketRateLimit
+}
@@ -0,0 +1,131 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler ready notifications
+"""
+
+from contextlib import contextmanager
+from select import select as select_fds
+from threading import Condition, Event, Lock, Thread
+
+from flask import current_app
+
+from sner.server.extensions import db
+
+
+SCHEDULER_READY_CHANNEL = 'sner_scheduler_ready'
+
+
+class SchedulerReadyListener:  # pylint: disable=too-many-instance-attributes
+    """
+    scheduler ready notifications listener
+
+    Single daemon thread per application holds dedicated database connection listening on scheduler ready
+    channel, waiting requests are woken through condition variable. Waiting requests does not occupy
+    database connection nor scheduler lock, but each one occupies server worker thread, hence number of
+    concurrent waiters is limited.
+    """
+
+    POLL_INTERVAL = 1.0
+    RECONNECT_INTERVAL = 1.0
+    EXTENSION_NAME = 'sner_scheduler_ready_listener'
+    CREATE_LOCK = Lock()
+
+    def __init__(self, engine, logger, waiters_max=0):
+        self.engine = engine
+        self.logger = logger
+        self.waiters_max = waiters_max
+        self.waiters = 0
+        self.generation = 0
+        self.cond = Condition()
+        self.listening = Event()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name='scheduler-ready-listener', daemon=True)
+        self.thread.start()
+        self.listening.wait(self.RECONNECT_INTERVAL)
+
+    @classmethod
+    def get(cls):
+        """get listener for current app, start it if not running"""
+
+        with cls.CREATE_LOCK:
+            if cls.EXTENSION_NAME not in current_app.extensions:
+                current_app.extensions[cls.EXTENSION_NAME] = cls(db.engine, current_app.logger, current_app.config['SNER_ASSIGN_WAITERS_MAX'])
+        return current_app.extensions[cls.EXTENSION_NAME]
+
+    def _wakeup(self):
+        """wake up all waiting requests"""
+
+        with self.cond:
+            self.generation += 1
+            self.cond.notify_all()
+
+    def _listen(self, conn):
+        """listen and dispatch notifications until stopped"""
+
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {SCHEDULER_READY_CHANNEL}')
+        self.listening.set()
+        # notifications might have been missed while (re)connecting
+        self._wakeup()
+
+        while not self.stopped.is_set():
+            if select_fds([conn], [], [], self.POLL_INTERVAL)[0]:
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    self._wakeup()
+
+    def _run(self):
+        """listener thread"""
+
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                # connection is detached from the pool, listening connection must not be reused by the application
+                fairy = self.engine.raw_connection()
+                fairy.detach()
+                conn = fairy.connection
+                self._listen(conn)
+            except Exception as exc:  # pylint: disable=broad-except  ; listener must survive database outages
+                self.logger.error('scheduler ready listener failed, %s', exc)
+                self.stopped.wait(self.RECONNECT_INTERVAL)
+            finally:
+                self.listening.clear()
+                if conn is not None:
+                    conn.close()
+
+    def stop(self):
+        """stop listener"""
+
+        self.stopped.set()
+        self.thread.join()
+
+    @contextmanager
+    def waiter(self):
+        """
+        waiter slot, yields False if maximum number of concurrent waiters (0 for unlimited) has been reached
+        """
+
+        with self.cond:
+            acquired = (not self.waiters_max) or (self.waiters < self.waiters_max)
+            if acquired:
+                self.waiters += 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self.cond:
+                    self.waiters -= 1
+
+    def wait(self, generation, timeout):
+        """
+        wait for notification received after given generation
+
+        :return: current generation
+        :rtype: int
+        """
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
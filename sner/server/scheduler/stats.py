@@ -0,0 +1,101 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler queue stats accounting
+"""
+
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from sner.server.extensions import db
+from sner.server.scheduler.models import QueueStats
+from sner.server.scheduler.ready import SCHEDULER_READY_CHANNEL
+
+
+class QueueStatsMixin:
+    """queue stats counters accounting, pending changes are held in session info"""
+
+    RUNTIME_WEIGHT = 0.2
+
+    @staticmethod
+    def stats_account(name, deltas):
+        """
+        account changes of queue stats counter, pending changes are written in bulk on transaction commit
+
+        :param name: QueueStats counter name
+        :param deltas: counter changes per queue id
+        :type deltas: dict
+        """
+
+        pending = db.session.info.setdefault('queue_stats', defaultdict(Counter))
+        for queue_id, delta in deltas.items():
+            pending[queue_id][name] += delta
+
+    @staticmethod
+    def stats_account_runtime(queue_id, runtime):
+        """
+        account observed job runtime per target, pending samples are folded into queue target_runtime
+        moving average on transaction commit
+
+        :param runtime: job runtime per target in seconds
+        :type runtime: float
+        """
+
+        pending = db.session.info.setdefault('queue_stats', defaultdict(Counter))
+        pending[queue_id]['runtime_sum'] += runtime
+        pending[queue_id]['runtime_count'] += 1
+
+    @staticmethod
+    def stats_write(session):
+        """
+        write pending queue stats changes, called on session commit
+
+        stats rows are locked in queue id order at the end of the transaction in order to avoid deadlocks
+        and to keep row locks held for the shortest time possible. If any readynet becomes available,
+        scheduler ready notification is sent.
+        """
+
+        if not (pending := session.info.pop('queue_stats', None)):
+            return
+
+        names = ['nr_targets', 'nr_readynets', 'nr_running']
+        rows = [
+            {
+                'queue_id': queue_id,
+                **{name: pending[queue_id][name] for name in names},
+                'target_runtime': (pending[queue_id]['runtime_sum'] / count) if (count := pending[queue_id]['runtime_count']) else None
+            }
+            for queue_id in sorted(pending)
+        ]
+        rows = [row for row in rows if any(row[name] for name in names) or (row['target_runtime'] is not None)]
+        if not rows:
+            return
+
+        stmt = pg_insert(QueueStats).values(rows)
+        # runtime moving average, takes over new or current value if the other one is not known
+        target_runtime = func.coalesce(
+            QueueStatsMixin.RUNTIME_WEIGHT * stmt.excluded.target_runtime + (1 - QueueStatsMixin.RUNTIME_WEIGHT) * QueueStats.target_runtime,
+            stmt.excluded.target_runtime,
+            QueueStats.target_runtime
+        )
+        session.connection().execute(
+            stmt.on_conflict_do_update(
+                index_elements=[QueueStats.queue_id],
+                set_={**{name: getattr(QueueStats, name) + getattr(stmt.excluded, name) for name in names}, 'target_runtime': target_runtime}
+            )
+        )
+
+        # wake up waiting assignments, notification is delivered on commit
+        if any(row['nr_readynets'] > 0 for row in rows):
+            session.connection().execute(select(func.pg_notify(SCHEDULER_READY_CHANNEL, '')))
+
+    @staticmethod
+    def stats_discard(session, previous_transaction):  # pylint: disable=unused-argument
+        """discard pending queue stats changes on rollback"""
+
+        session.info.pop('queue_stats', None)
+
+
+event.listen(db.session, 'before_commit', QueueStatsMixin.stats_write)
+event.listen(db.session, 'after_soft_rollback', QueueStatsMixin.stats_discard)
@@ -13,7 +13,7 @@ from sner.server.auth.core import session_required
 from sner.server.extensions import db
 from sner.server.scheduler.core import QueueManager
 from sner.server.scheduler.forms import QueueEnqueueForm, QueueForm
-from sner.server.scheduler.models import Job, Queue, Target
+from sner.server.scheduler.models import Job, Queue, QueueStats
 from sner.server.scheduler.views import blueprint
 from sner.server.utils import filter_query, error_response
 
@@ -23,22 +23,22 @@ from sner.server.utils import filter_query, error_response
 def queue_list_json_route():
     """list queues, data endpoint"""
 
-    query_nr_targets = db.session.query(Target.queue_id, func.count(Target.id).label('cnt')).group_by(Target.queue_id).subquery()
     query_nr_jobs = db.session.query(Job.queue_id, func.count(Job.id).label('cnt')).group_by(Job.queue_id).subquery()
     columns = [
         ColumnDT(Queue.id, mData='id'),
         ColumnDT(Queue.name, mData='name'),
         ColumnDT(Queue.config, mData='config'),
         ColumnDT(Queue.group_size, mData='group_size'),
+        ColumnDT(Queue.group_size_effective, mData='group_size_effective', global_search=False),
         ColumnDT(Queue.priority, mData='priority'),
         ColumnDT(Queue.active, mData='active'),
         ColumnDT(Queue.reqs, mData='reqs'),
-        ColumnDT(func.coalesce(query_nr_targets.c.cnt, 0), mData='nr_targets', global_search=False),
+        ColumnDT(func.coalesce(QueueStats.nr_targets, 0), mData='nr_targets', global_search=False),
         ColumnDT(func.coalesce(query_nr_jobs.c.cnt, 0), mData='nr_jobs', global_search=False),
         ColumnDT(literal_column('1'), mData='_buttons', search_method='none', global_search=False)
     ]
     query = db.session.query().select_from(Queue) \
-        .outerjoin(query_nr_targets, Queue.id == query_nr_targets.c.queue_id) \
+        .outerjoin(QueueStats) \
         .outerjoin(query_nr_jobs, Queue.id == query_nr_jobs.c.queue_id)
     if not (query := filter_query(query, request.values.get('filter'))):
         return jsonify({'message': 'Failed to filter query'}), HTTPStatus.BAD_REQUEST
@@ -60,6 +60,11 @@ def queue_json_route(queue_id):
         "config": queue.config,
         "priority": queue.priority,
         "group_size": queue.group_size,
+        "group_runtime": queue.group_runtime,
+        "group_size_min": queue.group_size_min,
+        "group_size_max": queue.group_size_max,
+        "group_size_effective": queue.group_size_effective,
+        "target_runtime": queue.stats.target_runtime if queue.stats else None,
         "active": queue.active,
         "reqs": queue.reqs
         })
@@ -15,6 +15,7 @@ from sner.lib import format_host_address
 from sner.server.extensions import db
 from sner.server.parser import REGISTERED_PARSERS
 from sner.server.storage.core import StorageManager, vuln_export, vuln_report
+from sner.server.storage.dedupe import dedupe_storage
 from sner.server.storage.models import Host, Service, Versioninfo, Vulnsearch
 from sner.server.storage.versioninfo import VersioninfoManager
 from sner.server.storage.vulnsearch import VulnsearchManager
@@ -74,6 +75,20 @@ def storage_flush():
     db.session.commit()
 
 
+@command.command(name='dedupe', help='merge storage items duplicate by natural key')
+@with_appcontext
+@click.option('--dry', is_flag=True, help='do not update database, only print number of duplicates')
+def storage_dedupe(**kwargs):
+    """merge duplicate storage items"""
+
+    counts = dedupe_storage(db.session.connection(), kwargs.get('dry'))
+    if kwargs.get('dry'):
+        db.session.rollback()
+    else:
+        db.session.commit()
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+
+
 @command.command(name='vuln-report', help='generate vulnerabilities report')
 @with_appcontext
 @click.option('--filter', help='filter query')
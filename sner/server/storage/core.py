@@ -3,7 +3,7 @@
 scheduler module functions
 """
 
-import json
+from collections import Counter, defaultdict
 from csv import DictWriter, QUOTE_ALL
 from datetime import datetime, timedelta
 from http import HTTPStatus
@@ -12,15 +12,16 @@ from typing import Union
 
 from flask import current_app
 from pytimeparse import parse as timeparse
-from sqlalchemy import case, cast, delete, func, or_, not_, select, update
+from sqlalchemy import case, cast, delete, exists, func, or_, not_, select, true, update
 from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY
 from sqlalchemy.sql.functions import coalesce
 
 from sner.lib import format_host_address
 from sner.server.extensions import db
 from sner.server.storage.forms import AnnotateForm
+from sner.server.storage.importer import StorageImporter
 from sner.server.storage.models import Host, Note, Service, Vuln
-from sner.server.utils import filter_query, windowed_query, error_response
+from sner.server.utils import filter_query, error_response
 
 
 def get_related_models(model_name, model_id):
@@ -293,177 +294,32 @@ def vuln_export(qfilter=None):
     return output_buffer.getvalue()
 
 
-def db_host(address, flag_required=False):
-    """query upsert host object"""
-
-    query = Host.query.filter(Host.address == address)
-    return query.one() if flag_required else query.one_or_none()
-
-
-def db_service(host_address, proto, port, flag_required=False):
-    """query upsert service object"""
-
-    query = Service.query.outerjoin(Host).filter(Host.address == host_address, Service.proto == proto, Service.port == port)
-    return query.one() if flag_required else query.one_or_none()
-
-
-def db_vuln(host_address, name, xtype, service_proto=None, service_port=None, via_target=None):  # pylint: disable=too-many-arguments
-    """query upsert vuln object"""
-
-    query = Vuln.query.outerjoin(Host, Vuln.host_id == Host.id).outerjoin(Service, Vuln.service_id == Service.id).filter(
-        Host.address == host_address,
-        Vuln.name == name,
-        Vuln.xtype == xtype,
-        Service.proto == service_proto,
-        Service.port == service_port,
-        Vuln.via_target == via_target
-    )
-    return query.one_or_none()
-
-
-def db_note(host_address, xtype, service_proto=None, service_port=None, via_target=None):
-    """query upsert note object"""
-
-    query = Note.query.outerjoin(Host, Note.host_id == Host.id).outerjoin(Service, Note.service_id == Service.id).filter(
-        Host.address == host_address,
-        Note.xtype == xtype,
-        Service.proto == service_proto,
-        Service.port == service_port,
-        Note.via_target == via_target
-    )
-    return query.one_or_none()
-
-
 class StorageManager:
     """storage app logic"""
 
     @staticmethod
     def import_parsed_dry(pidb):
-        """check pidb for new storage items"""
-
-        for ihost in pidb.hosts:
-            host = db_host(ihost.address)
-            if not host:
-                print(f'storage update new host: {ihost}')
-
-        for iservice in pidb.services:
-            service = db_service(pidb.hosts.by.iid[iservice.host_iid].address, iservice.proto, iservice.port)
-            if not service:
-                print(f'storage update new service: {iservice}')
-
-        for ivuln in pidb.vulns:
-            service = pidb.services.by.iid[ivuln.service_iid] if (ivuln.service_iid is not None) else None
-            vuln = db_vuln(
-                pidb.hosts.by.iid[ivuln.host_iid].address,
-                ivuln.name,
-                ivuln.xtype,
-                service.proto if service else None,
-                service.port if service else None,
-                ivuln.via_target
-            )
-            if not vuln:
-                print(f'storage update new vuln: {ivuln}')
-
-        for inote in pidb.notes:
-            service = pidb.services.by.iid[inote.service_iid] if (inote.service_iid is not None) else None
-            note = db_note(
-                pidb.hosts.by.iid[inote.host_iid].address,
-                inote.xtype,
-                service.proto if service else None,
-                service.port if service else None,
-                inote.via_target
-            )
-            if not note:
-                print(f'storage update new note: {inote}')
+        """check pidb for new and changed storage items, see sner.server.storage.importer.StorageImporter"""
 
-    @staticmethod
-    def import_parsed(pidb, addtags=None):  # pylint: disable=too-many-branches
-        """import"""
-
-        # import hosts
-        for ihost in pidb.hosts:
-            host = db_host(ihost.address)
-            if not host:
-                host = Host(address=ihost.address)
-                db.session.add(host)
-                current_app.logger.info(f'storage update new host {host}')
-            host.update(ihost)
-            if addtags:
-                tag_add(host, addtags)
-
-            if ihost.hostnames:
-                note = db_note(ihost.address, 'hostnames')
-                if not note:
-                    note = Note(host=host, xtype='hostnames', data='[]')
-                    db.session.add(note)
-                note.data = json.dumps(list(set(json.loads(note.data) + ihost.hostnames)))
-        db.session.commit()
+        counts = defaultdict(Counter)
+        for name, status, item in StorageImporter().run_dry(pidb):
+            counts[name][status] += 1
+            if status != 'unchanged':
+                print(f'storage update {status} {name}: {item}')
 
-        # import services
-        for iservice in pidb.services:
-            host = db_host(pidb.hosts.by.iid[iservice.host_iid].address, flag_required=True)
-            service = db_service(host.address, iservice.proto, iservice.port)
-            if not service:
-                service = Service(host=host, proto=iservice.proto, port=iservice.port)
-                db.session.add(service)
-                current_app.logger.info(f'storage update new service {service}')
-            service.update(iservice)
-            if addtags:
-                tag_add(service, addtags)
-        db.session.commit()
+        for name, name_counts in counts.items():
+            print(f'storage import {name}, ' + ', '.join(f'{status} {name_counts[status]}' for status in StorageImporter.STATUSES))
 
-        # import vulns
-        for ivuln in pidb.vulns:
-            host = db_host(pidb.hosts.by.iid[ivuln.host_iid].address, flag_required=True)
-            service = (
-                db_service(
-                    host.address,
-                    pidb.services.by.iid[ivuln.service_iid].proto,
-                    pidb.services.by.iid[ivuln.service_iid].port,
-                    flag_required=True
-                )
-                if ivuln.service_iid is not None
-                else None
-            )
-            vuln = db_vuln(
-                host.address,
-                ivuln.name,
-                ivuln.xtype,
-                service.proto if service else None,
-                service.port if service else None,
-                ivuln.via_target
-            )
-            if not vuln:
-                vuln = Vuln(host=host, name=ivuln.name, xtype=ivuln.xtype, service=service, via_target=ivuln.via_target)
-                db.session.add(vuln)
-                current_app.logger.info(f'storage update new vuln {vuln}')
-            vuln.update(ivuln)
-            if addtags:
-                tag_add(vuln, addtags)
-        db.session.commit()
+    @staticmethod
+    def import_parsed(pidb, addtags=None):
+        """
+        import parsed items in bulk, see sner.server.storage.importer.StorageImporter
 
-        # import notes
-        for inote in pidb.notes:
-            host = db_host(pidb.hosts.by.iid[inote.host_iid].address, flag_required=True)
-            service = (
-                db_service(
-                    host.address,
-                    pidb.services.by.iid[inote.service_iid].proto,
-                    pidb.services.by.iid[inote.service_iid].port,
-                    flag_required=True
-                )
-                if inote.service_iid is not None
-                else None
-            )
-            note = db_note(host.address, inote.xtype, service.proto if service else None, service.port if service else None, inote.via_target)
-            if not note:
-                note = Note(host=host, xtype=inote.xtype, service=service, via_target=inote.via_target)
-                db.session.add(note)
-                current_app.logger.info(f'storage update new note {note}')
-            note.update(inote)
-            if addtags:
-                tag_add(note, addtags)
-        db.session.commit()
+        :return: counts of new, changed and unchanged items per entity type
+        :rtype: dict
+        """
+
+        return StorageImporter(addtags).run(pidb)
 
     @staticmethod
     def get_all_six_address():
@@ -472,91 +328,109 @@ class StorageManager:
         return db.session.connection().execute(select(Host.address).filter(func.family(Host.address) == 6)).scalars().all()
 
     @staticmethod
-    def get_rescan_hosts(interval):
-        """rescan hosts from storage; discovers new services on hosts"""
+    def rescan_due(model, interval, limit=None):
+        """
+        filter items due to rescan
+
+        :param limit: at most limit of the most overdue items are selected
+        """
 
-        now = datetime.utcnow()
-        rescan_horizont = now - timedelta(seconds=timeparse(interval))
-        query = Host.query.filter(or_(Host.rescan_time < rescan_horizont, Host.rescan_time == None))  # noqa: E501, E711  pylint: disable=singleton-comparison
+        rescan_horizont = datetime.utcnow() - timedelta(seconds=timeparse(interval))
+        due = or_(model.rescan_time < rescan_horizont, model.rescan_time == None)  # noqa: E711  pylint: disable=singleton-comparison
+        if limit:
+            return model.id.in_(select(model.id).filter(due).order_by(model.rescan_time.asc().nulls_first()).limit(limit).scalar_subquery())
+        return due
 
-        rescan, ids = [], []
-        for host in windowed_query(query, Host.id):
-            rescan.append(host.address)
-            ids.append(host.id)
+    @staticmethod
+    def get_rescan_hosts(interval, limit=None):
+        """rescan hosts from storage; discovers new services on hosts"""
 
-        # orm is bypassed for performance reasons in case of large rescans
-        db.session.connection().execute(update(Host).where(Host.id.in_(ids)).values(rescan_time=now))
+        # orm is bypassed for performance reasons in case of large rescans, items are selected and marked by single statement
+        rescan = db.session.connection().execute(
+            update(Host)
+            .where(StorageManager.rescan_due(Host, interval, limit))
+            .values(rescan_time=datetime.utcnow())
+            .returning(Host.address)
+        ).scalars().all()
         db.session.commit()
         db.session.expire_all()
 
         return rescan
 
     @staticmethod
-    def get_rescan_services(interval):
+    def get_rescan_services(interval, limit=None):
         """rescan services from storage; update known services info"""
 
-        now = datetime.utcnow()
-        rescan_horizont = now - timedelta(seconds=timeparse(interval))
-        query = Service.query.filter(or_(Service.rescan_time < rescan_horizont, Service.rescan_time == None))  # noqa: E501,E711  pylint: disable=singleton-comparison
-
-        rescan, ids = [], []
-        for service in windowed_query(query, Service.id):
-            item = f'{service.proto}://{format_host_address(service.host.address)}:{service.port}'
-            rescan.append(item)
-            ids.append(service.id)
-
-        # orm is bypassed for performance reasons in case of large rescans
-        db.session.connection().execute(update(Service).where(Service.id.in_(ids)).values(rescan_time=now))
+        # orm is bypassed for performance reasons in case of large rescans, items are selected and marked by single statement
+        rescan = [
+            f'{service.proto}://{format_host_address(service.address)}:{service.port}'
+            for service in db.session.connection().execute(
+                update(Service)
+                .where(Service.host_id == Host.id, StorageManager.rescan_due(Service, interval, limit))
+                .values(rescan_time=datetime.utcnow())
+                .returning(Service.proto, Host.address, Service.port)
+            )
+        ]
         db.session.commit()
         db.session.expire_all()
 
         return rescan
 
     @staticmethod
-    def cleanup_storage():
-        """clean up storage from various import artifacts"""
+    def cleanup_storage(since=None, log_items=True):
+        """
+        clean up storage from various import artifacts
+
+        * any but open:* state services are removed
+        * hosts without any data attribute, service, vuln or note are removed, the only note allowed is the hostnames one
+        * cleanup runs as server-side anti-join deletes, optionally only for items touched since given time;
+          hosts are touched by modification or by removal of their services
+
+        :param since: process only items modified since the time
+        :param log_items: log each removed item
+        :return: counts of removed services and hosts
+        :rtype: dict
+        """
         # bypassing ORM for performance reasons
         conn = db.session.connection()
 
-        # remove any but open:* state services
-        services_to_delete = conn.execute(select(
-            Service.id,
-            Service.proto,
-            Service.port,
-            Host.address.label('host_address')
-        ).join(Host).filter(not_(Service.state.ilike('open:%')))).all()
-        for service in services_to_delete:
-            current_app.logger.info(
-                    'storage update delete service '
-                    f'<Service {service.id}: {format_host_address(service.host_address)} {service.proto}.{service.port}>'
+        services = conn.execute(
+            delete(Service)
+            .where(
+                Service.host_id == Host.id,
+                not_(Service.state.ilike('open:%')),
+                (Service.modified >= since) if since else true()
             )
-        conn.execute(delete(Service).filter(Service.id.in_([x[0] for x in services_to_delete])))
-
-        # remove hosts without any data attribute, service, vuln or note
-        hosts_noinfo = conn.execute(
-            select(Host.id).filter(or_(Host.os == '', Host.os == None), or_(Host.comment == '', Host.comment == None))  # noqa: E501,E711  pylint: disable=singleton-comparison
-        ).scalars().all()
-        hosts_noservices = conn.execute(
-            select(Host.id).outerjoin(Service).having(func.count(Service.id) == 0).group_by(Host.id)
-        ).scalars().all()
-        hosts_novulns = conn.execute(select(Host.id).outerjoin(Vuln).having(func.count(Vuln.id) == 0).group_by(Host.id)).scalars().all()
-        hosts_nonotes = conn.execute(select(Host.id).outerjoin(Note).having(func.count(Note.id) == 0).group_by(Host.id)).scalars().all()
-
-        hosts_to_delete = list(set(hosts_noinfo) & set(hosts_noservices) & set(hosts_novulns) & set(hosts_nonotes))
-        for host in conn.execute(select(Host.id, Host.address, Host.hostname).filter(Host.id.in_(hosts_to_delete))).all():
-            current_app.logger.info(f'storage update delete host <Host {host.id}: {host.address} {host.hostname}>')
-        conn.execute(delete(Host).filter(Host.id.in_(hosts_to_delete)))
-
-        # also remove all hosts not having any info but one note xtype hostnames
-        hosts_only_one_note = conn.execute(select(Host.id).outerjoin(Note).having(func.count(Note.id) == 1).group_by(Host.id)).scalars().all()
-        hosts_only_note_hostnames = conn.execute(
-            select(Host.id).join(Note).filter(Host.id.in_(hosts_only_one_note), Note.xtype == 'hostnames')
-        ).scalars().all()
-
-        hosts_to_delete = list(set(hosts_noinfo) & set(hosts_noservices) & set(hosts_novulns) & set(hosts_only_note_hostnames))
-        for host in conn.execute(select(Host.id, Host.address, Host.hostname).filter(Host.id.in_(hosts_to_delete))).all():
-            current_app.logger.info(f'storage update delete host <Host {host.id}: {host.address} {host.hostname}>')
-        conn.execute(delete(Host).filter(Host.id.in_(hosts_to_delete)))
+            .returning(Service.id, Service.proto, Service.port, Service.host_id, Host.address.label('host_address'))
+        ).all()
+
+        notes_count = select(func.count(Note.id)).filter(Note.host_id == Host.id).scalar_subquery()
+        services_host_ids = cast(sorted({x.host_id for x in services}), pg_ARRAY(db.Integer))
+        hosts = conn.execute(
+            delete(Host)
+            .where(
+                func.coalesce(Host.os, '') == '',
+                func.coalesce(Host.comment, '') == '',
+                ~exists().where(Service.host_id == Host.id),
+                ~exists().where(Vuln.host_id == Host.id),
+                ~exists().where(Note.host_id == Host.id, Note.xtype.is_distinct_from('hostnames')),
+                notes_count <= 1,
+                or_(Host.modified >= since, Host.id == func.any(services_host_ids)) if since else true()
+            )
+            .returning(Host.id, Host.address, Host.hostname)
+        ).all()
 
         db.session.commit()
         db.session.expire_all()
+
+        if log_items:
+            for service in services:
+                current_app.logger.info(
+                    'storage update delete service '
+                    f'<Service {service.id}: {format_host_address(service.host_address)} {service.proto}.{service.port}>'
+                )
+            for host in hosts:
+                current_app.logger.info(f'storage update delete host <Host {host.id}: {host.address} {host.hostname}>')
+        current_app.logger.info(f'storage cleanup deleted {len(services)} services, {len(hosts)} hosts')
+
+        return {'services': len(services), 'hosts': len(hosts)}
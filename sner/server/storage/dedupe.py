@@ -0,0 +1,113 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+storage natural-key deduplication
+
+Storage had no natural-key constraints before, so duplicate hosts, services, vulns and notes might exist in the
+database. Duplicates must be merged before the constraints are enforced, the constraints migration carries its own
+frozen copy of the procedure.
+"""
+
+from sqlalchemy import delete, func, Integer, select, union, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+
+from sner.server.storage.models import Host, Note, Service, Vuln
+
+
+NATURAL_KEYS = {
+    Host: ['address'],
+    Service: ['host_id', 'proto', 'port'],
+    Vuln: ['host_id', 'service_id', 'name', 'xtype', 'via_target'],
+    Note: ['host_id', 'service_id', 'xtype', 'via_target']
+}
+
+
+def natural_key(model, columns=None):
+    """
+    null-safe natural key expressions of storage model, must correspond with model unique indexes
+
+    :param columns: column collection named as model columns (eg. subquery.c) to build the key of, defaults to model table
+    """
+
+    columns = model.__table__.c if columns is None else columns
+    key = []
+    for name in NATURAL_KEYS[model]:
+        column = model.__table__.c[name]
+        if column.nullable:
+            key.append(func.coalesce(columns[name], 0 if isinstance(column.type, Integer) else ''))
+        else:
+            key.append(columns[name])
+    return key
+
+
+def dedupe_model(conn, model, fields, children, dry_run=False):
+    """
+    merge duplicates of storage model
+
+    * the oldest item (lowest id) of each natural-key group is kept
+    * empty fields of kept item are filled with values of the newest duplicate having the field set
+    * tags are merged, child items are moved to the kept item
+    * duplicates are deleted
+
+    :param fields: fields merged from duplicates
+    :param children: list of (child model, foreign key column name) referencing deduplicated model
+    :return: number of removed duplicates
+    :rtype: int
+    """
+
+    ranked = select(model.id, func.min(model.id).over(partition_by=natural_key(model)).label('keep_id')).subquery()
+    dups = select(ranked.c.id, ranked.c.keep_id).filter(ranked.c.id != ranked.c.keep_id).subquery()
+
+    if dry_run:
+        return conn.execute(select(func.count()).select_from(dups)).scalar()
+
+    # fill empty fields of kept items
+    newest = (
+        select(
+            dups.c.keep_id,
+            *[
+                array_agg(aggregate_order_by(getattr(model, field), model.id.desc()))
+                .filter(getattr(model, field) != None)[1]  # noqa: E711  pylint: disable=singleton-comparison
+                .label(field)
+                for field in fields
+            ]
+        )
+        .join(model, model.id == dups.c.id)
+        .group_by(dups.c.keep_id)
+        .subquery()
+    )
+    conn.execute(
+        update(model)
+        .where(model.id == newest.c.keep_id)
+        .values({field: func.coalesce(getattr(model, field), newest.c[field]) for field in fields})
+    )
+
+    # merge tags of kept items
+    tags = union(*[
+        select(dups.c.keep_id, func.unnest(model.tags).label('tag')).join(model, model.id == member_id)
+        for member_id in [dups.c.id, dups.c.keep_id]
+    ]).subquery()
+    merged_tags = select(tags.c.keep_id, func.array_agg(tags.c.tag).label('tags')).group_by(tags.c.keep_id).subquery()
+    conn.execute(update(model).where(model.id == merged_tags.c.keep_id).values(tags=merged_tags.c.tags))
+
+    for child, column in children:
+        conn.execute(update(child).where(getattr(child, column) == dups.c.id).values({column: dups.c.keep_id}))
+
+    return conn.execute(delete(model).where(model.id == dups.c.id)).rowcount
+
+
+def dedupe_storage(conn, dry_run=False):
+    """
+    merge duplicates of all storage models, children are processed after their parents
+
+    :return: number of removed duplicates per model
+    :rtype: dict
+    """
+
+    return {
+        'hosts': dedupe_model(conn, Host, ['hostname', 'os', 'comment'], [(Service, 'host_id'), (Vuln, 'host_id'), (Note, 'host_id')], dry_run),
+        'services': dedupe_model(
+            conn, Service, ['state', 'name', 'info', 'comment', 'import_time'], [(Vuln, 'service_id'), (Note, 'service_id')], dry_run
+        ),
+        'vulns': dedupe_model(conn, Vuln, ['descr', 'data', 'comment', 'import_time'], [], dry_run),
+        'notes': dedupe_model(conn, Note, ['data', 'comment', 'import_time'], [], dry_run)
+    }
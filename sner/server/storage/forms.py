@@ -28,10 +28,27 @@ def service_id_exists_and_belongs_to_host(form, field):  # pylint: disable=unuse
             raise ValidationError('Service does not belong to the host')
 
 
+def host_address_unique(form, field):  # pylint: disable=unused-argument
+    """validate submitted address is not used by other host"""
+
+    if (field.data != field.object_data) and Host.query.filter(Host.address == field.data).one_or_none():
+        raise ValidationError('Host already exists')
+
+
+def service_endpoint_unique(form, field):  # pylint: disable=unused-argument
+    """validate submitted host_id, proto and port are not used by other service"""
+
+    endpoint = [form.host_id, form.proto, form.port]
+    if [item.data for item in endpoint] == [item.object_data for item in endpoint]:
+        return
+    if Service.query.filter(Service.host_id == form.host_id.data, Service.proto == form.proto.data, Service.port == field.data).one_or_none():
+        raise ValidationError('Service already exists')
+
+
 class HostForm(FlaskForm):
     """host edit form"""
 
-    address = StringNoneField('Address', [InputRequired(), IPAddress(ipv4=True, ipv6=True)])
+    address = StringNoneField('Address', [InputRequired(), IPAddress(ipv4=True, ipv6=True), host_address_unique])
     hostname = StringNoneField('Hostname', [Length(max=256)])
     os = StringNoneField('Os')
     tags = TextAreaListField('Tags', render_kw={'class': 'form-control tageditor'})
@@ -44,7 +61,7 @@ class ServiceForm(FlaskForm):
 
     host_id = IntegerField('Host_id', [InputRequired(), host_id_exists])
     proto = StringNoneField('Proto', [InputRequired(), Length(min=1, max=250)])
-    port = IntegerField('Port', [InputRequired(), NumberRange(min=0, max=65535)])
+    port = IntegerField('Port', [InputRequired(), NumberRange(min=0, max=65535), service_endpoint_unique])
     state = StringNoneField('State', [Length(max=250)])
     name = StringNoneField('Name', [Length(max=250)])
     info = StringNoneField('Info')
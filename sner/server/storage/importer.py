@@ -0,0 +1,361 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+storage bulk import engine
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, case, cast, Column, func, insert, Integer, literal, MetaData, or_, select, Table, true, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY, insert as pg_insert
+
+from sner.lib import format_host_address
+from sner.server.extensions import db
+from sner.server.storage.dedupe import NATURAL_KEYS, natural_key
+from sner.server.storage.models import Host, Note, Service, Vuln
+
+
+class StorageImporter:
+    """
+    bulk import of parsed items into storage
+
+    * parsed items are staged per entity type into temporary tables
+    * natural keys (host address; service host, proto and port; vuln host, service, name, xtype and via_target;
+      note host, service, xtype and via_target) are resolved by set-based joins
+    * each staged item is classified as new, changed or unchanged by comparing content fingerprint of merged values
+      with fingerprint of the existing row, volatile fields (import_time) are not part of the fingerprint
+    * only new rows are inserted and only changed rows are updated, unchanged rows get only volatile fields refreshed
+    * merge rules of StorageModelBase.update holds, empty values never overwrite existing ones
+    * addtags and host hostnames are merged with existing lists
+    * whole import is commited in single transaction, counts of new, changed and unchanged items are reported
+    """
+
+    HOST_FIELDS = ['hostname', 'os']
+    SERVICE_FIELDS = ['state', 'name', 'info', 'import_time']
+    VULN_KEYS = ['name', 'xtype', 'via_target']
+    VULN_FIELDS = ['severity', 'descr', 'data', 'refs', 'import_time']
+    NOTE_KEYS = ['xtype', 'via_target']
+    NOTE_FIELDS = ['data', 'import_time']
+    VOLATILE_FIELDS = ['import_time']
+    STATUSES = ['new', 'changed', 'unchanged']
+
+    def __init__(self, addtags=None):
+        self.addtags = sorted(set(addtags or []))
+        self.now = datetime.utcnow()
+        self.conn = None
+
+    def run(self, pidb):
+        """
+        import parsed items db
+
+        :return: counts of new, changed and unchanged items per entity type
+        :rtype: dict
+        """
+
+        self.conn = db.session.connection()
+        counts = {}
+        for name, model, source, fields in self.sources(pidb):
+            counts[name] = self.upsert(model, source, fields)
+            if model is Host:
+                self.merge_hostnames(source)
+        db.session.commit()
+        db.session.expire_all()
+
+        for name, entity_counts in counts.items():
+            current_app.logger.info(f'storage import {name}, ' + ', '.join(f'{status} {entity_counts[status]}' for status in self.STATUSES))
+        return counts
+
+    def run_dry(self, pidb):
+        """
+        classify parsed items without updating storage
+
+        :return: list of (entity type name, status, parsed item)
+        :rtype: list
+        """
+
+        self.conn = db.session.connection()
+        sources = self.sources(pidb)
+        diffs = union_all(*[
+            select(literal(name).label('name'), diff.c.iid, diff.c.status)
+            for name, diff in [(name, self.diff(model, source, fields)) for name, model, source, fields in sources]
+        ])
+        items = {'host': pidb.hosts, 'service': pidb.services, 'vuln': pidb.vulns, 'note': pidb.notes}
+        result = [(row.name, row.status, items[row.name].by.iid[row.iid]) for row in self.conn.execute(diffs).all()]
+        db.session.rollback()
+        return result
+
+    @staticmethod
+    def model_columns(model, names, prefix=''):
+        """staging columns typed as model columns"""
+
+        return [Column(f'{prefix}{name}', model.__table__.c[name].type) for name in names]
+
+    @staticmethod
+    def empty_to_none(value):
+        """empty values are staged as null, so they never overwrite existing ones"""
+
+        return value if value else None
+
+    @staticmethod
+    def fingerprint(values):
+        """content fingerprint of row values"""
+
+        return func.md5(cast(tuple_(*values), db.Text))
+
+    def stage(self, name, columns, rows):
+        """create temporary staging table and load rows"""
+
+        staging = Table(name, MetaData(), Column('iid', Integer), *columns, prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+        staging.create(self.conn, checkfirst=True)
+        if rows:
+            self.conn.execute(insert(staging), rows)
+        return staging
+
+    def sources(self, pidb):
+        """
+        stage parsed items and resolve natural keys
+
+        :return: list of (entity type name, model, source subquery, fields) in import order, source subquery
+                 provides parsed item iid, natural key, fields and resolved flag
+        :rtype: list
+        """
+
+        return [
+            ('host', Host, self.stage_hosts(pidb), self.HOST_FIELDS),
+            ('service', Service, self.stage_services(pidb), self.SERVICE_FIELDS),
+            ('vuln', Vuln, self.stage_endpoint_items('vuln_staging', Vuln, pidb.vulns, pidb, self.VULN_KEYS, self.VULN_FIELDS), self.VULN_FIELDS),
+            ('note', Note, self.stage_endpoint_items('note_staging', Note, pidb.notes, pidb, self.NOTE_KEYS, self.NOTE_FIELDS), self.NOTE_FIELDS)
+        ]
+
+    def stage_hosts(self, pidb):
+        """stage hosts"""
+
+        staging = self.stage(
+            'host_staging',
+            [*self.model_columns(Host, ['address'] + self.HOST_FIELDS), Column('hostnames', pg_ARRAY(db.String))],
+            [
+                {
+                    'iid': ihost.iid,
+                    'address': ihost.address,
+                    **{field: self.empty_to_none(getattr(ihost, field)) for field in self.HOST_FIELDS},
+                    'hostnames': self.empty_to_none(ihost.hostnames)
+                }
+                for ihost in pidb.hosts
+            ]
+        )
+        return select(staging, true().label('resolved')).subquery()
+
+    def stage_services(self, pidb):
+        """stage services"""
+
+        staging = self.stage(
+            'service_staging',
+            self.model_columns(Host, ['address']) + self.model_columns(Service, ['proto', 'port'] + self.SERVICE_FIELDS),
+            [
+                {
+                    'iid': iservice.iid,
+                    'address': pidb.hosts.by.iid[iservice.host_iid].address,
+                    'proto': iservice.proto,
+                    'port': iservice.port,
+                    **{field: self.empty_to_none(getattr(iservice, field)) for field in self.SERVICE_FIELDS}
+                }
+                for iservice in pidb.services
+            ]
+        )
+        return (
+            select(
+                staging.c.iid,
+                Host.id.label('host_id'),
+                *[staging.c[column] for column in ['address', 'proto', 'port'] + self.SERVICE_FIELDS],
+                (Host.id != None).label('resolved')  # noqa: E711  pylint: disable=singleton-comparison
+            )
+            .select_from(staging)
+            .outerjoin(Host, Host.address == staging.c.address)
+            .subquery()
+        )
+
+    def stage_endpoint_items(self, name, model, items, pidb, keys, fields):  # pylint: disable=too-many-arguments
+        """stage vulns or notes along with host address and service natural keys, resolve host and service ids"""
+
+        rows = []
+        for item in items:
+            service = pidb.services.by.iid[item.service_iid] if (item.service_iid is not None) else None
+            rows.append({
+                'iid': item.iid,
+                'address': pidb.hosts.by.iid[item.host_iid].address,
+                'service_proto': service.proto if service else None,
+                'service_port': service.port if service else None,
+                **{key: getattr(item, key) for key in keys},
+                **{field: self.empty_to_none(getattr(item, field)) for field in fields}
+            })
+
+        columns = [
+            *self.model_columns(Host, ['address']),
+            *self.model_columns(Service, ['proto', 'port'], prefix='service_'),
+            *self.model_columns(model, keys + fields)
+        ]
+        staging = self.stage(name, columns, rows)
+
+        return (
+            select(
+                staging.c.iid,
+                Host.id.label('host_id'),
+                Service.id.label('service_id'),
+                *[staging.c[column] for column in keys + fields],
+                and_(
+                    Host.id != None,  # noqa: E711  pylint: disable=singleton-comparison
+                    or_(staging.c.service_port == None, Service.id != None)  # noqa: E711  pylint: disable=singleton-comparison
+                ).label('resolved')
+            )
+            .select_from(staging)
+            .outerjoin(Host, Host.address == staging.c.address)
+            .outerjoin(Service, and_(
+                Service.host_id == Host.id,
+                Service.proto == staging.c.service_proto,
+                Service.port == staging.c.service_port
+            ))
+            .subquery()
+        )
+
+    def addtags_array(self):
+        """addtags array literal"""
+
+        return cast(self.addtags, pg_ARRAY(db.String))
+
+    def diff(self, model, source, fields):
+        """
+        classify source items as new, changed or unchanged
+
+        :return: subquery of source columns, existing row id and status
+        """
+
+        content_fields = [field for field in fields if field not in self.VOLATILE_FIELDS]
+        merged = [func.coalesce(source.c[field], getattr(model, field)) for field in content_fields]
+        changed = self.fingerprint(merged) != self.fingerprint([getattr(model, field) for field in content_fields])
+        if self.addtags:
+            changed = or_(changed, ~model.tags.contains(self.addtags_array()))
+
+        return (
+            select(
+                source,
+                model.id.label('existing_id'),
+                case(
+                    (model.id == None, 'new'),  # noqa: E711  pylint: disable=singleton-comparison
+                    (changed, 'changed'),
+                    else_='unchanged'
+                ).label('status')
+            )
+            .select_from(source)
+            .outerjoin(model, and_(source.c.resolved, *[a == b for a, b in zip(natural_key(model), natural_key(model, source.c))]))
+            .subquery()
+        )
+
+    def upsert(self, model, source, fields):
+        """
+        insert new and update changed rows of model from resolved source, log new items
+
+        :return: counts of new, changed and unchanged items
+        :rtype: dict
+        """
+
+        counts = dict.fromkeys(self.STATUSES, 0)
+        diff = self.diff(model, source, fields)
+        counts.update(self.conn.execute(select(diff.c.status, func.count()).group_by(diff.c.status)).all())
+
+        def insert_value(name):
+            column = model.__table__.c[name]
+            if (column.default is not None) and column.default.is_scalar:
+                return func.coalesce(diff.c[name], cast(column.default.arg, column.type))
+            return diff.c[name]
+
+        # single statement must not affect same row twice
+        columns = NATURAL_KEYS[model] + fields
+        inserted = self.conn.execute(
+            pg_insert(model)
+            .from_select(
+                columns + ['tags', 'created', 'modified'],
+                select(*map(insert_value, columns), self.addtags_array(), literal(self.now), literal(self.now))
+                .filter(diff.c.status == 'new')
+                .distinct(*natural_key(model, diff.c))
+            )
+            .on_conflict_do_nothing()
+            .returning(model.id)
+        ).scalars().all()
+        self.log_new(model, inserted)
+
+        # new rows are seen as unchanged by the update diff
+        merged = {field: func.coalesce(diff.c[field], getattr(model, field)) for field in fields}
+        if self.addtags:
+            merged['tags'] = func.array(select(func.unnest(model.tags.concat(self.addtags_array()))).distinct().scalar_subquery())
+        self.conn.execute(
+            update(model)
+            .where(model.id == diff.c.existing_id, diff.c.status == 'changed')
+            .values(**merged, modified=self.now)
+        )
+
+        # rescans of unchanged items refresh only volatile fields, modified is kept
+        for field in set(fields) & set(self.VOLATILE_FIELDS):
+            self.conn.execute(
+                update(model)
+                .where(model.id == diff.c.existing_id, diff.c.status == 'unchanged')
+                .where(diff.c[field] != None)  # noqa: E711  pylint: disable=singleton-comparison
+                .where(getattr(model, field).is_distinct_from(diff.c[field]))
+                .values({field: diff.c[field], 'modified': model.modified})
+            )
+
+        return counts
+
+    def log_new(self, model, ids):
+        """log new items"""
+
+        if model is Host:
+            for host in self.conn.execute(select(Host.id, Host.address, Host.hostname).filter(Host.id.in_(ids))).all():
+                current_app.logger.info(f'storage update new host <Host {host.id}: {host.address} {host.hostname}>')
+        elif model is Service:
+            services = self.conn.execute(select(Service.id, Service.proto, Service.port, Host.address).join(Host).filter(Service.id.in_(ids)))
+            for service in services.all():
+                current_app.logger.info(
+                    f'storage update new service <Service {service.id}: {format_host_address(service.address)} {service.proto}.{service.port}>'
+                )
+        else:
+            for item in self.conn.execute(select(model.id, model.xtype).filter(model.id.in_(ids))).all():
+                current_app.logger.info(f'storage update new {model.__tablename__} <{model.__name__} {item.id}: {item.xtype}>')
+
+    def merge_hostnames(self, source):
+        """merge hostnames notes, note data is json list merged with the existing one"""
+
+        parsed = (
+            select(Host.id.label('host_id'), func.unnest(source.c.hostnames).label('hostname'))
+            .join(Host, Host.address == source.c.address)
+            .subquery()
+        )
+        existing = (
+            select(Note.host_id, func.json_array_elements_text(cast(Note.data, db.JSON)))
+            .filter(
+                Note.host_id.in_(select(parsed.c.host_id)),
+                Note.xtype == 'hostnames',
+                Note.service_id == None,  # noqa: E711  pylint: disable=singleton-comparison
+                Note.via_target == None  # noqa: E711  pylint: disable=singleton-comparison
+            )
+        )
+        merged = select(parsed).union(existing).subquery()
+
+        stmt = pg_insert(Note).from_select(
+            ['host_id', 'xtype', 'data', 'tags', 'created', 'modified'],
+            select(
+                merged.c.host_id,
+                literal('hostnames'),
+                cast(func.json_agg(merged.c.hostname.distinct()), db.Text),
+                cast([], pg_ARRAY(db.String)),
+                literal(self.now),
+                literal(self.now)
+            )
+            .group_by(merged.c.host_id)
+        )
+        self.conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=natural_key(Note),
+                set_={'data': stmt.excluded.data, 'modified': self.now},
+                where=Note.data.is_distinct_from(stmt.excluded.data)
+            )
+        )
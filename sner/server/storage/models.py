@@ -32,8 +32,10 @@ monitoring.
 
 from datetime import datetime
 
+from sqlalchemy import func
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
+from sqlalchemy.schema import Index
 
 from sner.lib import format_host_address
 from sner.server.extensions import db
@@ -46,11 +48,11 @@ class StorageModelBase(db.Model):
     __abstract__ = True
 
     def update(self, obj):
-        """Update model from data object. Existing values are not overwriten with empty values."""
+        """Update model from data object. Existing values are not overwriten with empty values, unchanged values are not set."""
 
         iterator = obj.__dict__ if hasattr(obj, '__dict__') else obj
         for key, value in iterator.items():
-            if value and hasattr(self, key):
+            if value and hasattr(self, key) and (getattr(self, key) != value):
                 setattr(self, key, value)
 
 
@@ -71,6 +73,11 @@ class Host(StorageModelBase):
     vulns = relationship('Vuln', back_populates='host', cascade='delete,delete-orphan', passive_deletes=True)
     notes = relationship('Note', back_populates='host', cascade='delete,delete-orphan', passive_deletes=True)
 
+    __table_args__ = (
+        Index('host_address', address, unique=True),  # import: natural key
+        Index('host_address_inet', address, postgresql_using='gist', postgresql_ops={'address': 'inet_ops'}),  # api: network restrictions
+    )
+
     def __repr__(self):
         return f'<Host {self.id}: {self.address} {self.hostname}>'
 
@@ -96,6 +103,10 @@ class Service(StorageModelBase):
     vulns = relationship('Vuln', back_populates='service', cascade='delete,delete-orphan', passive_deletes=True)
     notes = relationship('Note', back_populates='service', cascade='delete,delete-orphan', passive_deletes=True)
 
+    __table_args__ = (
+        Index('service_hostid_proto_port', host_id, proto, port, unique=True),  # import: natural key
+    )
+
     def __repr__(self):
         host = format_host_address(self.host.address) if self.host else None
         return f'<Service {self.id}: {host} {self.proto}.{self.port}>'
@@ -135,6 +146,15 @@ class Vuln(StorageModelBase):
     host = relationship('Host', back_populates='vulns')
     service = relationship('Service', back_populates='vulns')
 
+    __table_args__ = (
+        Index(  # import: natural key, nullable parts are coalesced in order to make key null-safe
+            'vuln_hostid_serviceid_name_xtype_viatarget',
+            host_id, func.coalesce(service_id, 0), name, func.coalesce(xtype, ''), func.coalesce(via_target, ''),
+            unique=True
+        ),
+        Index('vuln_serviceid', service_id),  # service delete: cascade
+    )
+
     def __repr__(self):
         host = format_host_address(self.host.address) if self.host else None
         service = f'{self.service.proto}.{self.service.port}' if self.service else None
@@ -159,6 +179,16 @@ class Note(StorageModelBase):
     host = relationship('Host', back_populates='notes')
     service = relationship('Service', back_populates='notes')
 
+    __table_args__ = (
+        Index(  # import: natural key, nullable parts are coalesced in order to make key null-safe
+            'note_hostid_serviceid_xtype_viatarget',
+            host_id, func.coalesce(service_id, 0), func.coalesce(xtype, ''), func.coalesce(via_target, ''),
+            unique=True
+        ),
+        Index('note_serviceid', service_id),  # service delete: cascade
+        Index('note_xtype', xtype),  # versioninfo, vulnsearch: select notes by xtype
+    )
+
     def __repr__(self):
         host = format_host_address(self.host.address) if self.host else None
         service = f'{self.service.proto}.{self.service.port}' if self.service else None
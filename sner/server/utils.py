@@ -5,6 +5,8 @@ misc utils used in server
 
 import datetime
 import json
+import zlib
+from io import BytesIO
 from urllib.parse import urlparse
 from http import HTTPStatus
 
@@ -12,9 +14,10 @@ import yaml
 from flask import current_app, jsonify
 from lark.exceptions import LarkError
 from sqlalchemy_filters import apply_filters
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
+from werkzeug.wsgi import get_input_stream
 
-from sner.server.scheduler.core import ExclFamily
+from sner.server.scheduler.exclusion import ExclFamily
 from sner.server.sqlafilter import FILTER_PARSER
 from sner.server.storage.models import SeverityEnum
 
@@ -119,3 +122,28 @@ def error_response(message, errors=None, code=HTTPStatus.BAD_REQUEST):
             'message': message
         }
     }), code
+
+
+class GzipRequestMiddleware:  # pylint: disable=too-few-public-methods
+    """wsgi middleware decompressing gzip encoded request bodies"""
+
+    def __init__(self, wsgi_app, max_size=16*1024*1024):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = decompressor.decompress(get_input_stream(environ).read(), self.max_size)
+            except zlib.error:
+                return BadRequest('invalid gzip request body')(environ, start_response)
+            if decompressor.unconsumed_tail:
+                return RequestEntityTooLarge()(environ, start_response)
+
+            environ['wsgi.input'] = BytesIO(data)
+            environ['CONTENT_LENGTH'] = str(len(data))
+            environ.pop('HTTP_CONTENT_ENCODING')
+            environ.pop('wsgi.input_terminated', None)
+
+        return self.wsgi_app(environ, start_response)
@@ -4,6 +4,8 @@ agent basic tests
 """
 
 import json
+import os
+import re
 from pathlib import Path
 from uuid import uuid4
 
@@ -12,6 +14,7 @@ from flask import url_for
 from sner.agent.core import main as agent_main
 from sner.lib import file_from_zip
 from sner.server.scheduler.models import Job, Queue
+from tests.agent import xjsonify
 
 
 def test_version(tmpworkdir):  # pylint: disable=unused-argument
@@ -56,3 +59,28 @@ def test_run_with_liveserver(tmpworkdir, live_server, apikey_agent, dummy_target
 
     job = Job.query.filter(Job.queue_id == dummy_target.queue_id).one()
     assert dummy_target.target in file_from_zip(job.output_abspath, 'assignment.json').decode('utf-8')
+
+
+def test_run_slots(tmpworkdir, httpserver):  # pylint: disable=unused-argument
+    """test agent processing assignments concurrently in slots"""
+
+    uploaded = []
+
+    def handler_assign(request):  # pylint: disable=unused-argument
+        return xjsonify({'id': str(uuid4()), 'config': {'module': 'dummy', 'args': '--arg1'}, 'targets': []})
+
+    def handler_output(request):
+        uploaded.append(request.path.split('/')[-1])
+        return xjsonify({'message': 'success'})
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_handler(handler_assign)
+    httpserver.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(handler_output)
+    cwd = os.getcwd()
+
+    result = agent_main(['--server', httpserver.url_for('/')[:-1], '--apikey', 'dummy', '--oneshot', '--slots', '3'])
+
+    assert result == 0
+    assert len(set(uploaded)) == 3
+    assert os.getcwd() == cwd
+    assert [path.name for path in Path(cwd).iterdir()] == ['spool']
+    assert not list(Path('spool').iterdir())
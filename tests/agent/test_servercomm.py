@@ -3,11 +3,17 @@
 tests with various server communication test cases
 """
 
+import gzip
+import json
 import multiprocessing
 import os
+import re
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from http import HTTPStatus
+from pathlib import Path
+from threading import Event
 from time import sleep
 from unittest.mock import patch
 from uuid import uuid4
@@ -16,6 +22,7 @@ from flask import url_for
 
 import sner.agent.core
 from sner.agent.core import main as agent_main
+from sner.agent.transport import GZIP_MIN_SIZE, Transport
 from tests.agent import xjsonify
 
 
@@ -46,7 +53,7 @@ class FailServer():
         self.cnt_assign = 0
         self.cnt_output = 0
         self.server.expect_request('/api/v2/scheduler/job/assign').respond_with_handler(self.handler_assign)
-        self.server.expect_request('/api/v2/scheduler/job/output').respond_with_handler(self.handler_output)
+        self.server.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(self.handler_output)
 
     def handler_assign(self, request):
         """handle assign request"""
@@ -87,6 +94,57 @@ def test_fail_server_communication(tmpworkdir, httpserver):  # pylint: disable=u
     assert sserver.cnt_output > 1
 
 
+def test_chunked_upload(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests chunked output upload resuming from offset reported by server"""
+
+    ranges = []
+
+    responses = [
+        ({'message': 'chunk accepted', 'offset': 4}, HTTPStatus.ACCEPTED),
+        ({'message': 'invalid range', 'offset': 2}, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE),
+        ({'message': 'chunk accepted', 'offset': 6}, HTTPStatus.ACCEPTED),
+        ({'message': 'success'}, HTTPStatus.OK)
+    ]
+
+    def handler_output(request):
+        ranges.append(request.headers['Content-Range'])
+        data, status = responses[len(ranges)-1]
+        response = xjsonify(data)
+        response.status_code = status
+        return response
+
+    httpserver.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(handler_output)
+    Path('output.zip').write_bytes(b'0123456789')
+
+    config = {**sner.agent.core.DEFAULT_CONFIG, 'SERVER': httpserver.url_for('/')[:-1], 'UPLOAD_CHUNKSIZE': 4}
+    sner.agent.core.ServerableAgent(config).upload_output(str(uuid4()), 0, 'output.zip')
+
+    assert ranges == ['bytes 0-3/10', 'bytes 4-7/10', 'bytes 2-5/10', 'bytes 6-9/10']
+
+
+def test_assign_longpoll(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests agent uses long-poll assignment when advertised by server"""
+
+    requests = []
+
+    def handler_assign(request):
+        requests.append(request.json)
+        response = xjsonify({'id': str(uuid4()), 'config': {'module': 'dummy'}, 'targets': []} if len(requests) > 1 else {})
+        response.headers['X-Assign-Wait-Max'] = '10'
+        return response
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_handler(handler_assign)
+
+    config = {**sner.agent.core.DEFAULT_CONFIG, 'SERVER': httpserver.url_for('/')[:-1], 'BACKOFF_TIME': 0.1, 'ASSIGN_WAIT': 20}
+    assignment, retval = sner.agent.core.ServerableAgent(config).get_assignment()
+
+    assert assignment
+    assert retval == 0
+    assert 'wait' not in requests[0]
+    assert requests[1]['wait'] == 10
+    assert requests[0]['heartbeat']
+
+
 def test_empty_server_communication(tmpworkdir, live_server, apikey_agent):  # pylint: disable=unused-argument,redefined-outer-name
     """tests oneshot vs wait on assignment on empty server"""
 
@@ -111,3 +169,178 @@ def test_invalid_server_oneshot(tmpworkdir):  # pylint: disable=unused-argument,
 
     result = agent_main(['--server', 'http://localhost:0', '--debug', '--oneshot'])
     assert result == 1
+
+
+def test_pipelined_run(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests assignments are processed while outputs wait for busy server"""
+
+    events = []
+    runtimes = []
+    config = {**sner.agent.core.DEFAULT_CONFIG, 'SERVER': httpserver.url_for('/')[:-1], 'BACKOFF_TIME': 0.1}
+    agent = sner.agent.core.ServerableAgent(config)
+
+    def handler_assign(request):  # pylint: disable=unused-argument
+        if events.count('assign') == 3:
+            agent.shutdown()
+            return xjsonify({})
+        events.append('assign')
+        return xjsonify({'id': str(uuid4()), 'config': {'module': 'dummy', 'args': '--arg1'}, 'targets': []})
+
+    def handler_output(request):  # pylint: disable=unused-argument
+        if events.count('busy') < 3:
+            events.append('busy')
+            response = xjsonify({'message': 'server busy'})
+            response.status_code = HTTPStatus.TOO_MANY_REQUESTS
+            return response
+        events.append('upload')
+        runtimes.append(float(request.args['runtime']))
+        return xjsonify({'message': 'success'})
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_handler(handler_assign)
+    httpserver.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(handler_output)
+
+    assert agent.run() == 0
+    assert events.count('upload') == 3
+    assert events.index('upload') > max(idx for idx, event in enumerate(events) if event == 'assign')
+    assert not list(Path('spool').iterdir())
+    assert len(runtimes) == 3 and all(runtime >= 0 for runtime in runtimes)
+
+
+def test_prefetch_assignment(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests next assignment is prefetched near the expected end of current one"""
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_json({'id': str(uuid4()), 'config': {'module': 'dummy'}, 'targets': []})
+    config = {**sner.agent.core.DEFAULT_CONFIG, 'SERVER': httpserver.url_for('/')[:-1], 'PREFETCH': True, 'PREFETCH_LEAD': 1.0}
+    agent = sner.agent.core.ServerableAgent(config)
+
+    # runtime of current assignment not known, prefetch waits for it to finish
+    done = Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        prefetch = executor.submit(agent.prefetch_assignment, done, None)
+        sleep(0.5)
+        assert not httpserver.log
+        done.set()
+        assert prefetch.result()[0]
+
+    # current assignment expected to finish within the lead
+    assert agent.prefetch_assignment(Event(), 0.5)[0]
+    assert len(httpserver.log) == 2
+
+
+def test_spool_resume(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests outputs left in spool by previous run are uploaded on startup"""
+
+    uploaded = []
+
+    def handler_output(request):
+        uploaded.append((request.path.split('/')[-1], request.args['retval'], request.get_data()))
+        return xjsonify({'message': 'success'})
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_json({})
+    httpserver.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(handler_output)
+
+    job_id = str(uuid4())
+    Path('spool').mkdir()
+    Path(f'spool/{job_id}.zip').write_bytes(b'spooled output')
+    Path(f'spool/{job_id}.json').write_text(json.dumps({'id': job_id, 'retval': 3}), encoding='utf-8')
+
+    result = agent_main(['--server', httpserver.url_for('/')[:-1], '--apikey', 'dummy', '--oneshot'])
+
+    assert result == 0
+    assert uploaded == [(job_id, '3', b'spooled output')]
+    assert not list(Path('spool').iterdir())
+
+
+def test_spool_upload_resume(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests failed spooled upload is resumed from the offset acknowledged by server"""
+
+    ranges = []
+
+    def handler_output(request):
+        ranges.append(request.headers['Content-Range'])
+        if len(ranges) == 2:
+            response = xjsonify({'message': 'internal error'})
+            response.status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+            return response
+        offset = int(re.match(r'^bytes \d+-(\d+)/\d+$', ranges[-1]).group(1)) + 1
+        response = xjsonify({'message': 'chunk accepted', 'offset': offset} if offset < 10 else {'message': 'success'})
+        response.status_code = HTTPStatus.ACCEPTED if offset < 10 else HTTPStatus.OK
+        return response
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_json({})
+    httpserver.expect_request(re.compile(r'^/api/v2/scheduler/job/output/.*')).respond_with_handler(handler_output)
+
+    job_id = str(uuid4())
+    Path('spool').mkdir()
+    Path(f'spool/{job_id}.zip').write_bytes(b'0123456789')
+    Path(f'spool/{job_id}.json').write_text(json.dumps({'id': job_id, 'retval': 0}), encoding='utf-8')
+
+    config = {
+        **sner.agent.core.DEFAULT_CONFIG,
+        'SERVER': httpserver.url_for('/')[:-1],
+        'BACKOFF_TIME': 0.1,
+        'UPLOAD_CHUNKSIZE': 4,
+        'ONESHOT': True
+    }
+    assert sner.agent.core.ServerableAgent(config).run() == 0
+
+    assert ranges == ['bytes 0-3/10', 'bytes 4-7/10', 'bytes 4-7/10', 'bytes 8-9/10']
+    assert not list(Path('spool').iterdir())
+
+
+def test_transport(httpserver):
+    """tests transport compression, retries and latency counters"""
+
+    requests = []
+
+    def handler_assign(request):
+        requests.append(request)
+        response = xjsonify({'message': 'server busy'} if len(requests) == 1 else json.loads(gzip.decompress(request.get_data())))
+        response.status_code = HTTPStatus.SERVICE_UNAVAILABLE if len(requests) == 1 else HTTPStatus.OK
+        return response
+
+    httpserver.expect_request('/api/v2/scheduler/job/assign').respond_with_handler(handler_assign)
+    transport = Transport(httpserver.url_for('/')[:-1], 'dummy', 10, retry={'assign': {'status': 1, 'backoff_factor': 0}})
+    data = {'caps': ['x' * GZIP_MIN_SIZE]}
+
+    response = transport.post_json('assign', data)
+
+    assert response.json() == data
+    assert len(requests) == 2
+    assert requests[1].headers['Content-Encoding'] == 'gzip'
+    assert requests[1].headers['X-API-KEY'] == 'dummy'
+    assert transport.stats['assign']['calls'] == 1
+    assert transport.stats['assign']['errors'] == 0
+
+    # assignment must not be repeated once the server might have processed it
+    transport = Transport(httpserver.url_for('/')[:-1], 'dummy', 10, retry=sner.agent.core.DEFAULT_CONFIG['RETRY'])
+    assign_retry = transport.session.get_adapter(httpserver.url_for('/api/v2/scheduler/job/assign')).max_retries
+    assert not assign_retry.is_retry('POST', HTTPStatus.GATEWAY_TIMEOUT)
+    assert assign_retry.is_retry('POST', HTTPStatus.SERVICE_UNAVAILABLE)
+    assert assign_retry.total is not None
+    output_retry = transport.session.get_adapter(httpserver.url_for('/api/v2/scheduler/job/output/x')).max_retries
+    assert output_retry.is_retry('POST', HTTPStatus.GATEWAY_TIMEOUT)
+
+
+def test_heartbeat(tmpworkdir, httpserver):  # pylint: disable=unused-argument,redefined-outer-name
+    """tests agent sends heartbeat for assigned and spooled jobs"""
+
+    heartbeats = []
+
+    def handler_heartbeat(request):
+        heartbeats.append(request.json['ids'])
+        agent.heartbeat_stop.set()
+        return xjsonify({'ids': request.json['ids'][:1]})
+
+    httpserver.expect_request('/api/v2/scheduler/job/heartbeat').respond_with_handler(handler_heartbeat)
+
+    config = {**sner.agent.core.DEFAULT_CONFIG, 'SERVER': httpserver.url_for('/')[:-1], 'HEARTBEAT_INTERVAL': 0.1}
+    agent = sner.agent.core.ServerableAgent(config)
+    job_ids = sorted([str(uuid4()), str(uuid4())])
+    agent.assigned.add(job_ids[0])
+    Path('spool').mkdir()
+    Path(f'spool/{job_ids[1]}.json').write_text('{}', encoding='utf-8')
+
+    agent.heartbeat()
+
+    assert heartbeats == [job_ids]
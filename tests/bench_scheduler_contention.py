@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler job assignment contention benchmark
+
+Simulates number of agents concurrently assigning jobs and uploading outputs
+against test database (tests/sner.yaml, content is destroyed). Compares
+hashval-level locking with legacy global exclusive scheduler lock.
+
+## Usage
+
+```
+python3 -m tests.bench_scheduler_contention --agents 8 --targets 20000
+```
+"""
+
+import threading
+import time
+from argparse import ArgumentParser
+from unittest.mock import patch
+
+from sner.server.app import create_app
+from sner.server.dbx_command import db_remove
+from sner.server.extensions import db
+from sner.server.scheduler.core import QueueManager, SchedulerService, SchedulerServiceBusyException
+from sner.server.scheduler.models import Job, Queue, Target
+
+
+ORIGINAL_GET_LOCK = SchedulerService.get_lock
+STATS_LOCK = threading.Lock()
+
+
+def exclusive_get_lock(timeout=0, shared=False):  # pylint: disable=unused-argument
+    """emulate legacy global scheduler lock"""
+    return ORIGINAL_GET_LOCK(timeout)
+
+
+def get_app(args):
+    """create application, each agent uses own engine to avoid pool contention between agents"""
+
+    app = create_app(config_file='tests/sner.yaml')
+    app.config['SNER_HEATMAP_HOT_LEVEL'] = args.hot_level
+    return app
+
+
+def agent(app, args, stats):
+    """simulated agent loop, assign jobs and upload outputs until queue is exhausted"""
+
+    with app.app_context():
+        while True:
+            try:
+                assignment = SchedulerService.job_assign(None, [])
+            except SchedulerServiceBusyException:
+                with STATS_LOCK:
+                    stats['busy'] += 1
+                continue
+            if not assignment:
+                # queue might be only temporarily rate-limited by other agents
+                if not Target.query.first():
+                    break
+                db.session.commit()
+                time.sleep(args.worktime)
+                continue
+            with STATS_LOCK:
+                stats['jobs'] += 1
+
+            time.sleep(args.worktime)
+            SchedulerService.job_output(Job.query.get(assignment['id']), 0, b'')
+        db.session.remove()
+
+
+def run(args):
+    """prepare queue and run agents"""
+
+    app = get_app(args)
+    with app.app_context():
+        db_remove()
+        db.create_all()
+        queue = Queue(name='bench', config='module: dummy', group_size=args.group_size, priority=10, active=True)
+        db.session.add(queue)
+        db.session.commit()
+        QueueManager.enqueue(queue, (f'10.{(idx // 256) % 256}.{idx % 256}.{idx // 65536}' for idx in range(args.targets)))
+
+    stats = {'jobs': 0, 'busy': 0}
+    threads = [threading.Thread(target=agent, args=(get_app(args), args, stats)) for _ in range(args.agents)]
+    time_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - time_start
+
+    with app.app_context():
+        heatmap_ok = SchedulerService.heatmap_check()
+        db_remove()
+
+    return elapsed, stats, heatmap_ok
+
+
+def main():
+    """main"""
+
+    parser = ArgumentParser()
+    parser.add_argument('--agents', type=int, default=8, help='number of concurrent agents')
+    parser.add_argument('--targets', type=int, default=20000, help='number of enqueued targets')
+    parser.add_argument('--group-size', type=int, default=10, help='queue group size')
+    parser.add_argument('--hot-level', type=int, default=5, help='heatmap hot level')
+    parser.add_argument('--worktime', type=float, default=0.01, help='simulated job duration')
+    args = parser.parse_args()
+
+    results = {}
+    with patch.object(SchedulerService, 'get_lock', exclusive_get_lock):
+        results['exclusive'] = run(args)
+    results['hashval'] = run(args)
+
+    for name, (elapsed, stats, heatmap_ok) in results.items():
+        print(
+            f'{name:10} jobs {stats["jobs"]:6} busy {stats["busy"]:4} elapsed {elapsed:8.2f}s '
+            f'jobs/s {stats["jobs"]/elapsed:8.1f} heatmap_check {heatmap_ok}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,14 @@ api.views tests
 """
 
 import base64
+import gzip
+import json
+from hashlib import sha256
 from http import HTTPStatus
 from ipaddress import ip_network
 from pathlib import Path
+from threading import Thread
+from time import monotonic, sleep
 from unittest.mock import patch
 
 from flask import current_app, url_for
@@ -15,7 +20,7 @@ from sqlalchemy import create_engine, func, select
 import sner.server.api.views
 import sner.server.api.schema as api_schema
 from sner.server.extensions import db
-from sner.server.scheduler.core import SchedulerService, SCHEDULER_LOCK_NUMBER
+from sner.server.scheduler.core import QueueManager, SchedulerReadyListener, SchedulerService, SCHEDULER_LOCK_NUMBER
 from sner.server.scheduler.models import Heatmap, Job, Queue, Readynet, Target
 
 
@@ -40,6 +45,35 @@ def test_v2_scheduler_job_assign_route(client, api_agent, target):
     assert response.status_code == HTTPStatus.UNAUTHORIZED
 
 
+def test_v2_scheduler_job_assign_route_gzip(api_agent, target):
+    """job assign route test with gzip encoded request and response"""
+
+    target_value = target.target
+    body = gzip.compress(json.dumps({'queue': target.queue.name}).encode())
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'}
+
+    with patch.object(sner.server.api.views, 'GZIP_MIN_SIZE', 0):
+        response = api_agent.post(url_for('api.v2_scheduler_job_assign_route'), body, headers=headers)
+    # webtest decodes the response, vary header is left in place
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.json['targets'] == [target_value]
+
+    response = api_agent.post(url_for('api.v2_scheduler_job_assign_route'), b'invalid', headers=headers, status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_v2_scheduler_job_heartbeat_route(api_agent, job, job_completed):
+    """job heartbeat route test"""
+
+    job_id = job.id
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_heartbeat_route'), {'ids': [job_id, job_completed.id]})
+    assert response.json == {'ids': [job_id]}
+    assert Job.query.get(job_id).time_heartbeat
+
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_heartbeat_route'), {'ids': ['invalid']}, status='*')
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
 def test_v2_scheduler_job_assign_route_maintenance(api_agent, target):
     """job assign route test maintenance test"""
 
@@ -52,10 +86,54 @@ def test_v2_scheduler_job_assign_route_maintenance(api_agent, target):
     assert not response.json
 
     current_app.config['SNER_MAINTENANCE'] = False
-    response = api_agent.post_json(url_for('api.v2_scheduler_job_assign_route'), {'queue': qname})
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_assign_route'), {'queue': qname, 'heartbeat': True})
     assert response.status_code == HTTPStatus.OK
     assert response.json
     assert len(Queue.query.filter(Queue.name == qname).one().jobs) == 1
+    assert Job.query.get(response.json['id']).time_heartbeat
+
+
+def test_v2_scheduler_job_assign_route_longpoll(app, api_agent, queue):
+    """job assign route long-poll test"""
+
+    current_app.config['SNER_ASSIGN_WAIT_MAX'] = 10
+    queue_id = queue.id
+
+    # nowork after wait timeout
+    time_start = monotonic()
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_assign_route'), {'wait': 1})
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['X-Assign-Wait-Max'] == '10'
+    assert not response.json
+    assert monotonic() - time_start >= 1
+
+    # waiting assignment woken up by enqueue
+    def enqueue_later():
+        sleep(0.5)
+        with app.app_context():
+            QueueManager.enqueue(Queue.query.get(queue_id), ['127.0.0.1'])
+            db.session.remove()
+
+    thread = Thread(target=enqueue_later)
+    thread.start()
+    time_start = monotonic()
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_assign_route'), {'wait': 10})
+    thread.join()
+
+    assert response.json['targets'] == ['127.0.0.1']
+    assert monotonic() - time_start < 5
+
+    # nowork without waiting when all waiter slots are taken
+    listener = current_app.extensions[SchedulerReadyListener.EXTENSION_NAME]
+    listener.waiters = listener.waiters_max
+    time_start = monotonic()
+    response = api_agent.post_json(url_for('api.v2_scheduler_job_assign_route'), {'wait': 10})
+    assert response.headers['X-Assign-Wait-Max'] == '10'
+    assert not response.json
+    assert monotonic() - time_start < 5
+    listener.waiters = 0
+
+    listener.stop()
 
 
 def test_v2_scheduler_job_assign_route_priority(api_agent, queue_factory, target_factory):
@@ -189,6 +267,96 @@ def test_v2_scheduler_job_output_route_locked(api_agent, job):
     assert response.status_code == HTTPStatus.TOO_MANY_REQUESTS
 
 
+def test_v2_scheduler_job_output_stream_route(api_agent, job):
+    """job output stream route test"""
+
+    data = b'a-test-file-contents'
+    url = url_for('api.v2_scheduler_job_output_stream_route', job_id=job.id, retval=12345)
+    headers = {'Content-Type': 'application/zip', 'X-Output-Sha256': sha256(data).hexdigest()}
+
+    response = api_agent.post(url, data[:5], headers={**headers, 'Content-Range': f'bytes 0-4/{len(data)}'}, status='*')
+    assert response.status_code == HTTPStatus.ACCEPTED
+    assert response.json['offset'] == 5
+
+    # resume from the offset reported by server
+    response = api_agent.post(url, data[10:], headers={**headers, 'Content-Range': f'bytes 10-19/{len(data)}'}, status='*')
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.json['offset'] == 5
+
+    response = api_agent.post(url, data[5:], headers={**headers, 'Content-Range': f'bytes 5-19/{len(data)}'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json['message'] == 'success'
+    assert job.retval == 12345
+    assert Path(job.output_abspath).read_bytes() == data
+    assert not Path(f'{job.output_abspath}.part').exists()
+
+    response = api_agent.post(url, data, headers=headers)
+    assert response.json['message'] == 'discard job'
+
+
+def test_v2_scheduler_job_output_stream_route_multipart(api_agent, job):
+    """job output stream route test multipart upload"""
+
+    response = api_agent.post(
+        url_for('api.v2_scheduler_job_output_stream_route', job_id=job.id, retval=0, runtime=1.5),
+        upload_files=[('output', 'output.zip', b'a-test-file-contents')]
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert job.retval == 0
+    assert Path(job.output_abspath).read_bytes() == b'a-test-file-contents'
+
+
+def test_v2_scheduler_job_output_stream_route_invalidrequest(api_agent, job):
+    """job output stream route test invalid requests"""
+
+    url = url_for('api.v2_scheduler_job_output_stream_route', job_id=job.id, retval=0)
+    headers = {'Content-Type': 'application/zip'}
+
+    response = api_agent.post(url_for('api.v2_scheduler_job_output_stream_route', job_id=job.id), b'data', headers=headers, status='*')
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+    response = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 0-3'}, status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    response = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 0-4/4'}, status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    # chunk size does not correspond with content range
+    response = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 0-5/10'}, status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert not Path(f'{job.output_abspath}.part').exists()
+
+    response = api_agent.post(url, b'data', headers={**headers, 'X-Output-Sha256': sha256(b'other').hexdigest()}, status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert not Path(f'{job.output_abspath}.part').exists()
+    assert job.retval is None
+
+
+def test_v2_scheduler_job_output_stream_route_locked(api_agent, job):
+    """job output stream route test locked"""
+
+    url = url_for('api.v2_scheduler_job_output_stream_route', job_id=job.id, retval=0)
+    headers = {'Content-Type': 'application/zip'}
+
+    db.session.commit()
+    with create_engine(current_app.config['SQLALCHEMY_DATABASE_URI']).connect() as conn:
+        conn.execute(select(func.pg_advisory_lock(SCHEDULER_LOCK_NUMBER)))
+
+        with patch.object(sner.server.scheduler.core.SchedulerService, 'TIMEOUT_JOB_OUTPUT', 1):
+            response1 = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 0-3/8'}, status='*')
+            response2 = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 4-7/8'}, status='*')
+
+        conn.execute(select(func.pg_advisory_unlock(SCHEDULER_LOCK_NUMBER)))
+
+    assert response1.status_code == HTTPStatus.ACCEPTED
+    assert response2.status_code == HTTPStatus.TOO_MANY_REQUESTS
+
+    # last chunk has been dropped and can be repeated
+    assert Path(f'{job.output_abspath}.part').stat().st_size == 4
+    response = api_agent.post(url, b'data', headers={**headers, 'Content-Range': 'bytes 4-7/8'})
+    assert response.status_code == HTTPStatus.OK
+    assert Path(job.output_abspath).read_bytes() == b'datadata'
+
+
 def test_v2_scheduler_job_lifecycle_with_heatmap(api_agent, queue, target_factory):
     """job assign route test"""
 
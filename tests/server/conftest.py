@@ -118,6 +118,12 @@ class TestAppApi(TestApp):
         kwargs['headers'] = {'X-API-KEY': self.apikey}
         return super().post_json(*args, **kwargs)
 
+    def post(self, *args, **kwargs):
+        """authenticated post"""
+
+        kwargs['headers'] = {'X-API-KEY': self.apikey, **kwargs.get('headers', {})}
+        return super().post(*args, **kwargs)
+
 
 @pytest.fixture
 def api_agent(app, apikey_agent):  # pylint: disable=redefined-outer-name
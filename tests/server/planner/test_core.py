@@ -5,6 +5,7 @@ planner core tests
 
 import logging
 import os
+from datetime import datetime
 from ipaddress import ip_address
 from pathlib import Path
 
@@ -107,6 +108,24 @@ def test_storagerescan(app, host_factory, service_factory, queue_factory):  # py
     assert len(sscan_dummy.task_args) == 2
 
 
+def test_storagerescan_limit(app, host_factory, service_factory):  # pylint: disable=unused-argument
+    """test rescan selects at most limit of the most overdue items"""
+
+    service_factory.create(host=host_factory.create(address='127.0.0.1', rescan_time=datetime(2000, 1, 1)), rescan_time=datetime(2001, 1, 1))
+    service_factory.create(host=host_factory.create(address='::1', rescan_time=datetime(2001, 1, 1)), rescan_time=datetime(2000, 1, 1))
+    service_factory.create(host=host_factory.create(address='127.0.0.2'))
+    sdisco_dummy = DummyStage()
+    sscan_dummy = DummyStage()
+
+    StorageRescan('0s', '1day', sdisco_dummy, '1day', [sscan_dummy], limit=1).run()
+    assert sdisco_dummy.task_args == ['127.0.0.1']
+    assert sscan_dummy.task_args == ['tcp://[::1]:22']
+
+    StorageRescan('0s', '1day', sdisco_dummy, '1day', [sscan_dummy], limit=1).run()
+    assert sdisco_dummy.task_args == ['::1']
+    assert sscan_dummy.task_args == ['tcp://127.0.0.1:22']
+
+
 def test_sixdiscoqueuehandler(app, job_completed_sixenumdiscover):  # pylint: disable=unused-argument
     """test SixDiscoQueueHandle"""
 
@@ -171,6 +190,18 @@ def test_storagecleanup(app, host_factory, service_factory):  # pylint: disable=
     assert Host.query.count() == 1
 
 
+def test_storagecleanup_incremental(app, host_factory):  # pylint: disable=unused-argument
+    """test planners incremental cleanup storage stage"""
+
+    stage = StorageCleanup(incremental=True)
+    stage.run()
+    assert stage.lastrun_path.exists()
+
+    host_factory.create(address='127.127.127.134', hostname=None, os=None, comment=None, modified=datetime(2000, 1, 1))
+    stage.run()
+    assert Host.query.count() == 1
+
+
 def test_planner_simple(app, queue_factory):  # pylint: disable=unused-argument
     """try somewhat default config"""
 
@@ -215,6 +246,9 @@ stage:
 
   rebuild_versioninfo_map:
     schedule: 1h
+
+  output_store_gc:
+    schedule: 1day
 """)
 
     planner = Planner(config, oneshot=True)
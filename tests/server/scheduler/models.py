@@ -12,7 +12,7 @@ from zipfile import ZipFile
 from factory import LazyAttribute, post_generation, SubFactory
 
 from sner.server.extensions import db
-from sner.server.scheduler.core import SchedulerService
+from sner.server.scheduler.core import QueueManager, SchedulerService
 from sner.server.scheduler.models import Job, Queue, Readynet, Target
 from sner.server.utils import yaml_dump
 from tests import BaseModelFactory
@@ -48,10 +48,13 @@ class TargetFactory(BaseModelFactory):  # pylint: disable=too-few-public-methods
         if not create:
             return
 
-        # if target gets created in database, readynets must be updated in order to be assignable
+        # if target gets created in database, readynets and queue stats must be updated in order to be assignable
+        QueueManager.stats_account('nr_targets', {self.queue.id: 1})  # pylint: disable=no-member
         if self.hashval not in SchedulerService.grep_hot_hashvals([self.hashval]):
-            db.session.merge(Readynet(queue_id=self.queue.id, hashval=self.hashval))  # pylint: disable=no-member
-            db.session.commit()
+            if not Readynet.query.get((self.queue.id, self.hashval)):  # pylint: disable=no-member
+                db.session.add(Readynet(queue_id=self.queue.id, hashval=self.hashval))  # pylint: disable=no-member
+                QueueManager.stats_account('nr_readynets', {self.queue.id: 1})  # pylint: disable=no-member
+        db.session.commit()
 
 
 class JobFactory(BaseModelFactory):  # pylint: disable=too-few-public-methods
@@ -77,7 +80,9 @@ class JobFactory(BaseModelFactory):  # pylint: disable=too-few-public-methods
         SchedulerService.get_lock()
         for target in json.loads(self.assignment)['targets']:
             SchedulerService.heatmap_put(SchedulerService.hashval(target))
-        SchedulerService.release_lock()
+        if self.retval is None:
+            QueueManager.stats_account('nr_running', {self.queue.id: 1})  # pylint: disable=no-member
+        db.session.commit()
 
 
 class JobCompletedFactory(JobFactory):  # pylint: disable=too-few-public-methods
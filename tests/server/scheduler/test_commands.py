@@ -3,12 +3,13 @@
 scheduler.commands tests
 """
 
+from datetime import datetime, timedelta
 from pathlib import Path
 
 from sner.server.extensions import db
 from sner.server.scheduler.commands import command
-from sner.server.scheduler.core import SchedulerService
-from sner.server.scheduler.models import Job, Queue
+from sner.server.scheduler.core import JobManager, SchedulerService
+from sner.server.scheduler.models import Job, Queue, QueueStats
 
 
 def test_enumips_command(runner, tmpworkdir):  # pylint: disable=unused-argument
@@ -76,6 +77,22 @@ def test_queue_flush_command(runner, target):
     assert not Queue.query.get(tqueue.id).targets
 
 
+def test_queue_revalidate_command(app, runner, queue, target_factory):  # pylint: disable=unused-argument
+    """queue revalidate command test"""
+
+    app.config['SNER_EXCLUSIONS'] = [['regex', '^excluded$']]
+    target_factory.create(queue=queue, target='excluded', hashval='excluded')
+
+    result = runner.invoke(command, ['queue-revalidate', queue.name])
+    assert result.exit_code == 0
+    assert f'{queue.name} removed 1' in result.output
+    assert not Queue.query.get(queue.id).targets
+
+    result = runner.invoke(command, ['queue-revalidate'])
+    assert result.exit_code == 0
+    assert f'{queue.name} skipped' in result.output
+
+
 def test_queue_prune_command(runner, job_completed):
     """queue prune command test"""
 
@@ -89,12 +106,75 @@ def test_queue_prune_command(runner, job_completed):
     assert not Path(job_completed.output_abspath).exists()
 
 
+def test_queue_stats_recount_command(runner, queue):
+    """test queue-stats-recount command"""
+
+    queue_id = queue.id
+    db.session.add(QueueStats(queue_id=queue_id, nr_targets=10))
+    db.session.commit()
+
+    result = runner.invoke(command, ['queue-stats-recount'])
+    assert result.exit_code == 0
+    assert 'queue stats corrected 1' in result.output
+    assert QueueStats.query.get(queue_id).nr_targets == 0
+
+
+def test_job_reap_command(app, runner, job):
+    """test job-reap command"""
+
+    job_id = job.id
+    job.time_heartbeat = datetime.utcnow() - timedelta(hours=1)
+    db.session.commit()
+
+    result = runner.invoke(command, ['job-reap'])
+    assert result.exit_code == 1
+
+    app.config['SNER_HEARTBEAT_TIMEOUT'] = 60
+    result = runner.invoke(command, ['job-reap'])
+    assert result.exit_code == 0
+    assert 'jobs reaped 1' in result.output
+    assert Job.query.get(job_id).retval == -1
+
+
+def test_output_gc_command(runner, job_completed):
+    """test output-gc command"""
+
+    result = runner.invoke(command, ['output-gc'])
+    assert result.exit_code == 0
+    assert 'output objects removed 0' in result.output
+    assert Path(job_completed.output_abspath).exists()
+
+
+def test_output_archived_command(app, runner, job_completed):
+    """test output-archived command"""
+
+    job_id, queue_name, time_end = job_completed.id, job_completed.queue.name, job_completed.time_end
+    JobManager.archive(job_completed)
+
+    for args in [['--id', job_id], ['--queue', queue_name], ['--queue', queue_name, '--date', time_end.strftime('%Y-%m-%d')]]:
+        result = runner.invoke(command, ['output-archived'] + args)
+        assert result.exit_code == 0
+        assert job_id in result.output
+
+    result = runner.invoke(command, ['output-archived', '--queue', 'nonexistent'])
+    assert result.exit_code == 0
+    assert not result.output
+
+    app.config['SNER_OUTPUT_STORE'] = 'flat'
+    result = runner.invoke(command, ['output-archived', '--queue', queue_name])
+    assert result.exit_code == 1
+
+
 def test_readynet_recount_command(runner):
     """test readynet_recount command"""
 
     result = runner.invoke(command, ['readynet-recount'])
     assert result.exit_code == 0
 
+    result = runner.invoke(command, ['readynet-recount', '--dry'])
+    assert result.exit_code == 0
+    assert 'readynets removed 0 added 0' in result.output
+
 
 def test_heatmap_check_command(runner, target):  # pylint: disable=unused-argument
     """test heatmap-check command"""
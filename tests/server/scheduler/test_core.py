@@ -3,16 +3,30 @@
 scheduler core tests
 """
 
+import json
+from collections import Counter
+from datetime import datetime, timedelta
 from ipaddress import ip_address, ip_network
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 import yaml
 from flask import current_app
+from sqlalchemy import create_engine, func, select
 
 from sner.server.extensions import db
-from sner.server.scheduler.core import enumerate_network, ExclMatcher, QueueManager, SchedulerService, sixenum_target_boundaries
-from sner.server.scheduler.models import Heatmap, Job, Readynet
+from sner.server.scheduler.core import (
+    enumerate_network,
+    JobManager,
+    QueueManager,
+    SCHEDULER_HASHVAL_LOCK_NAMESPACE,
+    SCHEDULER_LOCK_NUMBER,
+    SchedulerService
+)
+from sner.server.scheduler.exclusion import ExclMatcher, sixenum_target_boundaries
+from sner.server.scheduler.models import Heatmap, Job, Queue, QueueStats, Readynet, Target, TokenBucket
+from sner.server.scheduler.ratelimit import TokenBucketRateLimit
 
 
 def test_enumerate_network():
@@ -77,6 +91,53 @@ def test_excl_matcher(app):  # pylint: disable=unused-argument
         repr(item)
 
 
+def test_excl_matcher_compiled(app):  # pylint: disable=unused-argument
+    """test compiled matcher index and cache"""
+
+    config = [
+        ['network', '10.0.0.0/24'],
+        ['network', '10.0.0.128/25'],
+        ['network', '10.0.1.0/24'],
+        ['network', '10.0.5.0/24'],
+        ['network', '2001:db8::/64'],
+        ['regex', '^url1$'],
+        ['regex', 'url2'],
+    ]
+    matcher = ExclMatcher(config)
+
+    assert len(matcher.excls) == 2
+    assert matcher.excls[0].match_to[4] == (
+        [int(ip_address('10.0.0.0')), int(ip_address('10.0.5.0'))],
+        [int(ip_address('10.0.1.255')), int(ip_address('10.0.5.255'))]
+    )
+    assert matcher.match('10.0.1.255')
+    assert not matcher.match('10.0.2.0')
+    assert matcher.match('10.0.5.1')
+    assert not matcher.match('9.255.255.255')
+    assert matcher.match('tcp://[2001:db8::1]:80')
+    assert not matcher.match('tcp://[2001:db8:0:1::1]:80')
+    assert matcher.match('sixenum://2001:db8::ff00-ffff')
+    assert matcher.match('url1')
+    assert matcher.match('xurl2x')
+    assert not matcher.match('xurl1')
+
+    # uncombinable rules falls back to separate regexes
+    matcher = ExclMatcher([['regex', '(?i)^url1$'], ['regex', '(?i)^url2$']])
+    assert len(matcher.excls[0].match_to) == 2
+    assert matcher.match('URL2')
+
+    # rules with numbered backreferences are not combined
+    matcher = ExclMatcher([['regex', '^(a)x$'], ['regex', r'^(b)\1$'], ['regex', r'^c\\1$']])
+    assert len(matcher.excls[0].match_to) == 2
+    assert matcher.match('bb')
+    assert not matcher.match('ba')
+    assert matcher.match('ax')
+    assert matcher.match('c\\1')
+
+    assert ExclMatcher.from_config(config) is ExclMatcher.from_config([list(x) for x in config])
+    assert not ExclMatcher.from_config([]).match('10.0.0.1')
+
+
 def test_queuemanager_errorhandling(app, queue):  # pylint: disable=unused-argument
     """test QueuemaManger error handling"""
 
@@ -88,6 +149,137 @@ def test_queuemanager_errorhandling(app, queue):  # pylint: disable=unused-argum
     assert 'failed to remove queue directory' in str(pytest_wrapped_e)
 
 
+def test_queuemanager_enqueue(app, queue):  # pylint: disable=unused-argument
+    """test QueueManager streaming enqueue"""
+
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 1
+    db.session.add(Heatmap(hashval='127.0.1.0/24', count=1))
+    db.session.commit()
+
+    with patch.object(QueueManager, 'ENQUEUE_CHUNKSIZE', 2):
+        assert QueueManager.enqueue(queue, iter(['127.0.0.1\n', ' ', '127.0.0.2', '127.0.1.1', 'a,"b\tc'])) == 4
+
+    assert Target.query.filter(Target.queue_id == queue.id).count() == 4
+    assert Target.query.filter(Target.target == 'a,"b\tc').one().hashval == 'a,"b\tc'
+    assert sorted(x.hashval for x in Readynet.query.all()) == ['127.0.0.0/24', 'a,"b\tc']
+
+    assert QueueManager.enqueue(queue, ['127.0.0.1', '127.0.0.3', '127.0.0.3'], skip_queued=True) == 1
+    assert Target.query.filter(Target.queue_id == queue.id).count() == 5
+
+    assert QueueManager.enqueue(queue, ['', ' ']) == 0
+
+
+def test_queuemanager_exclusions(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test QueueManager enqueue exclusions filtering and queue revalidation"""
+
+    current_app.config['SNER_EXCLUSIONS'] = [['network', '127.0.0.0/31']]
+    version1 = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS']).version
+
+    assert QueueManager.enqueue(queue, ['127.0.0.1', '127.0.0.2', '127.0.1.1']) == 2
+    assert queue.excl_version == version1
+    assert QueueManager.revalidate(queue) is None
+
+    current_app.config['SNER_EXCLUSIONS'] = [['network', '127.0.1.0/24']]
+    version2 = ExclMatcher.from_config(current_app.config['SNER_EXCLUSIONS']).version
+
+    # enqueue to non-empty queue does not bump version
+    assert QueueManager.enqueue(queue, ['127.0.1.2', '127.0.0.3']) == 1
+    assert queue.excl_version == version1
+
+    assert QueueManager.revalidate(queue) == 1
+    assert queue.excl_version == version2
+    assert sorted(x.target for x in Target.query.all()) == ['127.0.0.2', '127.0.0.3']
+    assert [x.hashval for x in Readynet.query.all()] == ['127.0.0.0/24']
+
+    target_factory.create(queue=queue, target='127.0.1.3', hashval=SchedulerService.hashval('127.0.1.3'))
+    assert QueueManager.revalidate(queue) is None
+    assert QueueManager.revalidate(queue, force=True) == 1
+
+
+def test_queuemanager_stats(app, queue):  # pylint: disable=unused-argument
+    """test queue stats are maintained along with scheduler operations"""
+
+    def get_stats():
+        stats = QueueStats.query.get(queue.id)
+        return stats.nr_targets, stats.nr_readynets, stats.nr_running
+
+    def get_actual():
+        return (
+            Target.query.filter(Target.queue_id == queue.id).count(),
+            Readynet.query.filter(Readynet.queue_id == queue.id).count(),
+            Job.query.filter(Job.queue_id == queue.id, Job.retval == None).count()  # noqa: E711  pylint: disable=singleton-comparison
+        )
+
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 1
+    queue.group_size = 2
+    QueueManager.enqueue(queue, ['127.0.0.1', '127.0.0.2', '127.0.1.1', '127.0.1.2'])
+    assert get_stats() == get_actual() == (4, 2, 0)
+
+    assignment = SchedulerService.job_assign(None, [])
+    assert get_stats() == get_actual() == (2, 0, 1)
+
+    SchedulerService.job_output(Job.query.get(assignment['id']), 0, b'')
+    assert get_stats() == get_actual() == (2, 2, 0)
+
+    QueueManager.stats_account('nr_targets', {queue.id: 10})
+    db.session.rollback()
+    db.session.commit()
+    assert get_stats() == get_actual()
+
+    current_app.config['SNER_EXCLUSIONS'] = [['regex', '^127.0.0.2$'], ['regex', '^127.0.1.1$'], ['regex', '^127.0.2.1$']]
+    QueueManager.revalidate(queue, force=True)
+    assert get_stats() == get_actual()
+
+    QueueManager.flush(queue)
+    assert get_stats() == get_actual() == (0, 0, 0)
+    assert QueueManager.stats_recount() == 0
+
+
+def test_jobmanager_heartbeat_reap(app, queue):  # pylint: disable=unused-argument
+    """test job heartbeat and reaping jobs with expired heartbeat"""
+
+    QueueManager.enqueue(queue, ['127.0.0.1', '127.0.1.1'])
+    assignment1 = SchedulerService.job_assign(None, [])
+    assignment2 = SchedulerService.job_assign(None, [])
+
+    assert sorted(JobManager.heartbeat([assignment1['id'], 'notexist'])) == [assignment1['id']]
+    assert JobManager.reap(60) == 0
+
+    # job without heartbeat is not reaped regardless of age
+    Job.query.get(assignment1['id']).time_heartbeat = datetime.utcnow() - timedelta(seconds=120)
+    Job.query.get(assignment2['id']).time_start = datetime.utcnow() - timedelta(days=1)
+    db.session.commit()
+
+    assert JobManager.reap(60) == 1
+    job1 = Job.query.get(assignment1['id'])
+    assert job1.retval == -1
+    assert Target.query.filter(Target.queue_id == queue.id).one().target == assignment1['targets'][0]
+    assert SchedulerService.heatmap_check()
+
+    # late output from reaped job is discarded
+    assert not SchedulerService.job_output(job1, 0, b'')
+    assert JobManager.heartbeat([assignment1['id']]) == []
+
+
+def test_jobmanager_reap_missing_heartbeat(app, queue):  # pylint: disable=unused-argument
+    """test job assigned to agent supporting heartbeats expires if the first heartbeat never arrives"""
+
+    QueueManager.enqueue(queue, ['127.0.0.1', '127.0.1.1'])
+    assignment1 = SchedulerService.job_assign(None, [], heartbeat=True)
+    assignment2 = SchedulerService.job_assign(None, [])
+    assert Job.query.get(assignment1['id']).time_heartbeat
+    assert JobManager.reap(60) == 0
+
+    Job.query.get(assignment1['id']).time_heartbeat -= timedelta(seconds=120)
+    db.session.commit()
+
+    assert JobManager.reap(60) == 1
+    assert Job.query.get(assignment1['id']).retval == -1
+    assert Job.query.get(assignment2['id']).retval is None
+    assert Target.query.filter(Target.queue_id == queue.id).one().target == assignment1['targets'][0]
+    assert SchedulerService.heatmap_check()
+
+
 def test_schedulerservice_hashval():
     """test heatmap hashval computation"""
 
@@ -98,6 +290,20 @@ def test_schedulerservice_hashval():
     assert SchedulerService.hashval('tcp://[::1]:11') == '::/48'
     assert SchedulerService.hashval('sixenum://2001:db8:aa::1:2:3:11') == '2001:db8:aa::/48'
     assert SchedulerService.hashval('sixenum://2001:db8:bb::1:2:3:0-ffff') == '2001:db8:bb::/48'
+    assert SchedulerService.hashval('tcp://localhost:11') == 'localhost'
+
+
+def test_schedulerservice_hashval_prefixlen(app):  # pylint: disable=unused-argument
+    """test heatmap hashval configurable prefix lengths and batch api"""
+
+    current_app.config['SNER_HEATMAP_PREFIXLEN_IPV4'] = 16
+    current_app.config['SNER_HEATMAP_PREFIXLEN_IPV6'] = 64
+
+    assert SchedulerService.hashvals(['127.0.1.1', 'tcp://[2001:db8:aa::1]:11', 'url', '127.0.2.1']) == [
+        '127.0.0.0/16', '2001:db8:aa::/64', 'url', '127.0.0.0/16'
+    ]
+    assert SchedulerService.hashval('sixenum://2001:db8:aa:bb:1:2:3:0-ffff') == '2001:db8:aa:bb::/64'
+    assert SchedulerService.hashval('::1') == '::/64'
 
 
 def test_schedulerservice_readynetupdates(app, queue, target_factory):  # pylint: disable=unused-argument
@@ -119,7 +325,7 @@ def test_schedulerservice_morereadynetupdates(app, queue, target_factory):  # py
     """
     test scheduler service readynet manipulation
 
-    used to analyze and reason about heatmap_pop readynet sql queries for update readynet lists.
+    used to analyze and reason about heatmap_pop_many readynet sql queries for update readynet lists.
     using readynet updates `if heat < level` provides automatic updates for readynets when hot_level changes
     in runtime, but produces extra queries for every returning job. result: on hot_level change
     readynets map must be manually recounted.
@@ -148,6 +354,173 @@ def test_schedulerservice_morereadynetupdates(app, queue, target_factory):  # py
     assert Readynet.query.count() == 1
 
 
+def test_schedulerservice_batchassign(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service batch target pop respects heatmap hot level and exclusions"""
+
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 3
+    current_app.config['SNER_EXCLUSIONS'] = [['regex', '^127.0.0.1$']]
+    queue.group_size = 10
+
+    for addr in range(1, 6):
+        target_factory.create(queue=queue, target=f'127.0.0.{addr}', hashval=SchedulerService.hashval('127.0.0.1'))
+    for addr in range(1, 3):
+        target_factory.create(queue=queue, target=f'127.0.1.{addr}', hashval=SchedulerService.hashval('127.0.1.1'))
+    db.session.commit()
+
+    assignment = SchedulerService.job_assign(None, [])
+
+    assert '127.0.0.1' not in assignment['targets']
+    assert len([x for x in assignment['targets'] if x.startswith('127.0.0.')]) == 3
+    assert len([x for x in assignment['targets'] if x.startswith('127.0.1.')]) == 2
+    assert Heatmap.query.get('127.0.0.0/24').count == 3
+    assert Heatmap.query.get('127.0.1.0/24').count == 2
+    assert Readynet.query.count() == 0
+    assert SchedulerService.heatmap_check()
+
+
+def test_schedulerservice_adaptiveassign(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service adapts group size to observed job runtime"""
+
+    queue.group_size = 4
+    for addr in range(1, 21):
+        target_factory.create(queue=queue, target=f'127.0.{addr}.1', hashval=SchedulerService.hashval(f'127.0.{addr}.1'))
+    db.session.commit()
+
+    queue.group_runtime = 60
+    db.session.commit()
+    assert queue.group_size_effective == 4
+    job = Job.query.get(SchedulerService.job_assign(None, [])['id'])
+    job.time_start = datetime.utcnow() - timedelta(seconds=80)
+    db.session.commit()
+    SchedulerService.job_output(job, 0, b'')
+    assert QueueStats.query.get(queue.id).target_runtime == pytest.approx(20, abs=1)
+    assert queue.group_size_effective == 3
+    assert len(SchedulerService.job_assign(None, [])['targets']) == 3
+
+    job = Job.query.get(SchedulerService.job_assign(None, [])['id'])
+    job.time_start = datetime.utcnow() - timedelta(seconds=3)
+    db.session.commit()
+    SchedulerService.job_output(job, 0, b'')
+    assert QueueStats.query.get(queue.id).target_runtime == pytest.approx(0.8 * 20 + 0.2 * 1, abs=1)
+    assert queue.group_size_effective == 4
+
+    # runtime reported by agent takes precedence over time since assignment
+    job = Job.query.get(SchedulerService.job_assign(None, [])['id'])
+    job.time_start = datetime.utcnow() - timedelta(hours=1)
+    db.session.commit()
+    SchedulerService.job_output(job, 0, b'', runtime=16.2 * len(json.loads(job.assignment)['targets']))
+    assert QueueStats.query.get(queue.id).target_runtime == pytest.approx(16.2, abs=1)
+
+    queue.group_size_max, queue.group_runtime = 8, 600
+    db.session.commit()
+    assert queue.group_size_effective == 8
+    assert db.session.query(Queue.group_size_effective).filter(Queue.id == queue.id).scalar() == 8
+
+    queue.group_size_min, queue.group_runtime = 2, 1
+    db.session.commit()
+    assert queue.group_size_effective == 2
+    assert db.session.query(Queue.group_size_effective).filter(Queue.id == queue.id).scalar() == 2
+
+    queue.group_runtime = None
+    db.session.commit()
+    assert queue.group_size_effective == 4
+    assert db.session.query(Queue.group_size_effective).filter(Queue.id == queue.id).scalar() == 4
+
+
+def test_schedulerservice_concurrentassign(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service assignment skips hashvals locked by concurrent transaction"""
+
+    queue.group_size = 10
+    for addr in range(1, 3):
+        target_factory.create(queue=queue, target=f'127.0.0.{addr}', hashval=SchedulerService.hashval('127.0.0.1'))
+        target_factory.create(queue=queue, target=f'127.0.1.{addr}', hashval=SchedulerService.hashval('127.0.1.1'))
+    db.session.commit()
+
+    # simulate concurrent assignment holding scheduler shared lock and hashval lock
+    with create_engine(current_app.config['SQLALCHEMY_DATABASE_URI']).connect() as conn:
+        with conn.begin():
+            conn.execute(select(func.pg_advisory_lock_shared(SCHEDULER_LOCK_NUMBER)))
+            conn.execute(select(func.pg_advisory_xact_lock(SCHEDULER_HASHVAL_LOCK_NAMESPACE, func.hashtext('127.0.0.0/24'))))
+
+            assignment1 = SchedulerService.job_assign(None, [])
+
+        conn.execute(select(func.pg_advisory_unlock_shared(SCHEDULER_LOCK_NUMBER)))
+
+    assignment2 = SchedulerService.job_assign(None, [])
+
+    assert sorted(assignment1['targets']) == ['127.0.1.1', '127.0.1.2']
+    assert sorted(assignment2['targets']) == ['127.0.0.1', '127.0.0.2']
+    assert Readynet.query.count() == 0
+    assert SchedulerService.heatmap_check()
+
+
+def test_schedulerservice_concurrentassign_retry(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service assignment retries other readynets if all selected ones are locked"""
+
+    queue.group_size = 1
+    for addr in range(1, 5):
+        target_factory.create(queue=queue, target=f'127.0.{addr}.1', hashval=SchedulerService.hashval(f'127.0.{addr}.1'))
+    db.session.commit()
+
+    with create_engine(current_app.config['SQLALCHEMY_DATABASE_URI']).connect() as conn:
+        with conn.begin():
+            for addr in range(1, 4):
+                conn.execute(select(func.pg_advisory_xact_lock(SCHEDULER_HASHVAL_LOCK_NAMESPACE, func.hashtext(f'127.0.{addr}.0/24'))))
+
+            # any selection of single readynet hitting locked one must be retried
+            for _ in range(5):
+                with patch.object(SchedulerService, 'HASHVAL_LOCK_ATTEMPTS', 4):
+                    assignment = SchedulerService.job_assign(None, [])
+                assert assignment['targets'] == ['127.0.4.1']
+                target_factory.create(queue=queue, target='127.0.4.1', hashval=SchedulerService.hashval('127.0.4.1'))
+                db.session.commit()
+
+
+def test_schedulerservice_locktimeout(app):  # pylint: disable=unused-argument
+    """test scheduler lock timeout does not apply to the rest of the transaction"""
+
+    SchedulerService.get_lock(SchedulerService.TIMEOUT_JOB_ASSIGN, shared=True)
+    assert db.session.execute('SHOW lock_timeout').scalar() == '0'
+    db.session.rollback()
+
+
+def test_schedulerservice_randomdistribution(app, queue):  # pylint: disable=unused-argument
+    """test scheduler service random selection over random sort keys is uniform"""
+
+    targets = [f'127.0.{net}.{addr}' for net in range(3) for addr in range(2)]
+    QueueManager.enqueue(queue, targets)
+
+    rounds = 600
+    picked = Counter()
+    for _ in range(rounds):
+        rtarget = SchedulerService._pop_random_targets(queue, 1)[0]  # pylint: disable=protected-access
+        db.session.commit()
+        picked[rtarget.target] += 1
+        QueueManager.enqueue(queue, [rtarget.target])
+
+    # chi-square goodness of fit, 5 degrees of freedom, p-value ~ 1e-6
+    expected = rounds / len(targets)
+    assert sum((picked[target] - expected)**2 / expected for target in targets) < 35
+
+
+def test_schedulerservice_joboutput(app, queue, job_factory, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service aggregated heatmap release"""
+
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 2
+    job = job_factory.create(queue=queue, assignment=json.dumps({'targets': ['127.0.0.1', '127.0.0.2', '127.0.1.1']}))
+    target_factory.create(queue=queue, target='127.0.0.3', hashval=SchedulerService.hashval('127.0.0.3'))
+    assert Heatmap.query.get('127.0.0.0/24').count == 2
+    assert Readynet.query.count() == 0
+
+    with patch.object(SchedulerService, 'HEATMAP_GC_PROBABILITY', 0):
+        SchedulerService.job_output(job, 0, b'')
+
+    assert Heatmap.query.get('127.0.0.0/24').count == 0
+    assert Heatmap.query.get('127.0.1.0/24').count == 0
+    assert Readynet.query.one().hashval == '127.0.0.0/24'
+    assert SchedulerService.heatmap_check()
+
+
 def test_schedulerservice_hashvalprocessing(app, queue, target_factory):  # pylint: disable=unused-argument
     """test scheduler service hashvalsreadynet manipulation"""
 
@@ -179,14 +552,21 @@ def test_schedulerservice_readynetrecount(app, queue, target_factory):  # pylint
     assert Readynet.query.count() == 0
 
     current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 7
-    SchedulerService.readynet_recount()
+    assert SchedulerService.readynet_recount(dry_run=True) == (0, 1)
+    assert Readynet.query.count() == 0
+    assert SchedulerService.readynet_recount() == (0, 1)
     assert Readynet.query.count() == 1
 
     assignment4 = SchedulerService.job_assign(None, [])
     assert len(assignment4['targets']) == 2
 
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 8
+    assert SchedulerService.readynet_recount() == (0, 1)
+    assert Readynet.query.count() == 1
+
     current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 3
-    SchedulerService.readynet_recount()
+    assert SchedulerService.readynet_recount(dry_run=True) == (1, 0)
+    assert SchedulerService.readynet_recount() == (1, 0)
     assert Readynet.query.count() == 0
 
 
@@ -201,3 +581,60 @@ def test_schedulerservice_heatmapcheck(app, target):  # pylint: disable=unused-a
     Job.query.filter(Job.id == assignment['id']).delete()
     db.session.commit()
     assert not SchedulerService.heatmap_check()
+
+
+def test_schedulerservice_tokenbucket(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service token bucket rate-limit engine"""
+
+    current_app.config['SNER_RATELIMIT_ENGINE'] = 'tokenbucket'
+    current_app.config['SNER_TOKENBUCKET_RATE'] = 60
+    current_app.config['SNER_TOKENBUCKET_BURST'] = 2
+    queue.group_size = 10
+
+    # bucket states are evaluated against frozen clock, elapsed time is simulated by shifting stored timestamps
+    with patch.object(TokenBucketRateLimit, 'now', return_value=datetime.utcnow()):
+        for addr in range(1, 6):
+            target_factory.create(queue=queue, target=f'127.0.0.{addr}', hashval=SchedulerService.hashval('127.0.0.1'))
+        target_factory.create(queue=queue, target='127.0.1.1', hashval=SchedulerService.hashval('127.0.1.1'))
+        db.session.commit()
+
+        assignment1 = SchedulerService.job_assign(None, [])
+        assert len([x for x in assignment1['targets'] if x.startswith('127.0.0.')]) == 2
+        assert TokenBucket.query.get('127.0.0.0/24').time_ready
+        assert TokenBucket.query.get('127.0.1.0/24').tokens == 1
+        assert Readynet.query.count() == 0
+        assert QueueStats.query.get(queue.id).nr_readynets == 0
+        assert 0 < SchedulerService.ratelimit().refill_delay() <= 1
+
+        # released targets does not activate exhausted hashval
+        SchedulerService.job_output(Job.query.get(assignment1['id']), 0, b'')
+        assert Readynet.query.count() == 0
+        assert not SchedulerService.job_assign(None, [])
+        assert SchedulerService.readynet_recount() == (0, 0)
+
+        # targets of exhausted hashval are enqueued without readynet
+        assert QueueManager.enqueue(queue, ['127.0.0.9']) == 1
+        assert Readynet.query.count() == 0
+
+        # refill over time
+        TokenBucket.query.update({
+            TokenBucket.time_update: TokenBucket.time_update - timedelta(seconds=1.5),
+            TokenBucket.time_ready: TokenBucket.time_ready - timedelta(seconds=1.5)
+        })
+        db.session.commit()
+        assert SchedulerService.ratelimit_refill() == 1
+        assert QueueStats.query.get(queue.id).nr_readynets == 1
+
+        assignment2 = SchedulerService.job_assign(None, [])
+        assert len(assignment2['targets']) == 1
+        assert TokenBucket.query.get('127.0.0.0/24').tokens == pytest.approx(0.5)
+        assert SchedulerService.heatmap_check()
+
+        # assignment refills on its own
+        TokenBucket.query.update({
+            TokenBucket.time_update: TokenBucket.time_update - timedelta(seconds=1),
+            TokenBucket.time_ready: TokenBucket.time_ready - timedelta(seconds=1)
+        })
+        db.session.commit()
+        assignment3 = SchedulerService.job_assign(None, [])
+        assert len(assignment3['targets']) == 1
@@ -0,0 +1,151 @@
+# This file is part of sner4 project governed by MIT license, see the LICENSE.txt file.
+"""
+scheduler output store tests
+"""
+
+import errno
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from flask import current_app
+
+from sner.server.extensions import db
+from sner.server.scheduler.core import JobManager, QueueManager
+from sner.server.scheduler.outputstore import output_store, ShardedOutputStore
+
+
+def test_sharded_store_dedup(app, queue, job_factory):  # pylint: disable=unused-argument
+    """test sharded store layout and output deduplication"""
+
+    job1 = job_factory.create(queue=queue)
+    job2 = job_factory.create(queue=queue)
+    JobManager.finish(job1, 0, b'same output')
+    JobManager.finish(job2, 0, b'same output')
+
+    opath1, opath2 = Path(job1.output_abspath), Path(job2.output_abspath)
+    assert opath1 == Path(queue.data_abspath) / job1.id[:2] / job1.id
+    assert opath1.samefile(opath2)
+    assert opath1.read_bytes() == b'same output'
+    assert opath1.stat().st_nlink == 3
+
+    JobManager.delete(job1)
+    assert not opath1.exists()
+    assert opath2.stat().st_nlink == 2
+
+    JobManager.delete(job2)
+    assert not opath2.exists()
+    assert output_store().gc_objects() == 1
+    assert not any(Path(current_app.config['SNER_VAR'], 'scheduler', 'objects').glob('*/*'))
+
+    QueueManager.delete(queue)
+    assert not Path(queue.data_abspath).exists()
+
+
+def test_sharded_store_legacy_path(app, job_completed):  # pylint: disable=unused-argument
+    """test sharded store honors outputs stored in legacy flat layout"""
+
+    legacy_path = Path(job_completed.queue.data_abspath) / job_completed.id
+    Path(job_completed.output_abspath).replace(legacy_path)
+
+    assert job_completed.output_abspath == str(legacy_path)
+    JobManager.delete(job_completed)
+    assert not legacy_path.exists()
+
+
+def test_sharded_store_archive(app, job_completed):  # pylint: disable=unused-argument
+    """test archive links and index lookups"""
+
+    store = output_store()
+    job_id, queue_name, time_end = job_completed.id, job_completed.queue.name, job_completed.time_end
+    output_data = Path(job_completed.output_abspath).read_bytes()
+
+    JobManager.archive(job_completed)
+    JobManager.delete(job_completed)
+
+    archived = store.archived(job_id=job_id)
+    assert len(archived) == 1
+    assert store.read_archived(archived[0]) == output_data
+    assert store.archived(queue_name=queue_name) == store.archived(date=time_end.date())
+    assert store.archived(queue_name=queue_name, date=time_end.date())
+    assert store.archived(queue_name=queue_name)[0].samefile(archived[0])
+    assert not store.archived(queue_name='nonexistent')
+
+
+def test_sharded_store_gc(app, queue, job_factory):  # pylint: disable=unused-argument
+    """test objects shared with archive views are garbage collected"""
+
+    store = output_store()
+    objects_dir = Path(current_app.config['SNER_VAR'], 'scheduler', 'objects')
+    job1 = job_factory.create(queue=queue)
+    job2 = job_factory.create(queue=queue)
+    JobManager.finish(job1, 0, b'same output')
+    JobManager.finish(job2, 0, b'same output')
+    job1_id = job1.id
+
+    JobManager.archive(job1)
+    JobManager.delete(job1)
+    assert store.gc_objects() == 0
+
+    JobManager.delete(job2)
+    assert len(list(objects_dir.glob('*/*'))) == 1
+    assert store.gc_objects() == 1
+    assert not any(objects_dir.glob('*/*'))
+    assert store.read_archived(store.archived(job_id=job1_id)[0]) == b'same output'
+
+
+def test_sharded_store_nolink(app, queue, job_factory):  # pylint: disable=unused-argument
+    """test store copies data on filesystem not supporting hardlinks"""
+
+    store = output_store()
+    job1 = job_factory.create(queue=queue)
+    job2 = job_factory.create(queue=queue)
+
+    with patch.object(os, 'link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+        JobManager.finish(job1, 0, b'same output')
+        JobManager.finish(job2, 0, b'same output')
+        db.session.commit()
+        JobManager.archive(job1)
+
+    assert Path(job1.output_abspath).read_bytes() == b'same output'
+    assert Path(job1.output_abspath).stat().st_nlink == 1
+    assert store.read_archived(store.archived(job_id=job1.id)[0]) == b'same output'
+
+    with patch.object(os, 'link', side_effect=OSError(errno.EACCES, 'Permission denied')):
+        with pytest.raises(OSError):
+            JobManager.archive(job2)
+
+
+def test_sharded_store_archive_zstd(app, job_completed):  # pylint: disable=unused-argument
+    """test compressed archive"""
+
+    pytest.importorskip('zstandard')
+
+    current_app.config['SNER_OUTPUT_STORE_ZSTD_LEVEL'] = 3
+    store = output_store()
+    output_data = Path(job_completed.output_abspath).read_bytes()
+
+    JobManager.archive(job_completed)
+
+    archived = store.archived(job_id=job_completed.id)
+    assert archived[0].name == f'{job_completed.id}{ShardedOutputStore.ZSTD_SUFFIX}'
+    assert store.read_archived(archived[0]) == output_data
+
+
+def test_flat_store(app, job_completed):  # pylint: disable=unused-argument
+    """test legacy flat store"""
+
+    current_app.config['SNER_OUTPUT_STORE'] = 'flat'
+    store = output_store()
+    job_completed.queue.name = 'flatqueue'
+
+    JobManager.finish(job_completed, 0, b'flat output')
+    assert job_completed.output_abspath == os.path.join(job_completed.queue.data_abspath, job_completed.id)
+
+    JobManager.archive(job_completed)
+    archived = store.archived(job_id=job_completed.id)
+    assert store.read_archived(archived[0]) == b'flat output'
+    assert not archived[0].samefile(job_completed.output_abspath)
+    with pytest.raises(ValueError):
+        store.archived(queue_name='flatqueue')
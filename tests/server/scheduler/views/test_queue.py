@@ -22,6 +22,7 @@ def test_queue_list_json_route(cl_operator, queue):
     assert response.status_code == HTTPStatus.OK
     response_data = json.loads(response.body.decode('utf-8'))
     assert response_data['data'][0]['name'] == queue.name
+    assert response_data['data'][0]['group_size_effective'] == queue.group_size
 
     response = cl_operator.post(
         url_for('scheduler.queue_list_json_route', filter=f'Queue.name=="{queue.name}"'),
@@ -89,6 +90,28 @@ def test_queue_edit_route(cl_operator, queue):
     assert Queue.query.get(queue.id).name == new_name
 
 
+def test_queue_edit_route_adaptive(cl_operator, queue):
+    """queue edit route adaptive group size test"""
+
+    form_data = [('name', queue.name), ('config', queue.config), ('group_size', 10), ('priority', queue.priority),
+                 ('group_runtime', 300), ('group_size_min', 5), ('group_size_max', 2)]
+    response = cl_operator.post(url_for('scheduler.queue_edit_route', queue_id=queue.id), params=form_data, expect_errors=True)
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert 'Must not be lower than group size min' in response.json['error']['errors']['group_size_max']
+
+    form_data[-1] = ('group_size_max', 20)
+    response = cl_operator.post(url_for('scheduler.queue_edit_route', queue_id=queue.id), params=form_data)
+
+    assert response.status_code == HTTPStatus.OK
+
+    response = cl_operator.get(url_for('scheduler.queue_json_route', queue_id=queue.id))
+    assert response.json['group_runtime'] == 300
+    assert response.json['group_size_max'] == 20
+    assert response.json['group_size_effective'] == 10
+    assert response.json['target_runtime'] is None
+
+
 def test_queue_enqueue_route(cl_operator, queue, target_factory):
     """queue enqueue route test"""
 
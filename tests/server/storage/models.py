@@ -3,7 +3,7 @@
 storage test models
 """
 
-from factory import LazyAttribute, SubFactory
+from factory import LazyAttribute, Sequence, SubFactory
 
 from sner.server.storage.models import Host, Note, Service, SeverityEnum, Versioninfo, Vuln, Vulnsearch
 from sner.server.storage.versioninfo import versioninfo_docid
@@ -17,7 +17,7 @@ class HostFactory(BaseModelFactory):  # pylint: disable=too-few-public-methods
         """test host model factory"""
         model = Host
 
-    address = '127.128.129.130'
+    address = Sequence(lambda n: f'127.128.{n // 256 % 256}.{n % 256}')  # address is unique
     hostname = 'localhost.localdomain'
     os = 'some linux'
     comment = 'testing webserver'
@@ -9,6 +9,7 @@ from io import StringIO
 from unittest.mock import Mock, patch
 
 import sner.server.storage.elastic
+from sner.server.extensions import db
 from sner.server.storage.commands import command
 from sner.server.storage.models import Host, Note, Service, SeverityEnum, Vuln
 
@@ -53,6 +54,41 @@ def test_flush_command(runner, service, vuln, note):  # pylint: disable=unused-a
     assert not Note.query.all()
 
 
+def test_dedupe_command(runner, host_factory, service_factory, vuln_factory, note_factory):
+    """test dedupe command"""
+
+    # simulate storage created before natural-key constraints
+    for index in ['host_address', 'service_hostid_proto_port', 'vuln_hostid_serviceid_name_xtype_viatarget', 'note_hostid_serviceid_xtype_viatarget']:
+        db.session.execute(f'DROP INDEX {index}')
+    host1 = host_factory.create(address='192.0.2.1', hostname=None, tags=['tag1'])
+    host2 = host_factory.create(address='192.0.2.1', hostname='host2.example.com', tags=['tag2'])
+    service_factory.create(host=host1, proto='tcp', port=22, info=None)
+    service2 = service_factory.create(host=host2, proto='tcp', port=22, info='info2')
+    vuln_factory.create(host=host1, service=None, name='vuln1', xtype='xtype1', via_target=None)
+    vuln_factory.create(host=host2, service=None, name='vuln1', xtype='xtype1', via_target=None)
+    note_factory.create(host=host2, service=service2, xtype='xtype1')
+    db.session.commit()
+    host1_id = host1.id
+
+    result = runner.invoke(command, ['dedupe', '--dry'])
+    assert result.exit_code == 0
+    assert 'hosts: 1, services: 0, vulns: 0, notes: 0' in result.output
+    assert Host.query.count() == 2
+
+    result = runner.invoke(command, ['dedupe'])
+    assert result.exit_code == 0
+    assert 'hosts: 1, services: 1, vulns: 1, notes: 0' in result.output
+
+    host = Host.query.one()
+    assert host.id == host1_id
+    assert host.hostname == 'host2.example.com'
+    assert sorted(host.tags) == ['tag1', 'tag2']
+    service = Service.query.one()
+    assert service.info == 'info2'
+    assert Note.query.one().service == service
+    assert Vuln.query.count() == 1
+
+
 def test_vuln_report_command(runner, vuln):  # pylint: disable=unused-argument
     """test vuln-report command"""
 
@@ -3,6 +3,9 @@
 storage.core functions tests
 """
 
+import json
+from datetime import datetime, timedelta
+
 import pytest
 
 from sner.server.parser import ParsedItemsDb
@@ -38,6 +41,80 @@ def test_importparsed(app):  # pylint: disable=unused-argument
     assert host.notes[0].tags == ['testtag']
 
 
+def test_importparsed_merge(app, host_factory, note_factory):  # pylint: disable=unused-argument
+    """test import parsed merges items with existing storage data"""
+
+    host = host_factory.create(address='192.0.2.1', hostname='existing.example.com', os='existing os')
+    note_factory.create(host=host, xtype='hostnames', data='["existing.example.com"]')
+
+    pidb = ParsedItemsDb()
+    pidb.upsert_host('192.0.2.1', hostnames=['new.example.com'], os='')
+    pidb.upsert_host('192.0.2.2', hostname='other.example.com')
+    pidb.upsert_service('192.0.2.1', 'tcp', 80, state='open:syn-ack', name='http')
+    pidb.upsert_vuln('192.0.2.1', 'name1', 'xtype1', 'tcp', 80, severity=SeverityEnum.INFO, refs=['ref1'])
+    pidb.upsert_vuln('192.0.2.1', 'name1', 'xtype1', severity=SeverityEnum.LOW)
+    pidb.upsert_note('192.0.2.2', 'xtype1', data='data1')
+    counts = StorageManager.import_parsed(pidb)
+    assert counts['host'] == {'new': 1, 'changed': 0, 'unchanged': 1}
+    assert counts['vuln'] == {'new': 2, 'changed': 0, 'unchanged': 0}
+
+    host = Host.query.filter(Host.address == '192.0.2.1').one()
+    assert host.hostname == 'existing.example.com'
+    assert host.os == 'existing os'
+    assert json.loads(Note.query.filter(Note.host == host, Note.xtype == 'hostnames').one().data) == ['existing.example.com', 'new.example.com']
+    assert Host.query.filter(Host.address == '192.0.2.2').one().notes[0].data == 'data1'
+    assert Vuln.query.filter(Vuln.service != None).one().refs == ['ref1']  # noqa: E711  pylint: disable=singleton-comparison
+    assert Vuln.query.filter(Vuln.service == None).one().severity == SeverityEnum.LOW  # noqa: E711  pylint: disable=singleton-comparison
+
+    pidb = ParsedItemsDb()
+    pidb.upsert_service('192.0.2.1', 'tcp', 80, state=None, info='info1')
+    pidb.upsert_vuln('192.0.2.1', 'name1', 'xtype1', 'tcp', 80, severity=SeverityEnum.HIGH)
+    counts = StorageManager.import_parsed(pidb, ['tag1', 'tag2'])
+    assert counts['service'] == {'new': 0, 'changed': 1, 'unchanged': 0}
+
+    service = Service.query.one()
+    assert (service.state, service.name, service.info) == ('open:syn-ack', 'http', 'info1')
+    assert sorted(service.tags) == ['tag1', 'tag2']
+    vuln = Vuln.query.filter(Vuln.service == service).one()
+    assert (vuln.severity, vuln.refs) == (SeverityEnum.HIGH, ['ref1'])
+    assert (Host.query.count(), Service.query.count(), Vuln.query.count(), Note.query.count()) == (2, 1, 2, 2)
+
+    modified = service.modified
+    counts = StorageManager.import_parsed(pidb, ['tag1'])
+    assert counts['service'] == {'new': 0, 'changed': 0, 'unchanged': 1}
+    assert Service.query.one().modified == modified
+
+    # rescan with newer import_time is not a change, import_time is refreshed
+    for import_time in [datetime(2020, 1, 1), datetime(2020, 1, 2)]:
+        pidb = ParsedItemsDb()
+        pidb.upsert_service('192.0.2.1', 'tcp', 80, info='info1', import_time=import_time)
+        pidb.upsert_vuln('192.0.2.1', 'name1', 'xtype1', 'tcp', 80, severity=SeverityEnum.HIGH, import_time=import_time)
+        counts = StorageManager.import_parsed(pidb)
+        assert counts['service'] == {'new': 0, 'changed': 0, 'unchanged': 1}
+        assert counts['vuln'] == {'new': 0, 'changed': 0, 'unchanged': 1}
+
+        service = Service.query.one()
+        assert (service.import_time, service.modified) == (import_time, modified)
+        assert Vuln.query.filter(Vuln.service == service).one().import_time == import_time
+
+
+def test_importparsed_dry(app, capsys, service):  # pylint: disable=unused-argument
+    """test import parsed dry run classifies items without updating storage"""
+
+    pidb = ParsedItemsDb()
+    pidb.upsert_service(service.host.address, service.proto, service.port, info='changed info')
+    pidb.upsert_service(service.host.address, service.proto, service.port + 1)
+    pidb.upsert_note('192.0.2.1', 'xtype1', service_proto='tcp', service_port=80, data='data1')
+    StorageManager.import_parsed_dry(pidb)
+
+    output = capsys.readouterr().out
+    assert 'storage update changed service:' in output
+    assert 'storage import host, new 1, changed 0, unchanged 1' in output
+    assert 'storage import service, new 2, changed 1, unchanged 0' in output
+    assert 'storage import note, new 1, changed 0, unchanged 0' in output
+    assert (Host.query.count(), Service.query.count(), Note.query.count()) == (1, 1, 0)
+
+
 def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_factory):  # pylint: disable=unused-argument
     """test planners cleanup storage stage"""
 
@@ -58,7 +135,7 @@ def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_f
     service3 = service_factory.create(host=host3, proto='tcp', port=1, state='filtered:reason')
     note_factory.create(host=host3, service=service3)
     vuln_factory.create(host=host3, service=service3)
-    service4 = service_factory.create(host=host3, proto='tcp', port=1, state='open:reason')
+    service4 = service_factory.create(host=host3, proto='tcp', port=2, state='open:reason')
     vuln_factory.create(host=host3)
     vuln_factory.create(host=host3, service=service4)
 
@@ -69,6 +146,23 @@ def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_f
     assert Note.query.count() == 0
 
 
+def test_storagecleanup_incremental(app, host_factory, service_factory):  # pylint: disable=unused-argument
+    """test incremental cleanup processes only items touched since given time"""
+
+    since = datetime.utcnow()
+    host_factory.create(address='127.127.127.134', hostname=None, os=None, comment=None, modified=since - timedelta(days=1))
+    host2 = host_factory.create(address='127.127.127.135', hostname=None, os=None, comment=None, modified=since - timedelta(days=1))
+    service_factory.create(host=host2, state='closed:reason')
+    service_factory.create(state='closed:reason', port=2, modified=since - timedelta(days=1))
+
+    assert StorageManager.cleanup_storage(since, log_items=False) == {'services': 1, 'hosts': 1}
+    assert Host.query.filter(Host.address == '127.127.127.134').one()
+    assert Service.query.count() == 1
+
+    assert StorageManager.cleanup_storage() == {'services': 1, 'hosts': 1}
+    assert Host.query.count() == 1
+
+
 def test_vuln_report(app, host_factory, service_factory, vuln_factory):  # pylint: disable=unused-argument
     """test vuln_report"""
 
@@ -48,6 +48,14 @@ def test_host_add_route(cl_operator, host_factory):
     assert thost.comment == ahost.comment
 
 
+def test_host_add_route_duplicate(cl_operator, host):
+    """host add route duplicate address test"""
+
+    response = cl_operator.post(url_for('storage.host_add_route'), params=[('address', host.address)], status='*')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert Host.query.count() == 1
+
+
 def test_host_edit_route(cl_operator, host):
     """host edit route test"""
 